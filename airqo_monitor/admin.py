@@ -6,7 +6,9 @@ from airqo_monitor.models import (
 	ChannelType,
 	GlobalVariable,
 	Incident,
+	Job,
 	MalfunctionReason,
+	ThingspeakUsage,
 )
 
 # Register your models here.
@@ -15,4 +17,6 @@ admin.site.register(ChannelNote)
 admin.site.register(ChannelType)
 admin.site.register(GlobalVariable)
 admin.site.register(Incident)
+admin.site.register(Job)
 admin.site.register(MalfunctionReason)
+admin.site.register(ThingspeakUsage)
@@ -0,0 +1,29 @@
+"""
+pytest-benchmark entry point for the pipeline benchmark. It isn't picked up by the test runner;
+run it explicitly with pytest-benchmark installed:
+
+    pytest airqo_monitor/benchmark/bench_pipeline.py --benchmark-json=benchmark.json
+
+Each stage's wall time, queries, bytes and peak memory end up in the run's extra_info.
+"""
+import os
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'gettingstarted.settings')
+django.setup()
+
+from airqo_monitor.benchmark.pipeline import run_pipeline_benchmark
+
+
+def _run_pipeline_benchmark(benchmark, **kwargs):
+    results = benchmark.pedantic(run_pipeline_benchmark, kwargs=kwargs, rounds=3, iterations=1)
+    benchmark.extra_info['stages'] = [result.to_dict() for result in results]
+
+
+def test_pipeline_small_fleet(benchmark):
+    _run_pipeline_benchmark(benchmark, num_channels=10, report_interval_seconds=60, duration_hours=24)
+
+
+def test_pipeline_large_fleet(benchmark):
+    _run_pipeline_benchmark(benchmark, num_channels=100, report_interval_seconds=60, duration_hours=24, trace_memory=False)
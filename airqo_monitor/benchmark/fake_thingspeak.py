@@ -0,0 +1,264 @@
+import gzip
+import json
+import random
+import threading
+import time
+
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib import parse
+
+from airqo_monitor.constants import (
+    AIRQO_CHANNEL_TYPE,
+    API_KEY_CONFIG_VAR_NAME,
+    SOIL_CHANNEL_TYPE,
+    THINGSPEAK_DATETIME_FORMAT,
+    THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS,
+)
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeThingspeakServer(object):
+    """
+    A local HTTP stand-in for the Thingspeak API calls this app makes, serving synthetic
+    channels so sweeps can be load tested and developed against without the network or API
+    limits.
+
+    There are num_channels airqo channels followed by num_soil_channels soil channels, each
+    reporting every report_interval_seconds for the duration_hours before the server started.
+    The first num_private_channels channels are private and only return feeds when given their
+    read key (see get_environ). Readings are generated from the entry id and the seed, so every
+    run with the same arguments serves the same data.
+
+    Like the real API:
+        - channels.json lists the channels, filtered by tag, and needs user_api_key if it's set
+        - /channels/<id>/feeds returns at most 8000 entries between start and end, the newest ones,
+          or the newest `results` entries (the app doesn't send `minutes`, so it isn't supported)
+        - /channels/<id>/fields/<n> does the same with only field<n> in each entry
+        - feeds requests with no entries in range, for an unknown channel or without the right
+          key for a private channel return -1
+        - responses are gzipped when the client asks for it
+
+    Every request waits latency_seconds (plus up to latency_jitter_seconds), and error_rate of
+    them fail with a 503. bytes_sent and num_requests count what was served.
+
+    Use it as a context manager, and point the Thingspeak URLs at channels_list_url and
+    feeds_list_url.
+    """
+
+    def __init__(self, num_channels=10, report_interval_seconds=60, duration_hours=24,
+                 num_soil_channels=0, num_private_channels=0, user_api_key=None,
+                 latency_seconds=0, latency_jitter_seconds=0, error_rate=0, seed=0,
+                 first_channel_id=100000, host='127.0.0.1', port=0):
+        self.report_interval = timedelta(seconds=report_interval_seconds)
+        self.end_time = datetime.utcnow().replace(microsecond=0)
+        self.num_entries = int(timedelta(hours=duration_hours) / self.report_interval)
+        self.channel_ids = list(range(first_channel_id, first_channel_id + num_channels + num_soil_channels))
+        self.soil_channel_ids = set(self.channel_ids[num_channels:])
+        self.private_channel_ids = set(self.channel_ids[:num_private_channels])
+        self.user_api_key = user_api_key
+        self.seed = seed
+
+        self.latency_seconds = latency_seconds
+        self.latency_jitter_seconds = latency_jitter_seconds
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+
+        self.bytes_sent = 0
+        self.num_requests = 0
+        self.num_errors = 0
+        self._lock = threading.Lock()
+
+        self._httpd = _ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def channels_list_url(self):
+        return '{}/channels.json'.format(self.url)
+
+    @property
+    def feeds_list_url(self):
+        return '{}/channels/{{}}'.format(self.url)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def get_channel_type(self, channel_id):
+        return SOIL_CHANNEL_TYPE if channel_id in self.soil_channel_ids else AIRQO_CHANNEL_TYPE
+
+    def get_api_key(self, channel_id):
+        return 'FAKE-READ-KEY-{}'.format(channel_id)
+
+    def get_environ(self):
+        """
+        Returns: dict of the environment variables the app reads its Thingspeak keys from
+        """
+        environ = {
+            API_KEY_CONFIG_VAR_NAME.format(channel_id): self.get_api_key(channel_id)
+            for channel_id in self.private_channel_ids
+        }
+        if self.user_api_key:
+            environ['THINGSPEAK_USER_API_KEY'] = self.user_api_key
+        return environ
+
+    def get_channel(self, channel_id):
+        channel_type = self.get_channel_type(channel_id)
+        return {
+            'id': channel_id,
+            'name': '{} BENCHMARK {}'.format(channel_type.upper(), channel_id),
+            'public_flag': channel_id not in self.private_channel_ids,
+            'tags': [{'name': channel_type}],
+            'last_entry_id': self.num_entries,
+        }
+
+    def get_created_at(self, entry_id):
+        return self.end_time - (self.num_entries - entry_id) * self.report_interval
+
+    def get_feed(self, channel_id, entry_id):
+        pm_2_5 = 10 + (entry_id * 7 + channel_id + self.seed) % 60
+        return {
+            'entry_id': entry_id,
+            'created_at': datetime.strftime(self.get_created_at(entry_id), THINGSPEAK_DATETIME_FORMAT),
+            'field1': '{:.2f}'.format(pm_2_5 * 0.6),
+            'field2': '{:.2f}'.format(pm_2_5),
+            'field3': '{:.2f}'.format(pm_2_5 * 1.4),
+            'field4': '1.39',
+            'field5': '{:.6f}'.format(0.3 + (channel_id % 100) * 0.001),
+            'field6': '{:.6f}'.format(32.5 + (channel_id % 100) * 0.001),
+            'field7': '{:.2f}'.format(4.2 - entry_id * 0.0001),
+            'field8': '0.3,32.5,1200,0,7,1.1',
+        }
+
+    def get_feeds(self, channel_id, start_time, end_time):
+        """
+        Like Thingspeak, return the newest THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS entries between
+        start_time and end_time, oldest first.
+        """
+        first_entry_id = max(1, self.num_entries - (self.end_time - start_time) // self.report_interval)
+        last_entry_id = min(self.num_entries, self.num_entries - -(-(self.end_time - end_time) // self.report_interval))
+        first_entry_id = max(first_entry_id, last_entry_id - THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS + 1)
+        return [self.get_feed(channel_id, entry_id) for entry_id in range(first_entry_id, last_entry_id + 1)]
+
+    def _handle(self, path, query):
+        """
+        Returns: tuple (status code, the JSON response for a request)
+        """
+        path_parts = [part for part in path.split('/') if part]
+        api_key = query.get('api_key', [None])[0]
+
+        # /channels.json/?api_key=...&tag=...
+        if path_parts == ['channels.json']:
+            if self.user_api_key and api_key != self.user_api_key:
+                return 401, {'status': '401', 'error': {'error_code': 'error_auth_required'}}
+
+            tag = query.get('tag', [None])[0]
+            return 200, [
+                self.get_channel(channel_id)
+                for channel_id in self.channel_ids
+                if tag is None or self.get_channel_type(channel_id) == tag
+            ]
+
+        # /channels/<id>/feeds/?start=...&end=...&api_key=... (or ?results=...)
+        # /channels/<id>/fields/<n>/?... for just one field
+        is_feeds = len(path_parts) == 3 and path_parts[2] == 'feeds'
+        is_field = len(path_parts) == 4 and path_parts[2] == 'fields'
+        if (is_feeds or is_field) and path_parts[0] == 'channels':
+            channel_id = int(path_parts[1])
+            if channel_id not in self.channel_ids:
+                return 200, -1
+            if channel_id in self.private_channel_ids and api_key != self.get_api_key(channel_id):
+                return 200, -1
+
+            if 'results' in query:
+                start_time = self.get_created_at(1)
+                end_time = self.end_time
+            else:
+                start_time = datetime.strptime(query['start'][0], THINGSPEAK_DATETIME_FORMAT)
+                end_time = datetime.strptime(query['end'][0], THINGSPEAK_DATETIME_FORMAT)
+            feeds = self.get_feeds(channel_id, start_time, end_time)
+            if 'results' in query:
+                feeds = feeds[-int(query['results'][0]):]
+            if is_field:
+                field_name = 'field{}'.format(path_parts[3])
+                feeds = [
+                    {'entry_id': feed['entry_id'], 'created_at': feed['created_at'], field_name: feed[field_name]}
+                    for feed in feeds
+                ]
+            if not feeds:
+                return 200, -1
+            return 200, {'channel': self.get_channel(channel_id), 'feeds': feeds}
+
+        return 404, -1
+
+    def _get_request_delay_and_failure(self):
+        """
+        Returns: tuple (seconds to wait before responding, whether to fail the request)
+        """
+        with self._lock:
+            delay = self.latency_seconds + self._random.uniform(0, self.latency_jitter_seconds)
+            fail = self._random.random() < self.error_rate
+        return delay, fail
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _respond(self):
+                delay, fail = server._get_request_delay_and_failure()
+                if delay:
+                    time.sleep(delay)
+
+                if fail:
+                    status = 503
+                    body = b'Service Unavailable'
+                else:
+                    url = parse.urlparse(self.path)
+                    status, response = server._handle(url.path, parse.parse_qs(url.query))
+                    body = json.dumps(response).encode('utf-8')
+
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    self.send_header('Content-Encoding', 'gzip')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+
+                # Count before writing, so the counts are up to date once the client has the response
+                with server._lock:
+                    server.bytes_sent += len(body)
+                    server.num_requests += 1
+                    if fail:
+                        server.num_errors += 1
+                self.wfile.write(body)
+
+            do_GET = _respond
+            do_POST = _respond
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,301 @@
+import json
+import mock
+import os
+import threading
+import time
+import tracemalloc
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.db.backends.utils import CursorWrapper
+from django.test.utils import override_settings
+
+from airqo_monitor.benchmark.fake_thingspeak import FakeThingspeakServer
+from airqo_monitor.constants import AIRQO_CHANNEL_TYPE
+from airqo_monitor.external import thingspeak
+from airqo_monitor.format_data import get_and_format_data_for_channel, select_data_format, update_all_channel_data
+from airqo_monitor.malfunction_detection import MalfunctionThresholds
+from airqo_monitor.malfunction_detection.get_malfunctions import (
+    _get_malfunction_detector,
+    _get_malfunctions_for_channels,
+    get_all_channel_malfunctions,
+    update_db,
+)
+from airqo_monitor.models import (
+    Channel,
+    ChannelType,
+    GlobalVariable,
+    MalfunctionReason,
+)
+from airqo_monitor.utils import clear_global_var_cache, update_last_channel_update_time
+
+
+BENCHMARK_DATA_FORMAT = {
+    "field1": "pm_1",
+    "field2": "pm_2_5",
+    "field3": "pm_10",
+    "field4": "sample_period",
+    "field5": "latitude",
+    "field6": "longitude",
+    "field7": "battery_voltage",
+    "field8": "latlonalt",
+}
+
+BENCHMARK_GLOBAL_VARS = {
+    'LOW_BATTERY_CUTOFF': '3.3',
+    'AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION': '10',
+    'AIRQO_SENSOR_PM_2_5_MIN_CUTOFF': '1.0',
+    'AIRQO_SENSOR_PM_2_5_MAX_CUTOFF': '1000.0',
+    'AIRQO_ALLOWABLE_OUTLIER_SENSOR_RATIO': '0.2',
+    'AIRQO_NUM_REPORTS_TO_VERIFY_REPORTING_MALFUNCTION': '10',
+    'AIRQO_MAXIMUM_AVERAGE_SECONDS_BETWEEN_REPORTS': '180',
+}
+
+BENCHMARK_MALFUNCTION_REASONS = [
+    'no_data',
+    'low_battery_voltage',
+    'low_reporting_frequency',
+    'reporting_outliers',
+]
+
+
+class QueryCounter(object):
+    """
+    Count the SQL statements run on any connection, including the ones worker threads open,
+    while the context is active.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def _wrap(self, method):
+        counter = self
+
+        def counted(cursor, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return method(cursor, *args, **kwargs)
+
+        return counted
+
+    def __enter__(self):
+        self._patchers = [
+            mock.patch.object(CursorWrapper, 'execute', self._wrap(CursorWrapper.execute)),
+            mock.patch.object(CursorWrapper, 'executemany', self._wrap(CursorWrapper.executemany)),
+        ]
+        for patcher in self._patchers:
+            patcher.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        for patcher in self._patchers:
+            patcher.stop()
+
+
+class StageResult(object):
+
+    def __init__(self, stage, wall_seconds, num_queries, bytes_transferred, peak_memory_bytes):
+        self.stage = stage
+        self.wall_seconds = wall_seconds
+        self.num_queries = num_queries
+        self.bytes_transferred = bytes_transferred
+        self.peak_memory_bytes = peak_memory_bytes
+
+    def to_dict(self):
+        return {
+            'stage': self.stage,
+            'wall_seconds': self.wall_seconds,
+            'num_queries': self.num_queries,
+            'bytes_transferred': self.bytes_transferred,
+            'peak_memory_bytes': self.peak_memory_bytes,
+        }
+
+
+def measure_stage(stage, func, server, trace_memory=True):
+    """
+    Run func() and measure its wall time, the queries it issues, the bytes the fake Thingspeak
+    server sends and (if trace_memory) the peak Python memory allocated while it runs.
+
+    Returns: tuple (func's return value, StageResult)
+    """
+    bytes_before = server.bytes_sent
+    if trace_memory:
+        tracemalloc.start()
+
+    try:
+        with QueryCounter() as query_counter:
+            start = time.perf_counter()
+            result = func()
+            wall_seconds = time.perf_counter() - start
+        peak_memory_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+
+    return result, StageResult(
+        stage,
+        wall_seconds,
+        query_counter.count,
+        server.bytes_sent - bytes_before,
+        peak_memory_bytes,
+    )
+
+
+@contextmanager
+def benchmark_database():
+    """
+    Run inside a throwaway test database (like the test runner does), so the benchmark never
+    touches real data and worker threads see everything the benchmark writes.
+    """
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True, keepdb=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+@contextmanager
+def fake_thingspeak(server, rate_limit=False):
+    """
+    Point the Thingspeak client at the fake server, with the keys it expects. The fake server
+    has no rate limits, so the client's isn't applied either unless rate_limit is True.
+    """
+    settings_override = override_settings(
+        THINGSPEAK_CHANNELS_LIST_URL=server.channels_list_url,
+        THINGSPEAK_FEEDS_LIST_URL=server.feeds_list_url,
+    )
+    with settings_override, mock.patch.dict(os.environ, server.get_environ()):
+        if rate_limit:
+            yield
+        else:
+            with mock.patch.object(thingspeak.client, 'rate_limiter', None):
+                yield
+
+
+def create_benchmark_data():
+    ChannelType.objects.get_or_create(
+        name=AIRQO_CHANNEL_TYPE,
+        defaults=dict(friendly_name='Airqo', data_format_json=json.dumps(BENCHMARK_DATA_FORMAT)),
+    )
+    for key, value in BENCHMARK_GLOBAL_VARS.items():
+        GlobalVariable.objects.update_or_create(key=key, defaults=dict(value=value))
+    GlobalVariable.objects.get_or_create(key='LAST_CHANNEL_UPDATE_TIME')
+    update_last_channel_update_time()
+    for name in BENCHMARK_MALFUNCTION_REASONS:
+        MalfunctionReason.objects.get_or_create(name=name, defaults=dict(description=name))
+    clear_global_var_cache()
+
+
+def run_pipeline_benchmark(num_channels=10, report_interval_seconds=60, duration_hours=24, trace_memory=True,
+                           rate_limit=False, **server_options):
+    """
+    Benchmark each stage of a malfunction detection sweep against a fake Thingspeak server with
+    num_channels channels reporting every report_interval_seconds for duration_hours (and any
+    other FakeThingspeakServer options, e.g. latency_seconds or error_rate), optionally with the
+    Thingspeak client's rate limit applied:
+
+        - get_data_for_channel: fetching the raw feeds for every channel
+        - get_data_for_channel_pm_2_5: the same, with only the PM2.5 field requested
+        - get_and_format_data_for_channel: syncing them into the feed store and formatting them
+        - detectors: running the malfunction detectors on the formatted data
+        - update_db: reconciling the resulting incidents
+        - get_all_channel_malfunctions: a whole scheduled sweep, after the stages above, so it
+          shows the cost of an incremental sweep
+
+    The stages before the whole sweep run one channel at a time, so their numbers don't depend
+    on THINGSPEAK_MAX_CONCURRENT_REQUESTS.
+
+    Returns: list of StageResults
+    """
+    results = []
+    start_time = datetime.utcnow() - timedelta(days=1)
+
+    with benchmark_database(), \
+            FakeThingspeakServer(num_channels, report_interval_seconds, duration_hours, **server_options) as server, \
+            fake_thingspeak(server, rate_limit):
+        create_benchmark_data()
+        update_all_channel_data(force=True)
+        channels = list(Channel.objects.filter(is_active=True).select_related('channel_type'))
+
+        _, result = measure_stage(
+            'get_data_for_channel',
+            lambda: [thingspeak.get_data_for_channel(channel.channel_id, start_time=start_time) for channel in channels],
+            server,
+            trace_memory,
+        )
+        results.append(result)
+
+        _, result = measure_stage(
+            'get_data_for_channel_pm_2_5',
+            lambda: [
+                thingspeak.get_data_for_channel(
+                    channel.channel_id,
+                    start_time=start_time,
+                    fields=list(select_data_format(channel.channel_type.data_format, ['pm_2_5'])),
+                )
+                for channel in channels
+            ],
+            server,
+            trace_memory,
+        )
+        results.append(result)
+
+        all_channel_data, result = measure_stage(
+            'get_and_format_data_for_channel',
+            lambda: [
+                get_and_format_data_for_channel(channel, start_time=start_time, columnar=True)
+                for channel in channels
+            ],
+            server,
+            trace_memory,
+        )
+        results.append(result)
+
+        thresholds = MalfunctionThresholds.load()
+        detection_inputs = []
+        for channel, channel_data in zip(channels, all_channel_data):
+            num_recent_entries = _get_malfunction_detector(channel.channel_type.name, thresholds).get_num_recent_entries_needed()
+            detection_inputs.append((channel_data[-num_recent_entries:], channel.channel_type.name, thresholds))
+
+        all_malfunctions, result = measure_stage(
+            'detectors',
+            lambda: _get_malfunctions_for_channels(detection_inputs),
+            server,
+            trace_memory,
+        )
+        results.append(result)
+
+        _, result = measure_stage(
+            'update_db',
+            lambda: update_db([
+                {'channel_id': channel.channel_id, 'possible_malfunction_reasons': malfunctions}
+                for channel, malfunctions in zip(channels, all_malfunctions)
+            ]),
+            server,
+            trace_memory,
+        )
+        results.append(result)
+
+        _, result = measure_stage('get_all_channel_malfunctions', get_all_channel_malfunctions, server, trace_memory)
+        results.append(result)
+
+    return results
+
+
+def format_results(results):
+    """Returns: the results as a plain text table"""
+    lines = ['{:<34}{:>12}{:>10}{:>14}{:>16}'.format('stage', 'wall (s)', 'queries', 'bytes', 'peak mem (KB)')]
+    for result in results:
+        peak_memory = '{:.0f}'.format(result.peak_memory_bytes / 1024) if result.peak_memory_bytes is not None else '-'
+        lines.append('{:<34}{:>12.3f}{:>10}{:>14}{:>16}'.format(
+            result.stage,
+            result.wall_seconds,
+            result.num_queries,
+            result.bytes_transferred,
+            peak_memory,
+        ))
+    return '\n'.join(lines)
@@ -0,0 +1,94 @@
+import mock
+
+from datetime import timedelta
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from airqo_monitor.benchmark.fake_thingspeak import FakeThingspeakServer
+from airqo_monitor.benchmark.pipeline import fake_thingspeak
+from airqo_monitor.external.thingspeak import (
+    get_all_channels_by_type,
+    get_data_for_channel,
+)
+
+
+class TestFakeThingspeakServer(TestCase):
+
+    def test_channels_are_listed_by_tag(self):
+        with FakeThingspeakServer(num_channels=3) as server, fake_thingspeak(server):
+            channels = get_all_channels_by_type('airqo')
+            assert [channel['id'] for channel in channels] == server.channel_ids
+            assert get_all_channels_by_type('soil') == []
+
+    def test_feeds_are_paged_like_thingspeak(self):
+        # 8640 entries, so more than one page of 8000
+        with FakeThingspeakServer(num_channels=1, report_interval_seconds=10, duration_hours=24) as server, \
+                fake_thingspeak(server):
+            data = get_data_for_channel(server.channel_ids[0], start_time=server.end_time - timedelta(days=2))
+
+            assert [entry['entry_id'] for entry in data] == list(range(1, 8641))
+            assert server.num_requests == 2
+            assert server.bytes_sent > 0
+
+            # Only the entries inside the window come back
+            data = get_data_for_channel(
+                server.channel_ids[0],
+                start_time=server.end_time - timedelta(minutes=1),
+                end_time=server.end_time,
+            )
+            assert [entry['entry_id'] for entry in data] == list(range(8634, 8641))
+
+    def test_fields_and_short_queries(self):
+        with FakeThingspeakServer(num_channels=1) as server, fake_thingspeak(server):
+            channel_id = server.channel_ids[0]
+            full_data = get_data_for_channel(channel_id, results=10)
+            full_bytes = server.bytes_sent
+
+            # The newest 10 entries, in one request
+            assert [entry['entry_id'] for entry in full_data] == list(range(1431, 1441))
+            assert server.num_requests == 1
+
+            # A single field is served on its own, so less comes over the wire
+            data = get_data_for_channel(channel_id, fields=['field2'], results=10)
+            assert data == [
+                {'entry_id': entry['entry_id'], 'created_at': entry['created_at'], 'field2': entry['field2']}
+                for entry in full_data
+            ]
+            assert server.bytes_sent - full_bytes < full_bytes
+
+            # Several fields come from the full feed and are trimmed
+            data = get_data_for_channel(channel_id, fields=['field2', 'field7'], results=6)
+            assert [entry['entry_id'] for entry in data] == list(range(1435, 1441))
+            assert set(data[0]) == {'entry_id', 'created_at', 'field2', 'field7'}
+            assert server.num_requests == 3
+
+    def test_private_channels_need_their_key(self):
+        with FakeThingspeakServer(num_channels=2, num_private_channels=1) as server:
+            private_channel_id, public_channel_id = server.channel_ids
+
+            with override_settings(THINGSPEAK_FEEDS_LIST_URL=server.feeds_list_url):
+                assert get_data_for_channel(private_channel_id) == []
+                assert len(get_data_for_channel(public_channel_id)) == server.num_entries
+
+            with fake_thingspeak(server):
+                assert len(get_data_for_channel(private_channel_id)) == server.num_entries
+
+    def test_soil_channels_are_tagged(self):
+        with FakeThingspeakServer(num_channels=2, num_soil_channels=1) as server, fake_thingspeak(server):
+            assert [channel['id'] for channel in get_all_channels_by_type('soil')] == server.channel_ids[2:]
+            assert len(get_all_channels_by_type('airqo')) == 2
+
+    def test_unknown_paths_are_not_found(self):
+        server = FakeThingspeakServer(num_channels=1)
+
+        assert server._handle('/', {}) == (404, -1)
+        assert server._handle('/channels/{}/'.format(server.channel_ids[0]), {}) == (404, -1)
+
+    @mock.patch('airqo_monitor.external.http_client.time.sleep')
+    def test_injected_errors_are_retried(self, sleep_mocker):
+        with FakeThingspeakServer(num_channels=1, error_rate=0.5, seed=1) as server, fake_thingspeak(server):
+            for _ in range(5):
+                get_all_channels_by_type('airqo')
+
+            assert server.num_errors > 0
+            assert server.num_requests == 5 + server.num_errors
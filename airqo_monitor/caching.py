@@ -0,0 +1,166 @@
+import threading
+import time
+
+from contextlib import contextmanager
+from django.core.cache import cache
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from airqo_monitor.constants import (
+    CACHE_LOCK_POLL_SECONDS,
+    CACHE_LOCK_TIMEOUT_SECONDS,
+    DASHBOARD_CACHE_GENERATION_KEY,
+    DASHBOARD_CACHE_TIMEOUT_SECONDS,
+)
+from airqo_monitor.models import Channel, ChannelNote, Incident
+
+# Channel fields that show up on the dashboard. Saves that only touch other fields (like the
+# feed store's high-water marks) don't need to invalidate anything.
+DASHBOARD_CHANNEL_FIELDS = {'channel_id', 'name', 'is_active', 'channel_type'}
+
+
+def get_dashboard_generation():
+    generation = cache.get(DASHBOARD_CACHE_GENERATION_KEY)
+    if generation is None:
+        generation = 0
+        cache.add(DASHBOARD_CACHE_GENERATION_KEY, generation, timeout=None)
+    return generation
+
+
+def invalidate_dashboard_cache():
+    """
+    Bump the dashboard generation so every cached dashboard entry is stale. Old entries aren't
+    deleted, they just stop being looked up and expire on their own.
+    """
+    try:
+        cache.incr(DASHBOARD_CACHE_GENERATION_KEY)
+    except ValueError:
+        cache.set(DASHBOARD_CACHE_GENERATION_KEY, 1, timeout=None)
+
+
+@receiver(post_save, sender=Incident)
+@receiver(post_delete, sender=Incident)
+@receiver(post_save, sender=ChannelNote)
+@receiver(post_delete, sender=ChannelNote)
+@receiver(post_save, sender=Channel)
+@receiver(post_delete, sender=Channel)
+def _invalidate_dashboard_cache_on_write(sender, update_fields=None, **kwargs):
+    if sender is Channel and update_fields and not DASHBOARD_CHANNEL_FIELDS.intersection(update_fields):
+        return
+    invalidate_dashboard_cache()
+
+
+def get_or_set_dashboard_data(name, last_update_time, compute):
+    """
+    Get data for a dashboard view from the cache, or compute and cache it.
+
+    Entries are keyed on the LAST_CHANNEL_UPDATE_TIME value, so they turn over whenever a
+    malfunction sweep finishes, and on the dashboard generation, which incident, note and
+    channel writes bump.
+
+    Returns: whatever compute() returns
+    """
+    key = 'dashboard:{}:{}:{}'.format(name, last_update_time, get_dashboard_generation())
+    data = cache.get(key)
+    if data is None:
+        data = compute()
+        cache.set(key, data, timeout=DASHBOARD_CACHE_TIMEOUT_SECONDS)
+    return data
+
+
+class CacheLockTimeout(Exception):
+    """Raised when another process held a cache lock for longer than the caller would wait."""
+
+
+def get_or_set_with_lock(key, compute, timeout, lock_timeout=CACHE_LOCK_TIMEOUT_SECONDS,
+                         wait_seconds=None, poll_seconds=CACHE_LOCK_POLL_SECONDS):
+    """
+    Get key from the cache, or compute and cache it for timeout seconds. With a shared cache
+    backend, only one process recomputes a missing or expired entry: it holds a lock (an add()ed
+    key that expires after lock_timeout, in case the process dies) while the others poll for its
+    result. If the lock holder fails (or dies, and its lock expires), one of the waiting
+    processes takes the lock over and computes the entry instead.
+
+    Waiters never compute without the lock, since that is exactly the stampede the lock is there
+    to stop. By default they wait as long as the lock can be held; if wait_seconds is given and
+    passes first, CacheLockTimeout is raised.
+
+    compute() mustn't return None, which can't be told apart from a cache miss.
+
+    Returns: whatever compute() returns
+    """
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    lock_key = '{}:lock'.format(key)
+    if cache.add(lock_key, True, timeout=lock_timeout):
+        try:
+            value = compute()
+            cache.set(key, value, timeout=timeout)
+        finally:
+            cache.delete(lock_key)
+        return value
+
+    if wait_seconds is None:
+        # A little longer than the lock can live, so an expired lock is always noticed
+        wait_seconds = lock_timeout + poll_seconds
+    deadline = time.time() + wait_seconds
+    while time.time() < deadline:
+        time.sleep(poll_seconds)
+        value = cache.get(key)
+        if value is not None:
+            return value
+        if cache.get(lock_key) is None:
+            # The other process finished without caching anything (it failed or died), so take over
+            return get_or_set_with_lock(key, compute, timeout, lock_timeout, deadline - time.time(), poll_seconds)
+
+    raise CacheLockTimeout('Gave up waiting for {} after {} seconds'.format(key, wait_seconds))
+
+
+@contextmanager
+def renewing_cache_locks(lock_keys, timeout):
+    """
+    Hold cache locks the caller has already taken (with cache.add and the same timeout) for as
+    long as the block runs, then release them. A background thread renews them every third of
+    timeout, so timeout can be short: if the process dies, its locks expire soon after.
+    """
+    stopped = threading.Event()
+
+    def renew():
+        try:
+            while not stopped.wait(timeout / 3.0):
+                cache.set_many({lock_key: True for lock_key in lock_keys}, timeout=timeout)
+        finally:
+            # The database cache backend opens a connection for this thread
+            connection.close()
+
+    renewer = threading.Thread(target=renew, daemon=True)
+    renewer.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        renewer.join()
+        cache.delete_many(lock_keys)
+
+
+def set_with_age(key, value, timeout):
+    """
+    Cache value for timeout seconds, along with when it was computed (see get_with_age)
+    """
+    cache.set(key, {'value': value, 'computed_at': time.time()}, timeout=timeout)
+
+
+def get_with_age(key):
+    """
+    Get a value cached by set_with_age. Callers can serve a value that's getting old while they
+    arrange for it to be recomputed elsewhere, rather than computing it themselves.
+
+    Returns: tuple (the value, its age in seconds), or (None, None) if it isn't cached
+    """
+    entry = cache.get(key)
+    if entry is None:
+        return None, None
+    return entry['value'], time.time() - entry['computed_at']
@@ -4,6 +4,34 @@
 DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS = 7
 THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS = 8000
 THINGSPEAK_FEEDS_LIST_URL = 'http://thingspeak.com/channels/{}'
+THINGSPEAK_MAX_CONCURRENT_REQUESTS = 8
+
+# local feed store
+FEED_STORE_RETENTION_DAYS = 30
+FEED_STORE_BULK_CREATE_BATCH_SIZE = 500
+THINGSPEAK_FIELD_NAMES = ['field{}'.format(i) for i in range(1, 9)]
+THINGSPEAK_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+# rollups
+ROLLUP_FIELD_NAMES = ['pm_1', 'pm_2_5', 'pm_10', 'battery_voltage']
+ROLLUP_HOURLY_RETENTION_DAYS = 365
+ROLLUP_MAX_POINTS = 500
+
+# http client
+THINGSPEAK_CONNECT_TIMEOUT_SECONDS = 5
+THINGSPEAK_READ_TIMEOUT_SECONDS = 30
+THINGSPEAK_MAX_RETRIES = 3
+THINGSPEAK_RETRY_BACKOFF_SECONDS = 1
+THINGSPEAK_RETRY_MAX_BACKOFF_SECONDS = 30
+THINGSPEAK_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+THINGSPEAK_RATE_LIMIT_PER_SECOND = 4
+THINGSPEAK_RATE_LIMIT_BURST = 8
+THINGSPEAK_RATE_LIMIT_CACHE_KEY = 'thingspeak-rate-limit'  # shared by every process using the cache
+RATE_LIMIT_CACHE_WAIT_SECONDS = 60  # after this, a request waiting on the shared limit uses its process's own bucket
+
+# request usage accounting
+THINGSPEAK_USAGE_FLUSH_INTERVAL_SECONDS = 60
+THINGSPEAK_USAGE_RETENTION_DAYS = 30
 
 # channels
 MATHWORKS_USER_ID = 'baurd'
@@ -14,6 +42,8 @@ API_KEY_CONFIG_VAR_NAME = 'CHANNEL_{}_API_KEY'
 AIRQO_CHANNEL_TYPE = 'airqo'
 SOIL_CHANNEL_TYPE = 'soil'
 LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME = 'LAST_CHANNEL_UPDATE_TIME'
+CHANNEL_METADATA_SYNC_INTERVAL_SECONDS = 15 * 60
+CHANNEL_METADATA_SYNC_CACHE_KEY = 'channel-metadata-synced'
 
 # Incidents
 NO_DATA_MALFUNCTION_REASON_STR = 'no_data'
@@ -21,5 +51,52 @@ LOW_BATTERY_MALFUNCTION_REASON_STR = 'low_battery_voltage'
 LOW_REPORTING_FREQUENCY_MALFUNCTION_REASON_STR = 'low_reporting_frequency'
 REPORTING_OUTLIERS_MALFUNCTION_REASON_STR = 'reporting_outliers'
 
+# Malfunction detection
+DETECTION_MAX_PROCESSES = None  # one per core
+DETECTION_PROCESS_POOL_MIN_CHANNELS = 50
+DETECTION_PROCESS_POOL_CHUNKS_PER_PROCESS = 4
+
+# Adaptive checking. Each channel's time between checks halves while its readings are volatile,
+# drops to the minimum while it's malfunctioning, doubles while it's stable or quiet, and goes
+# straight to the maximum once it's marked INACTIVE.
+CHECK_INTERVAL_MIN_SECONDS = 15 * 60
+CHECK_INTERVAL_MAX_SECONDS = 6 * 60 * 60
+CHECK_INTERVAL_DEFAULT_SECONDS = 60 * 60
+CHECK_INTERVAL_BACKOFF_FACTOR = 2
+CHECK_INTERVAL_VOLATILE_COEFFICIENT_OF_VARIATION = 0.5  # of the recent PM2.5 readings
+CHECK_DUE_SLACK_SECONDS = 60  # so a channel due just after a sweep starts isn't left for a whole interval
+
+# Scheduled sweeps (shard counts and intervals are set per ChannelType)
+SWEEP_LOCK_KEY = 'sweep-lock:{}:{}'
+SWEEP_LOCK_TIMEOUT_SECONDS = 5 * 60  # renewed while the sweep runs, so this is how long a dead sweep's lock lasts
+SWEEP_LOCK_WAIT_SECONDS = 15 * 60  # how long a queued full sweep waits for running shard sweeps
+SWEEP_SCHEDULE_REFRESH_MINUTES = 10
+
+# Background jobs
+JOB_POLL_INTERVAL_SECONDS = 5
+JOB_STALE_AFTER_SECONDS = 2 * 60 * 60  # a running job this old is assumed to have died with its worker
+JOB_ENQUEUE_LOCK_KEY = 'job-enqueue-lock'
+
+# Heatmap
+HEATMAP_GRID_CELL_DEGREES = 0.001  # roughly 110m at the equator
+
+# Dashboard caching
+DASHBOARD_CACHE_TIMEOUT_SECONDS = 60 * 60
+DASHBOARD_CACHE_GENERATION_KEY = 'dashboard-generation'
+
+# Shared caching. The cache backend is configured in settings (CACHE_BACKEND / CACHE_LOCATION).
+THINGSPEAK_CHANNELS_CACHE_KEY = 'get-all-channels'
+THINGSPEAK_CHANNELS_CACHE_TIMEOUT_SECONDS = 30 * 60
+MALFUNCTIONS_CACHE_KEY = 'channel-malfunctions'
+MALFUNCTIONS_CACHE_TIMEOUT_SECONDS = 5 * 60  # after this, the old result is served while a sweep is queued
+MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS = 60 * 60  # after this, it isn't served at all
+MALFUNCTIONS_RETRY_AFTER_SECONDS = 60  # how long to tell clients to wait when there's nothing to serve
+CACHE_LOCK_TIMEOUT_SECONDS = 60
+CACHE_LOCK_WAIT_SECONDS = 30
+CACHE_LOCK_POLL_SECONDS = 0.5
+
+# Global variables
+GLOBAL_VARIABLE_CACHE_TTL_SECONDS = 60
+
 # Misc constants
 PYTZ_KAMPALA_STRING = 'Africa/Kampala'
@@ -0,0 +1,97 @@
+import random
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from airqo_monitor.constants import (
+    THINGSPEAK_CONNECT_TIMEOUT_SECONDS,
+    THINGSPEAK_MAX_CONCURRENT_REQUESTS,
+    THINGSPEAK_MAX_RETRIES,
+    THINGSPEAK_READ_TIMEOUT_SECONDS,
+    THINGSPEAK_RETRY_BACKOFF_SECONDS,
+    THINGSPEAK_RETRY_MAX_BACKOFF_SECONDS,
+    THINGSPEAK_RETRY_STATUS_CODES,
+)
+
+
+class HttpClient(object):
+    """
+    Wrapper around a requests Session that keeps connections alive between calls, puts a
+    connect/read timeout on every request, and retries throttled (429) or failed (5xx, connection
+    error, timeout) requests with jittered exponential backoff.
+
+    If given, every attempt waits for rate_limiter.acquire() first, and every response is passed
+    to on_response (e.g. to count it).
+
+    A single instance is meant to be shared by every caller in a process, including worker threads.
+    """
+
+    def __init__(self, pool_size=THINGSPEAK_MAX_CONCURRENT_REQUESTS,
+                 connect_timeout=THINGSPEAK_CONNECT_TIMEOUT_SECONDS,
+                 read_timeout=THINGSPEAK_READ_TIMEOUT_SECONDS,
+                 max_retries=THINGSPEAK_MAX_RETRIES,
+                 backoff_seconds=THINGSPEAK_RETRY_BACKOFF_SECONDS,
+                 max_backoff_seconds=THINGSPEAK_RETRY_MAX_BACKOFF_SECONDS,
+                 retry_status_codes=THINGSPEAK_RETRY_STATUS_CODES,
+                 rate_limiter=None,
+                 on_response=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.retry_status_codes = retry_status_codes
+        self.rate_limiter = rate_limiter
+        self.on_response = on_response
+
+        self.session = requests.Session()
+        self.session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, **kwargs):
+        """
+        Make a request, retrying up to max_retries times. Once the retries are used up, the last
+        response is returned as is (or the last connection error/timeout is raised).
+
+        Returns: requests Response
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+
+        while True:
+            response = None
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.max_retries:
+                    raise
+            else:
+                if self.on_response:
+                    self.on_response(response)
+                if response.status_code not in self.retry_status_codes or attempt >= self.max_retries:
+                    return response
+
+            time.sleep(self._get_backoff_seconds(attempt, response))
+            attempt += 1
+
+    def _get_backoff_seconds(self, attempt, response=None):
+        """
+        Honour a Retry-After header if the server sent one, otherwise pick a random wait of up to
+        backoff_seconds * 2^attempt ("full jitter") so concurrent callers don't retry in lockstep.
+        """
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff_seconds)
+
+        max_wait = min(self.max_backoff_seconds, self.backoff_seconds * (2 ** attempt))
+        return random.uniform(0, max_wait)
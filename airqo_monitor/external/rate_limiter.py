@@ -0,0 +1,83 @@
+import threading
+import time
+
+from django.core.cache import cache
+
+from airqo_monitor.constants import RATE_LIMIT_CACHE_WAIT_SECONDS
+
+
+class TokenBucketRateLimiter(object):
+    """
+    Token bucket: requests can burst up to `burst` at once, and are otherwise limited to
+    `rate_per_second` on average.
+
+    The bucket is shared by every thread in the process. If cache_key is given, every process
+    sharing the cache (web workers and the scheduler, on any machine, with the database cache) is
+    limited together instead. That limit is a fixed window rather than a bucket: each window of
+    burst / rate_per_second seconds has a counter in the cache, and up to `burst` requests are let
+    through in it. Taking a request is one atomic cache.add and cache.incr, with no lock.
+
+    If the cache fails, or a request has waited on the shared limit for longer than
+    RATE_LIMIT_CACHE_WAIT_SECONDS, it falls back to the process's own bucket.
+    """
+
+    def __init__(self, rate_per_second, burst, cache_key=None):
+        self.rate_per_second = float(rate_per_second)
+        self.burst = float(burst)
+        self.cache_key = cache_key
+
+        self._lock = threading.Lock()
+        self._tokens = self.burst
+        self._updated_at = time.time()
+        self._window_seconds = self.burst / self.rate_per_second
+
+    def _take_token(self, tokens, updated_at, now):
+        """
+        Refill the bucket for the time since updated_at, then take a token if there is one.
+
+        Returns: tuple (tokens left, seconds to wait before one is available, or 0 if one was taken)
+        """
+        tokens = min(self.burst, tokens + max(0, now - updated_at) * self.rate_per_second)
+        if tokens >= 1:
+            return tokens - 1, 0
+        return tokens, (1 - tokens) / self.rate_per_second
+
+    def _try_acquire_in_process(self):
+        now = time.time()
+        self._tokens, wait_seconds = self._take_token(self._tokens, self._updated_at, now)
+        self._updated_at = now
+        return wait_seconds
+
+    def _try_acquire_in_cache(self):
+        now = time.time()
+        window = int(now // self._window_seconds)
+        key = '{}:{}'.format(self.cache_key, window)
+        # Kept a little past the end of the window, so it can't expire while it's being counted
+        cache.add(key, 0, timeout=2 * self._window_seconds)
+        if cache.incr(key) <= self.burst:
+            return 0
+        return (window + 1) * self._window_seconds - now
+
+    def _try_acquire(self, shared_until):
+        if self.cache_key and time.time() < shared_until:
+            try:
+                return self._try_acquire_in_cache()
+            except Exception as e:
+                print('[TokenBucketRateLimiter] Using the in-process bucket, the cache failed: {}'.format(e))
+        with self._lock:
+            return self._try_acquire_in_process()
+
+    def acquire(self):
+        """
+        Wait until a request is allowed.
+
+        Returns: the number of seconds spent waiting
+        """
+        shared_until = time.time() + RATE_LIMIT_CACHE_WAIT_SECONDS
+        waited = 0
+        while True:
+            wait_seconds = self._try_acquire(shared_until)
+            if not wait_seconds:
+                return waited
+            time.sleep(wait_seconds)
+            waited += wait_seconds
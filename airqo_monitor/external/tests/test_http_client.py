@@ -0,0 +1,86 @@
+import mock
+import requests
+
+from bunch import Bunch
+from django.test import TestCase
+
+from airqo_monitor.external.http_client import HttpClient
+
+
+class TestHttpClient(TestCase):
+
+    def setUp(self):
+        self.client = HttpClient(max_retries=2, backoff_seconds=1, max_backoff_seconds=10)
+
+    @mock.patch('airqo_monitor.external.http_client.time.sleep')
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_request_uses_timeouts_and_returns_response(self, request_mocker, sleep_mocker):
+        request_mocker.return_value = Bunch(status_code=200, headers={})
+
+        response = self.client.get('http://thingspeak.com/channels/123')
+
+        assert response.status_code == 200
+        request_mocker.assert_called_once_with('GET', 'http://thingspeak.com/channels/123', timeout=self.client.timeout)
+        assert not sleep_mocker.called
+
+    @mock.patch('airqo_monitor.external.http_client.time.sleep')
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_request_retries_throttled_and_server_errors(self, request_mocker, sleep_mocker):
+        request_mocker.side_effect = [
+            Bunch(status_code=429, headers={'Retry-After': '3'}),
+            Bunch(status_code=503, headers={}),
+            Bunch(status_code=200, headers={}),
+        ]
+
+        response = self.client.post('http://thingspeak.com/channels/123')
+
+        assert response.status_code == 200
+        assert request_mocker.call_count == 3
+        assert sleep_mocker.call_count == 2
+        # The first wait honours Retry-After, the second is jittered up to backoff_seconds * 2
+        assert sleep_mocker.call_args_list[0][0][0] == 3
+        assert 0 <= sleep_mocker.call_args_list[1][0][0] <= 2
+
+    @mock.patch('airqo_monitor.external.http_client.time.sleep')
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_request_gives_up_after_max_retries(self, request_mocker, sleep_mocker):
+        request_mocker.return_value = Bunch(status_code=500, headers={})
+
+        response = self.client.get('http://thingspeak.com/channels/123')
+
+        assert response.status_code == 500
+        assert request_mocker.call_count == 3
+
+    @mock.patch('airqo_monitor.external.http_client.time.sleep')
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_request_reraises_timeout_after_max_retries(self, request_mocker, sleep_mocker):
+        request_mocker.side_effect = requests.Timeout()
+
+        with self.assertRaises(requests.Timeout):
+            self.client.get('http://thingspeak.com/channels/123')
+
+        assert request_mocker.call_count == 3
+
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_request_does_not_retry_client_errors(self, request_mocker):
+        request_mocker.return_value = Bunch(status_code=400, headers={})
+
+        response = self.client.get('http://thingspeak.com/channels/123')
+
+        assert response.status_code == 400
+        assert request_mocker.call_count == 1
+
+    @mock.patch('airqo_monitor.external.http_client.time.sleep')
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_every_attempt_is_rate_limited_and_reported(self, request_mocker, sleep_mocker):
+        rate_limiter = mock.Mock()
+        on_response = mock.Mock()
+        client = HttpClient(max_retries=2, rate_limiter=rate_limiter, on_response=on_response)
+        throttled_response = Bunch(status_code=429, headers={})
+        ok_response = Bunch(status_code=200, headers={})
+        request_mocker.side_effect = [throttled_response, ok_response]
+
+        assert client.get('http://thingspeak.com/channels/123') is ok_response
+
+        assert rate_limiter.acquire.call_count == 2
+        assert on_response.call_args_list == [mock.call(throttled_response), mock.call(ok_response)]
@@ -0,0 +1,81 @@
+import mock
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from airqo_monitor.external.rate_limiter import TokenBucketRateLimiter
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class TestTokenBucketRateLimiter(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.clock = FakeClock()
+        patcher = mock.patch.multiple(
+            'airqo_monitor.external.rate_limiter.time',
+            time=self.clock.time,
+            sleep=self.clock.sleep,
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _check_rate(self, limiter):
+        # The burst goes straight through...
+        assert [limiter.acquire() for _ in range(3)] == [0, 0, 0]
+        # ...then requests are spaced out at the rate
+        assert limiter.acquire() == 0.5
+        assert limiter.acquire() == 0.5
+
+        # Idle time refills the bucket, but only up to the burst
+        self.clock.sleep(60)
+        assert [limiter.acquire() for _ in range(3)] == [0, 0, 0]
+        assert limiter.acquire() > 0
+
+    def test_in_process(self):
+        self._check_rate(TokenBucketRateLimiter(rate_per_second=2, burst=3))
+
+    def test_shared_through_cache(self):
+        # Windows are burst / rate = 1.5 seconds long, and this is the start of one
+        self.clock.now = 1500.0
+        first_limiter = TokenBucketRateLimiter(rate_per_second=2, burst=3, cache_key='rate-limit')
+        second_limiter = TokenBucketRateLimiter(rate_per_second=2, burst=3, cache_key='rate-limit')
+
+        # Another process's limiter counts against the same window
+        assert [first_limiter.acquire() for _ in range(2)] == [0, 0]
+        assert second_limiter.acquire() == 0
+        assert second_limiter.acquire() == 1.5
+        assert first_limiter.acquire() == 0
+
+        # Idle time doesn't build up more than a window's worth
+        self.clock.sleep(60)
+        assert [first_limiter.acquire() for _ in range(3)] == [0, 0, 0]
+        assert first_limiter.acquire() == 1.5
+
+    @mock.patch('airqo_monitor.external.rate_limiter.cache.incr')
+    def test_falls_back_to_the_process_bucket_when_the_cache_fails(self, incr_mocker):
+        incr_mocker.side_effect = ValueError('Cache is down')
+
+        self._check_rate(TokenBucketRateLimiter(rate_per_second=2, burst=3, cache_key='rate-limit'))
+
+    @mock.patch('airqo_monitor.external.rate_limiter.RATE_LIMIT_CACHE_WAIT_SECONDS', 1)
+    def test_falls_back_to_the_process_bucket_after_waiting(self):
+        self.clock.now = 1500.0
+        limiter = TokenBucketRateLimiter(rate_per_second=2, burst=3, cache_key='rate-limit')
+        # Other processes have used up this window
+        cache.set('rate-limit:1000', 3)
+
+        # Rather than waiting for the next window, it takes one of its own tokens
+        assert limiter.acquire() == 1.5
+        assert cache.get('rate-limit:1001') is None
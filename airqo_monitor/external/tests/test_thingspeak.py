@@ -1,18 +1,24 @@
 import mock
 
+from bunch import Bunch
 from datetime import datetime, timedelta
 from django.test import TestCase
 
 from airqo_monitor.constants import (
     THINGSPEAK_CHANNELS_LIST_URL,
+    THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS,
     THINGSPEAK_FEEDS_LIST_URL,
 )
 from airqo_monitor.external.thingspeak import (
+    flush_usage,
     get_all_channels,
     get_all_channels_by_type,
     get_api_key_for_channel,
     get_data_for_channel,
+    get_data_for_channels,
+    iter_data_for_channel,
 )
+from airqo_monitor.models import ThingspeakUsage
 
 
 class TestThingspeakAPI(TestCase):
@@ -84,6 +90,88 @@ class TestThingspeakAPI(TestCase):
             end_time_string
         ))
 
+    @mock.patch('airqo_monitor.external.thingspeak.make_post_call')
+    def test_get_data_for_channel_pages_backwards(self, make_post_call_mocker):
+        full_page = [
+            {'entry_id': i, 'created_at': '2017-03-27T22:53:55Z'}
+            for i in range(THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS, 2 * THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS)
+        ]
+        older_page = [{'entry_id': 1, 'created_at': '2017-03-26T22:53:55Z'}]
+        make_post_call_mocker.side_effect = [{'feeds': full_page}, {'feeds': older_page}]
+
+        start_time = datetime(2017, 3, 20)
+        end_time = datetime(2017, 3, 28)
+        pages = list(iter_data_for_channel(123, start_time=start_time, end_time=end_time))
+
+        assert pages == [full_page, older_page]
+        # The second request ends just before the oldest entry of the first page
+        assert make_post_call_mocker.call_args_list[1][0][0].endswith('&end=2017-03-27T22:53:54Z')
+
+        make_post_call_mocker.side_effect = [{'feeds': full_page}, {'feeds': older_page}]
+        result = get_data_for_channel(123, start_time=start_time, end_time=end_time)
+        assert result == older_page + full_page
+
+    @mock.patch('airqo_monitor.external.thingspeak.make_post_call')
+    def test_get_data_for_channel_single_field(self, make_post_call_mocker):
+        make_post_call_mocker.return_value = {'feeds': [
+            {'entry_id': 1, 'created_at': '2017-03-26T22:53:55Z', 'field2': '36.00'},
+        ]}
+
+        result = get_data_for_channel(123, start_time=datetime(2017, 3, 20), fields=['field2'])
+
+        assert result == [{'entry_id': 1, 'created_at': '2017-03-26T22:53:55Z', 'field2': '36.00'}]
+        assert make_post_call_mocker.call_args[0][0].startswith(
+            '{}/fields/2/?start=2017-03-20T00:00:00Z&end='.format(THINGSPEAK_FEEDS_LIST_URL.format('123')))
+
+    @mock.patch('airqo_monitor.external.thingspeak.make_post_call')
+    def test_get_data_for_channel_several_fields_are_trimmed(self, make_post_call_mocker):
+        make_post_call_mocker.return_value = self.sample_feeds_list_response
+
+        result = get_data_for_channel(123, fields=['field2', 'field7'])
+
+        assert '/feeds/?' in make_post_call_mocker.call_args[0][0]
+        assert result[0] == {'entry_id': 1, 'created_at': '2017-03-26T22:53:55Z', 'field2': '36.00', 'field7': '16'}
+
+    @mock.patch('airqo_monitor.external.thingspeak.make_post_call')
+    def test_get_data_for_channel_short_queries(self, make_post_call_mocker):
+        make_post_call_mocker.return_value = self.sample_feeds_list_response
+
+        result = get_data_for_channel(123, results=3)
+        assert len(result) == 3
+        make_post_call_mocker.assert_called_once_with('{}/feeds/?results=3'.format(THINGSPEAK_FEEDS_LIST_URL.format('123')))
+
+        # Even a full page isn't followed by more requests
+        make_post_call_mocker.reset_mock()
+        make_post_call_mocker.return_value = {'feeds': [
+            {'entry_id': i, 'created_at': '2017-03-27T22:53:55Z'} for i in range(THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS)
+        ]}
+        result = get_data_for_channel(123, fields=['field2'], results=10000)
+        assert len(result) == THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS
+        make_post_call_mocker.assert_called_once_with('{}/fields/2/?results={}'.format(
+            THINGSPEAK_FEEDS_LIST_URL.format('123'),
+            THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS,
+        ))
+
+    @mock.patch('airqo_monitor.external.thingspeak.make_post_call')
+    def test_iter_data_for_channel_stops_on_empty_result(self, make_post_call_mocker):
+        make_post_call_mocker.return_value = -1
+
+        assert list(iter_data_for_channel(123)) == []
+        assert make_post_call_mocker.call_count == 1
+
+    @mock.patch('airqo_monitor.external.thingspeak.get_data_for_channel')
+    def test_get_data_for_channels_skips_failed_channels(self, get_data_for_channel_mocker):
+        def fake_get_data_for_channel(channel, start_time=None, end_time=None):
+            if channel == 456:
+                raise ValueError('Thingspeak is down')
+            return [{'entry_id': channel}]
+        get_data_for_channel_mocker.side_effect = fake_get_data_for_channel
+
+        result = get_data_for_channels([123, 456, 789], max_workers=2)
+
+        assert result == {123: [{'entry_id': 123}], 789: [{'entry_id': 789}]}
+        assert get_data_for_channel_mocker.call_count == 3
+
     @mock.patch('airqo_monitor.external.thingspeak.make_get_call')
     @mock.patch('airqo_monitor.external.thingspeak.os.environ.get')
     def test_get_all_channels(self, env_var_mocker, make_get_call_mocker):
@@ -117,3 +205,20 @@ class TestThingspeakAPI(TestCase):
     def test_get_api_key_for_channel_doesnt_crash_if_no_key(self):
         api_key = get_api_key_for_channel(123)
         assert api_key is None
+
+    @mock.patch('airqo_monitor.external.thingspeak.client.rate_limiter', None)
+    @mock.patch('airqo_monitor.external.http_client.requests.Session.request')
+    def test_feed_requests_are_counted_for_their_channel(self, request_mocker):
+        request_mocker.return_value = Bunch(status_code=200, headers={'Content-Length': '2'}, content=b'-1')
+        # Start from nothing, whatever other tests have counted
+        flush_usage()
+        ThingspeakUsage.objects.all().delete()
+
+        list(iter_data_for_channel(123))
+        get_all_channels()
+        flush_usage()
+
+        assert sorted(ThingspeakUsage.objects.values_list('channel_id', 'num_requests', 'num_bytes')) == [
+            (ThingspeakUsage.NO_CHANNEL, 1, 2),
+            (123, 1, 2),
+        ]
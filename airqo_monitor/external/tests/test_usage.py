@@ -0,0 +1,86 @@
+import mock
+
+from bunch import Bunch
+from datetime import datetime
+from django.db import DatabaseError
+from django.test import TestCase
+from django.utils import timezone
+
+from airqo_monitor.external.usage import RequestUsage, get_usage_summary, prune_usage
+from airqo_monitor.models import ThingspeakUsage
+
+
+class TestRequestUsage(TestCase):
+
+    def setUp(self):
+        self.usage = RequestUsage()
+        self.hour_start = timezone.now().replace(minute=0, second=0, microsecond=0)
+
+    def _record(self, channel_id, num_bytes):
+        response = Bunch(headers={'Content-Length': str(num_bytes)}, content=b'')
+        if channel_id is None:
+            self.usage.record_response(response)
+        else:
+            with self.usage.for_channel(channel_id):
+                self.usage.record_response(response)
+
+    def test_requests_are_counted_per_channel_and_hour(self):
+        self._record(123, 100)
+        self._record(123, 50)
+        self._record(456, 10)
+        self._record(None, 5)
+        self.usage.flush()
+
+        usages = {
+            usage.channel_id: (usage.num_requests, usage.num_bytes)
+            for usage in ThingspeakUsage.objects.filter(hour_start=self.hour_start)
+        }
+        assert usages == {123: (2, 150), 456: (1, 10), ThingspeakUsage.NO_CHANNEL: (1, 5)}
+
+        # Later flushes add to the rows that are there
+        self._record(123, 25)
+        self.usage.flush()
+        usage = ThingspeakUsage.objects.get(hour_start=self.hour_start, channel_id=123)
+        assert (usage.num_requests, usage.num_bytes) == (3, 175)
+
+        summary = get_usage_summary(hours=1)
+        assert summary['hours'] == [{
+            'hour_start': self.hour_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'num_requests': 5,
+            'num_bytes': 190,
+        }]
+        assert summary['channels'][0] == {'channel_id': 123, 'num_requests': 3, 'num_bytes': 175}
+
+    def test_body_size_is_used_without_content_length(self):
+        self.usage.record_response(Bunch(headers={}, content=b'[1, 2]'))
+        self.usage.flush()
+        assert ThingspeakUsage.objects.get().num_bytes == 6
+
+    def test_flush_if_due(self):
+        self._record(123, 100)
+        self.usage.flush_if_due()
+        assert not ThingspeakUsage.objects.exists()
+
+        with mock.patch('airqo_monitor.external.usage.time.time', return_value=self.usage._flushed_at + 60):
+            self.usage.flush_if_due()
+        assert ThingspeakUsage.objects.exists()
+
+    @mock.patch('airqo_monitor.external.usage._add_usage')
+    def test_counts_are_kept_if_they_cant_be_saved(self, _add_usage_mocker):
+        self._record(123, 100)
+        _add_usage_mocker.side_effect = DatabaseError('database is locked')
+        self.usage.flush()
+
+        self._record(123, 50)
+        _add_usage_mocker.side_effect = None
+        self.usage.flush()
+
+        assert _add_usage_mocker.call_args[0][0] == {(self.hour_start, 123): [2, 150]}
+
+    def test_prune_usage(self):
+        ThingspeakUsage.objects.create(hour_start=timezone.make_aware(datetime(2018, 11, 1)), channel_id=123)
+        ThingspeakUsage.objects.create(hour_start=self.hour_start, channel_id=123)
+
+        prune_usage()
+
+        assert list(ThingspeakUsage.objects.values_list('hour_start', flat=True)) == [self.hour_start]
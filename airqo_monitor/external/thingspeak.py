@@ -1,21 +1,50 @@
-import json, requests
+import json
 import os
 
 from collections import defaultdict
 from datetime import datetime, timedelta
-from werkzeug.contrib.cache import SimpleCache
+from django.conf import settings
 
 from airqo_monitor.constants import (
     AIR_QUALITY_MONITOR_KEYWORD,
     API_KEY_CONFIG_VAR_NAME,
     DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS,
     INACTIVE_MONITOR_KEYWORD,
+    THINGSPEAK_CHANNELS_CACHE_KEY,
+    THINGSPEAK_CHANNELS_CACHE_TIMEOUT_SECONDS,
     THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS,
     THINGSPEAK_CHANNELS_LIST_URL,
     THINGSPEAK_FEEDS_LIST_URL,
+    THINGSPEAK_MAX_CONCURRENT_REQUESTS,
+    THINGSPEAK_RATE_LIMIT_BURST,
+    THINGSPEAK_RATE_LIMIT_CACHE_KEY,
+    THINGSPEAK_RATE_LIMIT_PER_SECOND,
 )
+from airqo_monitor.caching import get_or_set_with_lock
+from airqo_monitor.external.http_client import HttpClient
+from airqo_monitor.external.rate_limiter import TokenBucketRateLimiter
+from airqo_monitor.external.usage import RequestUsage
+from airqo_monitor.utils import map_concurrently
+
+usage = RequestUsage()
+client = HttpClient(
+    rate_limiter=TokenBucketRateLimiter(
+        THINGSPEAK_RATE_LIMIT_PER_SECOND,
+        THINGSPEAK_RATE_LIMIT_BURST,
+        cache_key=THINGSPEAK_RATE_LIMIT_CACHE_KEY,
+    ),
+    on_response=usage.record_response,
+)
+
+
+def get_feeds_list_url():
+    """The feeds URL template, which settings can point at a stand-in server."""
+    return settings.THINGSPEAK_FEEDS_LIST_URL or THINGSPEAK_FEEDS_LIST_URL
 
-cache = SimpleCache()
+
+def get_channels_list_url():
+    """The channels list URL, which settings can point at a stand-in server."""
+    return settings.THINGSPEAK_CHANNELS_LIST_URL or THINGSPEAK_CHANNELS_LIST_URL
 
 
 def get_api_key_for_channel(channel_id):
@@ -30,44 +59,82 @@ def get_api_key_for_channel(channel_id):
     return api_key
 
 
-def get_data_for_channel(channel, start_time=None, end_time=None):
+def _get_feeds_path(fields):
     """
-    Get all channel data for a single channel between start_time and end_time. By default,
-    the window goes back 1 week.
+    Thingspeak has an endpoint for a single field's feed, which leaves the other fields out of
+    the response. There isn't one for several fields, so those are fetched in full.
+    """
+    if fields and len(fields) == 1:
+        return 'fields/{}'.format(fields[0].replace('field', ''))
+    return 'feeds'
+
+
+def _project_feeds(feeds, fields):
+    """Keep only the given fields (and the entry id and time) of each feed entry."""
+    if fields is None:
+        return feeds
+    keys = ['entry_id', 'created_at'] + list(fields)
+    return [{key: feed.get(key) for key in keys} for feed in feeds]
+
+
+def iter_data_for_channel(channel, start_time=None, end_time=None, fields=None, results=None):
+    """
+    Stream all channel data for a single channel between start_time and end_time, one API page
+    at a time. By default, the window goes back 1 week.
 
     This API returns a maximum of 8000 results, so we keep requesting data until we have fewer
-    that 8000 results returned, or until we get a -1 response from the API (which means that there are no more results)
+    that 8000 results returned, or until we get a -1 response from the API (which means that there are no more results).
+    Each request ends just before the oldest entry of the previous page, so pages come newest first.
 
-    Returns: A list of data point dicts, from oldest to newest
+    fields (Thingspeak field names, e.g. ['field2']) limits the entries to those fields. A single
+    field is requested from the API on its own, so the others are never transferred.
+
+    If results is given, only the channel's newest `results` entries are fetched instead of the
+    window, in one request (so at most 8000 entries).
+
+    Yields: Non-empty lists of data point dicts, each ordered from oldest to newest
     """
+    api_url = '{}/{}/'.format(get_feeds_list_url().format(channel), _get_feeds_path(fields))
+    api_key = get_api_key_for_channel(channel)
+    key_param = '&api_key={}'.format(api_key) if api_key else ''
+
+    if results:
+        full_url = '{}?results={}{}'.format(
+            api_url,
+            min(results, THINGSPEAK_FEEDS_LIST_MAX_NUM_RESULTS),
+            key_param,
+        )
+        with usage.for_channel(int(channel)):
+            result = make_post_call(full_url)
+        if result != -1 and result['feeds']:
+            yield _project_feeds(result['feeds'], fields)
+        return
+
     if not start_time:
         start_time = datetime.now() - timedelta(days=DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS)
     if not end_time:
         end_time = datetime.now()
 
-    # convert to string before the loop because this never changes
+    # convert to string before the loop because these never change
     start_time_string = datetime.strftime(start_time,'%Y-%m-%dT%H:%M:%SZ')
 
-    api_url = THINGSPEAK_FEEDS_LIST_URL.format(channel)
-    all_data = []
-
     while start_time <= end_time:
-        full_url = '{}/feeds/?start={}&end={}'.format(
+        full_url = '{}?start={}&end={}{}'.format(
             api_url,
             start_time_string,
             datetime.strftime(end_time,'%Y-%m-%dT%H:%M:%SZ'),
+            key_param,
         )
-        api_key = get_api_key_for_channel(channel)
-        if api_key:
-            full_url += '&api_key={}'.format(api_key)
-        result = make_post_call(full_url)
+        with usage.for_channel(int(channel)):
+            result = make_post_call(full_url)
 
         # This means we got an empty result set and are done
         if result == -1:
             break
 
         feeds = result['feeds']
-        all_data = feeds + all_data
+        if feeds:
+            yield _project_feeds(feeds, fields)
 
         # If we aren't hitting the max number of results then we
         # have all of them for the time range and can stop iterating
@@ -77,7 +144,41 @@ def get_data_for_channel(channel, start_time=None, end_time=None):
         first_result = feeds[0]
         end_time = datetime.strptime(first_result['created_at'],'%Y-%m-%dT%H:%M:%SZ') - timedelta(seconds=1)
 
-    return all_data
+
+def get_data_for_channel(channel, start_time=None, end_time=None, fields=None, results=None):
+    """
+    Get all channel data for a single channel between start_time and end_time. By default,
+    the window goes back 1 week. fields and results work as for iter_data_for_channel.
+
+    Pages are collected as they arrive and stitched together once at the end, so long windows
+    cost linear rather than quadratic time.
+
+    Returns: A list of data point dicts, from oldest to newest
+    """
+    pages = list(iter_data_for_channel(
+        channel,
+        start_time=start_time,
+        end_time=end_time,
+        fields=fields,
+        results=results,
+    ))
+    return [entry for page in reversed(pages) for entry in page]
+
+
+def get_data_for_channels(channels, start_time=None, end_time=None, max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS):
+    """
+    Get data for several channels between start_time and end_time, fetching up to max_workers
+    channels at the same time. A channel whose fetch fails is logged and left out of the result
+    instead of failing the whole batch.
+
+    Returns: dict {channel: list of data point dicts, from oldest to newest}
+    """
+    results = map_concurrently(
+        lambda channel: get_data_for_channel(channel, start_time=start_time, end_time=end_time),
+        channels,
+        max_workers=max_workers,
+    )
+    return dict(results)
 
 
 def get_all_channels():
@@ -87,22 +188,23 @@ def get_all_channels():
     Returns: List of channel data dicts
     """
     api_key = os.environ.get('THINGSPEAK_USER_API_KEY')
-    full_url = '{}/?api_key={}'.format(THINGSPEAK_CHANNELS_LIST_URL, api_key)
+    full_url = '{}/?api_key={}'.format(get_channels_list_url(), api_key)
     channels = make_get_call(full_url)
     return channels
 
 
 def get_all_channels_cached():
     """
-    Wrapper around get_all_channels to allow caching. This data shouldn't change often.
+    Wrapper around get_all_channels to allow caching. This data shouldn't change often, and is
+    shared by every process using the same cache backend.
 
     Returns: List of channel data dicts
     """
-    cached_value = cache.get('get-all-channels')
-    if cached_value is None:
-        cached_value = get_all_channels()
-        cache.set('get-all-channels', cached_value, timeout=30 * 60)
-    return cached_value
+    return get_or_set_with_lock(
+        THINGSPEAK_CHANNELS_CACHE_KEY,
+        get_all_channels,
+        timeout=THINGSPEAK_CHANNELS_CACHE_TIMEOUT_SECONDS,
+    )
 
 
 def get_all_channels_by_type(channel_type):
@@ -113,7 +215,7 @@ def get_all_channels_by_type(channel_type):
     Returns: List of channel data dicts
     """
     api_key = os.environ.get('THINGSPEAK_USER_API_KEY')
-    full_url = '{}/?api_key={}&tag={}'.format(THINGSPEAK_CHANNELS_LIST_URL, api_key, channel_type)
+    full_url = '{}/?api_key={}&tag={}'.format(get_channels_list_url(), api_key, channel_type)
     channels = make_get_call(full_url)
 
     # For some reason the API returns a list on success and a dict when there's an error
@@ -124,19 +226,28 @@ def get_all_channels_by_type(channel_type):
     return channels
 
 
+def flush_usage():
+    """Save the counts of the requests this process has made to Thingspeak (see RequestUsage)"""
+    usage.flush()
+
+
 def make_post_call(url):
     """
-    Make a post call to any URL and parse the json
+    Make a post call to any URL (over the shared, pooled client) and parse the json
 
     Returns: Parsed json response (can be dict or list depending on the expected API response)
     """
-    return json.loads(requests.post(url).content)
+    response = client.post(url)
+    usage.flush_if_due()
+    return json.loads(response.content)
 
 
 def make_get_call(url):
     """
-    Make a get call to any URL and parse the json
+    Make a get call to any URL (over the shared, pooled client) and parse the json
 
     Returns: Parsed json response (can be dict or list depending on the expected API response)
     """
-    return json.loads(requests.get(url).content)
+    response = client.get(url)
+    usage.flush_if_due()
+    return json.loads(response.content)
@@ -0,0 +1,167 @@
+import threading
+import time
+import traceback
+
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from airqo_monitor.constants import (
+    THINGSPEAK_USAGE_FLUSH_INTERVAL_SECONDS,
+    THINGSPEAK_USAGE_RETENTION_DAYS,
+)
+from airqo_monitor.models import ThingspeakUsage
+
+
+class RequestUsage(object):
+    """
+    Counts the requests made to Thingspeak, and the bytes they returned, per channel and per
+    hour. Counts are kept in memory and added to the ThingspeakUsage table by flush(), so every
+    process's requests can be inspected together.
+
+    Requests are attributed to the channel set with for_channel() in the thread making them.
+    """
+
+    def __init__(self, flush_interval_seconds=THINGSPEAK_USAGE_FLUSH_INTERVAL_SECONDS):
+        self.flush_interval_seconds = flush_interval_seconds
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._counts = defaultdict(lambda: [0, 0])
+        self._flushed_at = time.time()
+
+    @contextmanager
+    def for_channel(self, channel_id):
+        previous_channel_id = getattr(self._local, 'channel_id', None)
+        self._local.channel_id = channel_id
+        try:
+            yield
+        finally:
+            self._local.channel_id = previous_channel_id
+
+    def record_response(self, response):
+        """
+        Count a response for the current thread's channel. The size is what came over the wire
+        (Content-Length, so compressed if the response was), falling back to the decoded body.
+        """
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit():
+            num_bytes = int(content_length)
+        else:
+            num_bytes = len(response.content)
+
+        hour_start = timezone.now().replace(minute=0, second=0, microsecond=0)
+        key = (hour_start, getattr(self._local, 'channel_id', None) or ThingspeakUsage.NO_CHANNEL)
+        with self._lock:
+            counts = self._counts[key]
+            counts[0] += 1
+            counts[1] += num_bytes
+
+    def flush_if_due(self):
+        if time.time() - self._flushed_at >= self.flush_interval_seconds:
+            self.flush()
+
+    def flush(self):
+        """
+        Add the counts since the last flush to the ThingspeakUsage table. This is called after
+        Thingspeak requests, so if the database can't be written to, the error is logged and the
+        counts are kept for the next flush rather than failing the request.
+        """
+        with self._lock:
+            counts = self._counts
+            self._counts = defaultdict(lambda: [0, 0])
+            self._flushed_at = time.time()
+        if not counts:
+            return
+
+        try:
+            try:
+                _add_usage(counts)
+            except IntegrityError:
+                # Another process created one of the same rows at the same time; the rows exist now
+                _add_usage(counts)
+        except DatabaseError:
+            print('[RequestUsage.flush] Failed to save usage, will retry: {}'.format(traceback.format_exc()))
+            with self._lock:
+                for key, (num_requests, num_bytes) in counts.items():
+                    self._counts[key][0] += num_requests
+                    self._counts[key][1] += num_bytes
+
+
+def _add_usage(counts):
+    """
+    counts: dict {(hour_start, channel_id): [num_requests, num_bytes]}
+    """
+    with transaction.atomic():
+        existing_ids = {
+            (hour_start, channel_id): usage_id
+            for usage_id, hour_start, channel_id in ThingspeakUsage.objects.filter(
+                hour_start__in=set(hour_start for hour_start, _ in counts),
+                channel_id__in=set(channel_id for _, channel_id in counts),
+            ).values_list('id', 'hour_start', 'channel_id')
+        }
+
+        new_usages = []
+        for (hour_start, channel_id), (num_requests, num_bytes) in counts.items():
+            usage_id = existing_ids.get((hour_start, channel_id))
+            if usage_id is None:
+                new_usages.append(ThingspeakUsage(
+                    hour_start=hour_start,
+                    channel_id=channel_id,
+                    num_requests=num_requests,
+                    num_bytes=num_bytes,
+                ))
+            else:
+                ThingspeakUsage.objects.filter(id=usage_id).update(
+                    num_requests=F('num_requests') + num_requests,
+                    num_bytes=F('num_bytes') + num_bytes,
+                )
+
+        ThingspeakUsage.objects.bulk_create(new_usages)
+
+
+def get_usage_summary(hours=24):
+    """
+    Totals of the Thingspeak requests made over the last `hours` hours (including this one), as
+    flushed so far.
+
+    Returns: dict of the form
+        {'hours': [{'hour_start': '2018-11-01T10:00:00Z', 'num_requests': 120, 'num_bytes': 52000}, ...],
+         'channels': [{'channel_id': 123, 'num_requests': 24, 'num_bytes': 10400}, ...]}
+        with the hours oldest first and the channels busiest first. Requests that weren't for a
+        channel's feeds (like listing the channels) have channel_id 0.
+    """
+    start = timezone.now().replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours - 1)
+    usages = ThingspeakUsage.objects.filter(hour_start__gte=start)
+
+    by_hour = defaultdict(lambda: [0, 0])
+    by_channel = defaultdict(lambda: [0, 0])
+    for hour_start, channel_id, num_requests, num_bytes in usages.values_list(
+            'hour_start', 'channel_id', 'num_requests', 'num_bytes'):
+        for totals in (by_hour[hour_start], by_channel[channel_id]):
+            totals[0] += num_requests
+            totals[1] += num_bytes
+
+    return {
+        'hours': [
+            {
+                'hour_start': hour_start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'num_requests': num_requests,
+                'num_bytes': num_bytes,
+            }
+            for hour_start, (num_requests, num_bytes) in sorted(by_hour.items())
+        ],
+        'channels': [
+            {'channel_id': channel_id, 'num_requests': num_requests, 'num_bytes': num_bytes}
+            for channel_id, (num_requests, num_bytes) in sorted(
+                by_channel.items(), key=lambda item: item[1][0], reverse=True)
+        ],
+    }
+
+
+def prune_usage(retention_days=THINGSPEAK_USAGE_RETENTION_DAYS):
+    cutoff = timezone.now() - timedelta(days=retention_days)
+    ThingspeakUsage.objects.filter(hour_start__lt=cutoff).delete()
@@ -0,0 +1,252 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from django.db import transaction
+from django.utils import timezone
+
+from airqo_monitor.constants import (
+    DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS,
+    FEED_STORE_BULK_CREATE_BATCH_SIZE,
+    FEED_STORE_RETENTION_DAYS,
+    THINGSPEAK_DATETIME_FORMAT,
+    THINGSPEAK_FIELD_NAMES,
+    THINGSPEAK_MAX_CONCURRENT_REQUESTS,
+)
+from airqo_monitor.external.thingspeak import iter_data_for_channel
+from airqo_monitor.models import Channel, FeedEntry
+from airqo_monitor.rollups import update_rollups_for_entries
+from airqo_monitor.utils import map_concurrently, to_utc
+
+
+def _to_naive_utc(value):
+    """The Thingspeak client works with naive UTC datetimes."""
+    return to_utc(value).replace(tzinfo=None)
+
+
+def _parse_thingspeak_datetime(value):
+    return pytz.utc.localize(datetime.strptime(value, THINGSPEAK_DATETIME_FORMAT))
+
+
+def _lock_channel(channel):
+    """
+    Lock the channel's row until the end of the current transaction, so overlapping syncs of the
+    same channel (say the heatmap API and a sweep) take turns writing its entries, rollups and
+    high-water marks instead of racing on the unique constraints.
+
+    Returns: the locked row as a fresh Channel
+    """
+    return Channel.objects.select_for_update().get(id=channel.id)
+
+
+def _save_feed_entries(channel, feeds):
+    """
+    Store any Thingspeak feed entries for the channel that aren't stored yet.
+
+    Returns: list of the FeedEntry objects that were created
+    """
+    if not feeds:
+        return []
+
+    entry_ids = [feed['entry_id'] for feed in feeds]
+
+    # Entries and their rollups are written together, because entries that are already stored
+    # are never added to the rollups again. The stored ids are only read once the channel is
+    # locked, so another sync can't store the same entries in between.
+    with transaction.atomic():
+        _lock_channel(channel)
+        existing_entry_ids = set(
+            FeedEntry.objects.filter(
+                channel=channel,
+                entry_id__gte=min(entry_ids),
+                entry_id__lte=max(entry_ids),
+            ).values_list('entry_id', flat=True)
+        )
+
+        new_entries = []
+        for feed in feeds:
+            if feed['entry_id'] in existing_entry_ids:
+                continue
+            existing_entry_ids.add(feed['entry_id'])
+
+            entry = FeedEntry(
+                channel=channel,
+                entry_id=feed['entry_id'],
+                created_at=_parse_thingspeak_datetime(feed['created_at']),
+            )
+            for field_name in THINGSPEAK_FIELD_NAMES:
+                setattr(entry, field_name, feed.get(field_name))
+            new_entries.append(entry)
+
+        FeedEntry.objects.bulk_create(new_entries, batch_size=FEED_STORE_BULK_CREATE_BATCH_SIZE)
+        update_rollups_for_entries(channel, new_entries)
+
+    return new_entries
+
+
+def _update_high_water_marks(channel, newest_entry, synced_from):
+    """
+    Move the channel's high-water marks forward (never back), comparing against the stored row
+    rather than the possibly stale channel object, in case another sync has moved them since.
+    """
+    with transaction.atomic():
+        locked_channel = _lock_channel(channel)
+        update_fields = []
+
+        if locked_channel.feed_synced_from is None or synced_from < locked_channel.feed_synced_from:
+            locked_channel.feed_synced_from = synced_from
+            update_fields.append('feed_synced_from')
+
+        if newest_entry and (locked_channel.feed_last_entry_id is None
+                             or newest_entry.entry_id > locked_channel.feed_last_entry_id):
+            locked_channel.feed_last_entry_id = newest_entry.entry_id
+            locked_channel.feed_last_entry_at = newest_entry.created_at
+            update_fields += ['feed_last_entry_id', 'feed_last_entry_at']
+
+        if update_fields:
+            locked_channel.save(update_fields=update_fields)
+
+    channel.feed_synced_from = locked_channel.feed_synced_from
+    channel.feed_last_entry_id = locked_channel.feed_last_entry_id
+    channel.feed_last_entry_at = locked_channel.feed_last_entry_at
+
+
+def sync_feed_entries_for_channel(channel, start_time=None, end_time=None, num_recent_entries=None):
+    """
+    Make sure the local store holds every Thingspeak entry for the channel between start_time
+    and end_time (by default, the last week up to now). Only the parts of the window that haven't
+    been synced before are requested from Thingspeak: older entries when start_time is earlier
+    than anything we have, and entries after the newest stored one.
+
+    Callers that only need the newest num_recent_entries entries of the window (like malfunction
+    detection) can say so. Then older entries aren't backfilled, and a channel that's never been
+    synced only gets that many of its newest entries, in one request, rather than the whole window.
+
+    Returns: number of new entries stored
+    """
+    now = timezone.now()
+    start_time = to_utc(start_time) if start_time else now - timedelta(days=DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS)
+    end_time = min(to_utc(end_time), now) if end_time else now
+
+    # Keyword arguments for each iter_data_for_channel call needed
+    fetches = []
+    synced_from = start_time
+    newest_only = channel.feed_synced_from is None and bool(num_recent_entries)
+    if newest_only:
+        fetches.append(dict(results=num_recent_entries))
+    elif channel.feed_synced_from is None:
+        fetches.append(dict(start_time=_to_naive_utc(start_time), end_time=_to_naive_utc(now)))
+    else:
+        # Backfill anything older than what the store already covers
+        if start_time < channel.feed_synced_from and num_recent_entries:
+            synced_from = channel.feed_synced_from
+        elif start_time < channel.feed_synced_from:
+            fetches.append(dict(
+                start_time=_to_naive_utc(start_time),
+                end_time=_to_naive_utc(channel.feed_synced_from),
+            ))
+
+        # Then only ask for entries newer than the high-water mark, if the window needs them
+        synced_until = channel.feed_last_entry_at or channel.feed_synced_from
+        if end_time > synced_until:
+            fetches.append(dict(start_time=_to_naive_utc(synced_until), end_time=_to_naive_utc(now)))
+
+    # Pages are stored as they arrive so a long backfill never sits in memory all at once. The
+    # high-water marks only move once every page is in, so an interrupted sync is simply redone
+    # next time (already stored entries are skipped).
+    num_new_entries = 0
+    newest_entry = None
+    oldest_fetched_at = None
+    for fetch in fetches:
+        for page in iter_data_for_channel(channel.channel_id, **fetch):
+            page_oldest_at = _parse_thingspeak_datetime(page[0]['created_at'])
+            if oldest_fetched_at is None or page_oldest_at < oldest_fetched_at:
+                oldest_fetched_at = page_oldest_at
+
+            new_entries = _save_feed_entries(channel, page)
+            num_new_entries += len(new_entries)
+            for entry in new_entries:
+                if newest_entry is None or entry.entry_id > newest_entry.entry_id:
+                    newest_entry = entry
+
+    if newest_only and oldest_fetched_at is not None:
+        # Only the newest entries were fetched, so the store covers the channel from the oldest of them
+        synced_from = oldest_fetched_at
+
+    _update_high_water_marks(channel, newest_entry, synced_from)
+
+    return num_new_entries
+
+
+def sync_feed_entries_for_channels(channels, start_time=None, end_time=None,
+                                   max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS):
+    """
+    Sync several channels (see sync_feed_entries_for_channel), up to max_workers at the same
+    time. A channel whose sync fails is logged and skipped. Each Channel object's high-water
+    marks are updated in place.
+
+    Returns: dict {channel: number of new entries stored}
+    """
+    return dict(map_concurrently(
+        lambda channel: sync_feed_entries_for_channel(channel, start_time=start_time, end_time=end_time),
+        channels,
+        max_workers=max_workers,
+    ))
+
+
+def get_stored_data_for_channel(channel, start_time=None, end_time=None, after_entry_id=None, fields=None,
+                                sync=True, num_recent_entries=None):
+    """
+    Sync the channel's feed entries from Thingspeak (unless sync is False, for callers that have
+    just done so), then read the window between start_time and end_time (by default, the last
+    week) from the local store. If after_entry_id is given, only entries newer than it are read.
+    If fields is given (Thingspeak field names, e.g. ['field2']), only those fields are read.
+    num_recent_entries is passed on to sync_feed_entries_for_channel.
+
+    The sync always fetches every field, since the store also serves the heatmap and rollups.
+
+    Returns: A list of data point dicts in Thingspeak's feed format, from oldest to newest
+    """
+    if sync:
+        sync_feed_entries_for_channel(
+            channel,
+            start_time=start_time,
+            end_time=end_time,
+            num_recent_entries=num_recent_entries,
+        )
+
+    now = timezone.now()
+    start_time = to_utc(start_time) if start_time else now - timedelta(days=DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS)
+    end_time = to_utc(end_time) if end_time else now
+
+    columns = ['entry_id', 'created_at'] + [
+        field for field in THINGSPEAK_FIELD_NAMES if fields is None or field in fields
+    ]
+    rows = FeedEntry.objects.filter(
+        channel=channel,
+        created_at__gte=start_time,
+        created_at__lte=end_time,
+    )
+    if after_entry_id is not None:
+        rows = rows.filter(entry_id__gt=after_entry_id)
+    rows = rows.order_by('entry_id').values_list(*columns)
+
+    data = []
+    for row in rows:
+        entry = dict(zip(columns, row))
+        entry['created_at'] = datetime.strftime(to_utc(entry['created_at']), THINGSPEAK_DATETIME_FORMAT)
+        data.append(entry)
+
+    return data
+
+
+def prune_feed_entries(retention_days=FEED_STORE_RETENTION_DAYS):
+    """
+    Delete stored entries older than retention_days and move each channel's feed_synced_from
+    forward so that the pruned range gets fetched from Thingspeak again if it's ever requested.
+    """
+    cutoff = timezone.now() - timedelta(days=retention_days)
+
+    with transaction.atomic():
+        FeedEntry.objects.filter(created_at__lt=cutoff).delete()
+        Channel.objects.filter(feed_synced_from__lt=cutoff).update(feed_synced_from=cutoff)
@@ -1,14 +1,28 @@
+import numpy as np
+
+from collections import defaultdict
+from datetime import datetime
+from django.core.cache import cache
+from django.db import transaction
+
 from airqo_monitor.external.thingspeak import (
     get_all_channels_by_type,
-    get_all_channels_cached,
-    get_data_for_channel,
 )
+from airqo_monitor.caching import invalidate_dashboard_cache
 from airqo_monitor.constants import (
+    CHANNEL_METADATA_SYNC_CACHE_KEY,
+    CHANNEL_METADATA_SYNC_INTERVAL_SECONDS,
     INACTIVE_MONITOR_KEYWORD,
     AIRQO_CHANNEL_TYPE,
+    HEATMAP_GRID_CELL_DEGREES,
+    THINGSPEAK_DATETIME_FORMAT,
+    THINGSPEAK_MAX_CONCURRENT_REQUESTS,
 )
+from airqo_monitor.feed_store import get_stored_data_for_channel
 from airqo_monitor.models import Channel, ChannelType
+from airqo_monitor.objects.channel_data import ChannelData
 from airqo_monitor.objects.data_entry import DataEntry
+from airqo_monitor.utils import iter_concurrently
 
 
 def parse_field8_metadata(field8):
@@ -18,18 +32,53 @@ def parse_field8_metadata(field8):
     return field8.split(',')
 
 
-def get_and_format_data_for_channel(channel, start_time=None, end_time=None):
+def select_data_format(data_format, field_names):
+    """
+    The part of a channel type's data format holding the given descriptive field names
+    (e.g. ['pm_2_5'] gives {"field2": "pm_2_5"}). Names the format doesn't have are ignored.
+    """
+    return {
+        thingspeak_fieldname: descriptive_name
+        for thingspeak_fieldname, descriptive_name in data_format.items()
+        if descriptive_name in field_names
+    }
+
+
+def get_and_format_data_for_channel(channel, start_time=None, end_time=None, columnar=False, after_entry_id=None,
+                                    field_names=None, sync=True, num_recent_entries=None):
     """
-    Gets data from Thingspeak and formats the response into understandable names
-    based on the channel type's data format.
+    Syncs the channel's data from Thingspeak into the local feed store, reads the window
+    from the store and formats it into understandable names based on the channel type's data format.
+    If after_entry_id is given, only entries newer than it are returned. If field_names is given
+    (e.g. ['pm_2_5', 'battery_voltage']), only those fields are read and returned. Pass sync=False
+    if the channel has just been synced, or num_recent_entries if only that many of the newest
+    entries are needed (see sync_feed_entries_for_channel).
 
-    Returns: List of dicts, where each dict is one data entry point
+    If columnar is True, the data is returned as a ChannelData (one NumPy array per field) instead,
+    which is much smaller and lets callers work on whole columns at once.
+
+    Returns: List of dicts, where each dict is one data entry point (or a ChannelData if columnar)
     """
     channel_id = channel.channel_id
     channel_type_name = channel.channel_type.name
     data_format = channel.channel_type.data_format
+    fields = None
+    if field_names is not None:
+        data_format = select_data_format(data_format, field_names)
+        fields = list(data_format)
+
+    data = get_stored_data_for_channel(
+        channel,
+        start_time=start_time,
+        end_time=end_time,
+        after_entry_id=after_entry_id,
+        fields=fields,
+        sync=sync,
+        num_recent_entries=num_recent_entries,
+    )
+    if columnar:
+        return ChannelData.from_feeds(data, data_format, channel_id=channel_id, channel_type_name=channel_type_name)
 
-    data = get_data_for_channel(channel_id, start_time=start_time, end_time=end_time)
     formatted_data = []
 
     for entry in data:
@@ -45,128 +94,373 @@ def get_and_format_data_for_channel(channel, start_time=None, end_time=None):
     return formatted_data
 
 
-def _update_db_channel_table(channel, channel_type, new_channel_data):
+def _get_channel_changes(channel, channel_type, new_channel_data):
     """
-    Given metadata about a Thingspeak channel, update the corresponding
-    Channel objects in the database
+    Given metadata about a Thingspeak channel, work out which fields of the corresponding
+    Channel object need to change
+
+    Returns: dict {field_name: new value}
     """
     channel_name = new_channel_data['name']
-    update_fields = []
+    changes = dict()
 
     # Update that channel with its latest data
     if channel.name != channel_name:
-        channel.name = channel_name
-        update_fields.append('name')
+        changes['name'] = channel_name
 
-    if not channel.channel_type or channel.channel_type is not channel_type:
-        channel.channel_type = channel_type
-        update_fields.append('channel_type')
+    if channel.channel_type_id != channel_type.id:
+        changes['channel_type'] = channel_type
 
     # reactivate channel if Thingspeak thinks it's active
     if not channel.is_active and INACTIVE_MONITOR_KEYWORD not in channel_name:
-        channel.is_active = True
-        update_fields.append('is_active')
+        changes['is_active'] = True
 
     # Deactivate channel if it's no longer active on Thingspeak
     if channel.is_active and INACTIVE_MONITOR_KEYWORD in channel_name:
-        channel.is_active = False
-        update_fields.append('is_active')
+        changes['is_active'] = False
 
-    if update_fields:
-        channel.save(update_fields=update_fields)
+    return changes
 
 
 def update_all_channels_for_channel_type(channel_type):
     """
     Given a channel type, get all channels for this channel type from Thingspeak
-    and update them in the DB based on Thingspeak's latest data
+    and update them in the DB based on Thingspeak's latest data.
+
+    The existing channels are read in one query and the differences are written in bulk: new
+    channels with one bulk_create, and changed ones with one update per distinct set of changes
+    (Django 2.0 has no bulk_update).
     """
     all_channel_data = get_all_channels_by_type(channel_type.name)
+    if not isinstance(all_channel_data, list):
+        # The API returns an error dict instead of a list when something went wrong
+        return
+
+    existing_channels = Channel.objects.in_bulk(
+        [channel_data['id'] for channel_data in all_channel_data],
+        field_name='channel_id',
+    )
+
+    new_channels = []
+    channel_ids_by_changes = defaultdict(list)
     for channel_data in all_channel_data:
-        channel, _ = Channel.objects.get_or_create(channel_id=channel_data['id'], channel_type=channel_type)
-        _update_db_channel_table(channel, channel_type, channel_data)
+        channel = existing_channels.get(channel_data['id'])
+        if channel is None:
+            new_channels.append(Channel(
+                channel_id=channel_data['id'],
+                name=channel_data['name'],
+                channel_type=channel_type,
+                is_active=INACTIVE_MONITOR_KEYWORD not in channel_data['name'],
+            ))
+            continue
+
+        changes = _get_channel_changes(channel, channel_type, channel_data)
+        if changes:
+            channel_ids_by_changes[tuple(sorted(changes.items()))].append(channel.id)
+
+    if not new_channels and not channel_ids_by_changes:
+        return
+
+    with transaction.atomic():
+        Channel.objects.bulk_create(new_channels)
+        for changes, channel_ids in channel_ids_by_changes.items():
+            Channel.objects.filter(id__in=channel_ids).update(**dict(changes))
 
+    # Bulk writes don't send the signals the dashboard cache listens for
+    invalidate_dashboard_cache()
+
+
+def update_all_channel_data(force=False):
+    """
+    Get all channel data from Thingspeak and update in the DB.
 
-def update_all_channel_data():
+    Channels don't change often, so this only runs once every CHANNEL_METADATA_SYNC_INTERVAL_SECONDS
+    (per cache) unless force is True.
     """
-    Get all channel data from Thingspeak and update in the DB
+    if not force and not cache.add(CHANNEL_METADATA_SYNC_CACHE_KEY, True, CHANNEL_METADATA_SYNC_INTERVAL_SECONDS):
+        return
+
+    try:
+        channel_types = ChannelType.objects.all()
+        for channel_type in channel_types:
+            update_all_channels_for_channel_type(channel_type)
+    except Exception:
+        # Let the next call try again rather than waiting out the interval
+        cache.delete(CHANNEL_METADATA_SYNC_CACHE_KEY)
+        raise
+
+
+def _get_and_format_data_for_channel_objects(channels, start_time=None, end_time=None, columnar=False,
+                                             max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS, after_entry_ids=None,
+                                             progress=None, field_names=None, num_recent_entries=None):
     """
-    channel_types = ChannelType.objects.all()
-    for channel_type in channel_types:
-        update_all_channels_for_channel_type(channel_type)
+    Get and format data for each of the given Channel objects, fetching up to max_workers channels
+    concurrently. Channels whose fetch fails are logged and left out of the result.
 
+    after_entry_ids can map Thingspeak channel ids to the newest entry id the caller already has,
+    in which case only newer entries are returned for those channels.
 
-def get_and_format_data_for_all_channels(start_time=None, end_time=None):
+    progress (a JobProgress) is told about each channel as its fetch finishes. field_names and
+    num_recent_entries work as for get_and_format_data_for_channel.
+
+    Returns: dict {thingspeak_channel_id: {'channel': channel_object, 'data': list of entry point dicts}}
+    """
+    channels = list(channels)
+    after_entry_ids = after_entry_ids or dict()
+    if progress:
+        progress.start_stage('fetching', [channel.channel_id for channel in channels])
+
+    all_data = {}
+    for channel, data in iter_concurrently(
+            lambda channel: get_and_format_data_for_channel(
+                channel,
+                start_time=start_time,
+                end_time=end_time,
+                columnar=columnar,
+                after_entry_id=after_entry_ids.get(channel.channel_id),
+                field_names=field_names,
+                num_recent_entries=num_recent_entries,
+            ),
+            channels,
+            max_workers=max_workers):
+        all_data[channel.channel_id] = data
+        if progress:
+            progress.channels_done({channel.channel_id: 'fetched'})
+
+    if progress:
+        progress.channels_done({
+            channel.channel_id: 'failed' for channel in channels if channel.channel_id not in all_data
+        })
+
+    # Keep the channels' order, whatever order their fetches finished in
+    return {
+        channel.channel_id: {'channel': channel, 'data': all_data[channel.channel_id]}
+        for channel in channels
+        if channel.channel_id in all_data
+    }
+
+
+def get_and_format_data_for_all_channels(start_time=None, end_time=None, columnar=False,
+                                         max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS, after_entry_ids=None,
+                                         progress=None, channels=None, field_names=None, num_recent_entries=None):
     """
     Update the channels from Thingspeak, then get and format data between start_time and end_time
-    for all active channels.
+    for all active channels, or just the given queryset of channels (only entries newer than
+    after_entry_ids[channel_id], and only the fields in field_names, if given). num_recent_entries
+    works as for get_and_format_data_for_channel.
 
     Returns: dict {thingspeak_channel_id: {'channel': channel_object, 'data': list of entry point dicts}}
     """
     update_all_channel_data()
 
-    all_channels_dict = dict()
+    if channels is None:
+        channels = Channel.objects.filter(is_active=True)
+    # channel_type is loaded up front so the worker threads don't need to query for it
+    channels = channels.select_related('channel_type')
+    return _get_and_format_data_for_channel_objects(
+        channels,
+        start_time=start_time,
+        end_time=end_time,
+        columnar=columnar,
+        max_workers=max_workers,
+        after_entry_ids=after_entry_ids,
+        progress=progress,
+        field_names=field_names,
+        num_recent_entries=num_recent_entries,
+    )
 
-    channels = Channel.objects.filter(is_active=True)
-    for channel in channels:
-        data = get_and_format_data_for_channel(channel, start_time=start_time, end_time=end_time)
-        all_channels_dict[channel.channel_id] = {'channel': channel, 'data': data}
 
-    return all_channels_dict
+def get_and_format_data_for_channels(channel_ids, start_time=None, end_time=None, columnar=False,
+                                     max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS):
+    update_all_channel_data()
 
+    channel_id_ints = [int(channel_id) for channel_id in channel_ids]
+    channels = Channel.objects.filter(
+        channel_id__in=channel_id_ints,
+        is_active=True,
+    ).select_related('channel_type')
 
-def get_and_format_data_for_channels(channel_ids, start_time=None, end_time=None):
-    update_all_channel_data()
+    return _get_and_format_data_for_channel_objects(
+        channels,
+        start_time=start_time,
+        end_time=end_time,
+        columnar=columnar,
+        max_workers=max_workers,
+    )
 
-    channels_dict = dict()
 
-    channel_id_ints = [int(channel_id) for channel_id in channel_ids]
-    channels = Channel.objects.filter(channel_id__in=channel_id_ints, is_active=True)
+def _get_heatmap_readings(channels_dict):
+    """
+    Collect the location, PM2.5 and time columns of every airqo channel, dropping readings
+    without a location.
 
-    for channel in channels:
-        data = get_and_format_data_for_channel(channel, start_time=start_time, end_time=end_time)
-        channels_dict[channel.channel_id] = {'channel': channel, 'data': data}
+    Returns: tuple of numpy arrays (longitudes, latitudes, pm_2_5, created_at)
+    """
+    longitudes, latitudes, pm_2_5, created_at = [], [], [], []
+
+    for channel_info in channels_dict.values():
+        if channel_info["channel"].channel_type.name != AIRQO_CHANNEL_TYPE:
+            continue
+
+        channel_data = ChannelData.coerce(channel_info["data"])
+        if 'latitude' not in channel_data or 'longitude' not in channel_data:
+            continue
+
+        channel_latitudes = channel_data['latitude']
+        channel_longitudes = channel_data['longitude']
+        if channel_latitudes.dtype.kind != 'f' or channel_longitudes.dtype.kind != 'f':
+            continue
 
-    return channels_dict
+        if 'pm_2_5' in channel_data and channel_data['pm_2_5'].dtype.kind == 'f':
+            channel_pm_2_5 = channel_data['pm_2_5']
+        else:
+            channel_pm_2_5 = np.full(len(channel_data), np.nan)
 
+        has_location = ~(np.isnan(channel_latitudes) | np.isnan(channel_longitudes))
+        longitudes.append(channel_longitudes[has_location])
+        latitudes.append(channel_latitudes[has_location])
+        pm_2_5.append(channel_pm_2_5[has_location])
+        created_at.append(channel_data['created_at'][has_location])
 
-def get_and_format_heatmap_data_for_all_channels(start_time=None, end_time=None):
-    all_channels_dict = get_and_format_data_for_all_channels(start_time, end_time)
-    geojson_data = {"type": "FeatureCollection", "features": []}
+    if not longitudes:
+        return np.array([]), np.array([]), np.array([]), np.array([], dtype='datetime64[s]')
 
-    for channel_info in all_channels_dict.values():
-        if channel_info["channel"].channel_type.name == AIRQO_CHANNEL_TYPE:
-            for data_entry in channel_info["data"]:
-                geojson_data["features"].append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [data_entry["longitude"], data_entry["latitude"]],
-                    },
-                })
+    return np.concatenate(longitudes), np.concatenate(latitudes), np.concatenate(pm_2_5), np.concatenate(created_at)
+
+
+def _format_heatmap_features(channels_dict, cell_size_degrees=HEATMAP_GRID_CELL_DEGREES, time_window_minutes=None):
+    """
+    Bin every reading into a grid of cell_size_degrees square cells (and, if time_window_minutes
+    is set, into time windows of that length), with one GeoJSON Point per non-empty cell at the
+    cell's centre.
 
-    return geojson_data
+    Each feature carries the number of readings in the cell and their mean and max PM2.5, so the
+    map can weight the heatmap by pollution while the payload grows with map area rather than
+    with the number of readings.
 
-def get_and_format_heatmap_data_for_channels(start_time=None, end_time=None, channel_ids=None):
+    Returns: list of GeoJSON Feature dicts
+    """
+    features = []
+
+    longitudes, latitudes, pm_2_5, created_at = _get_heatmap_readings(channels_dict)
+    if not len(longitudes):
+        return features
+
+    cell_x = np.floor(longitudes / cell_size_degrees).astype(np.int64)
+    cell_y = np.floor(latitudes / cell_size_degrees).astype(np.int64)
+    if time_window_minutes:
+        window = created_at.astype(np.int64) // (time_window_minutes * 60)
+    else:
+        window = np.zeros(len(longitudes), dtype=np.int64)
+
+    cells, cell_index = np.unique(np.stack([cell_x, cell_y, window], axis=1), axis=0, return_inverse=True)
+    cell_index = cell_index.reshape(-1)
+    num_cells = len(cells)
+
+    has_pm_2_5 = ~np.isnan(pm_2_5)
+    counts = np.bincount(cell_index, minlength=num_cells)
+    pm_2_5_counts = np.bincount(cell_index[has_pm_2_5], minlength=num_cells)
+    pm_2_5_sums = np.bincount(cell_index[has_pm_2_5], weights=pm_2_5[has_pm_2_5], minlength=num_cells)
+    pm_2_5_maxes = np.full(num_cells, -np.inf)
+    np.maximum.at(pm_2_5_maxes, cell_index[has_pm_2_5], pm_2_5[has_pm_2_5])
+
+    for i, (x, y, cell_window) in enumerate(cells.tolist()):
+        has_cell_pm_2_5 = pm_2_5_counts[i] > 0
+        properties = {
+            "count": int(counts[i]),
+            "mean_pm_2_5": round(float(pm_2_5_sums[i] / pm_2_5_counts[i]), 2) if has_cell_pm_2_5 else None,
+            "max_pm_2_5": round(float(pm_2_5_maxes[i]), 2) if has_cell_pm_2_5 else None,
+        }
+        if time_window_minutes:
+            window_start = datetime.utcfromtimestamp(cell_window * time_window_minutes * 60)
+            properties["window_start"] = datetime.strftime(window_start, THINGSPEAK_DATETIME_FORMAT)
+
+        features.append({
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [
+                    round((x + 0.5) * cell_size_degrees, 6),
+                    round((y + 0.5) * cell_size_degrees, 6),
+                ],
+            },
+            "properties": properties,
+        })
+
+    return features
+
+
+def _format_heatmap_geojson(channels_dict, cell_size_degrees=HEATMAP_GRID_CELL_DEGREES, time_window_minutes=None):
+    return {
+        "type": "FeatureCollection",
+        "features": _format_heatmap_features(channels_dict, cell_size_degrees, time_window_minutes),
+    }
+
+
+def get_and_format_heatmap_data_for_all_channels(start_time=None, end_time=None,
+                                                 cell_size_degrees=HEATMAP_GRID_CELL_DEGREES, time_window_minutes=None):
+    all_channels_dict = get_and_format_data_for_all_channels(start_time, end_time, columnar=True)
+    return _format_heatmap_geojson(all_channels_dict, cell_size_degrees, time_window_minutes)
+
+
+def get_and_format_heatmap_data_for_channels(start_time=None, end_time=None, channel_ids=None,
+                                             cell_size_degrees=HEATMAP_GRID_CELL_DEGREES, time_window_minutes=None):
     if not channel_ids:
-        return get_and_format_heatmap_data_for_all_channels(start_time, end_time)
+        return get_and_format_heatmap_data_for_all_channels(start_time, end_time, cell_size_degrees, time_window_minutes)
 
-    all_channels_dict = get_and_format_data_for_channels(
+    channels_dict = get_and_format_data_for_channels(
         start_time=start_time,
         end_time=end_time,
         channel_ids=channel_ids,
+        columnar=True,
+    )
+    return _format_heatmap_geojson(channels_dict, cell_size_degrees, time_window_minutes)
+
+
+def get_heatmap_channels(channel_ids=None):
+    """
+    Get the active airqo channels the heatmap draws, optionally only those in channel_ids.
+    Unlike the functions above, this doesn't refresh the channel list from Thingspeak first;
+    the scheduled sweep keeps it up to date.
+
+    Returns: QuerySet of Channel objects with their channel_type loaded
+    """
+    channels = Channel.objects.filter(
+        is_active=True,
+        channel_type__name=AIRQO_CHANNEL_TYPE,
+    ).select_related('channel_type')
+
+    if channel_ids:
+        channels = channels.filter(channel_id__in=[int(channel_id) for channel_id in channel_ids])
+
+    return channels
+
+
+def iter_heatmap_features_for_channels(channels, start_time=None, end_time=None,
+                                       cell_size_degrees=HEATMAP_GRID_CELL_DEGREES, time_window_minutes=None,
+                                       max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS, sync=True):
+    """
+    Fetch the given channels concurrently and bin each one's readings as soon as it arrives.
+    Cells are binned per channel, so two channels in the same cell give two features at the
+    same point, which the heatmap adds together anyway. Pass sync=False if the channels have
+    just been synced.
+
+    Returns: generator of lists of GeoJSON Feature dicts, one list per channel, in completion order
+    """
+    results = iter_concurrently(
+        lambda channel: get_and_format_data_for_channel(
+            channel,
+            start_time=start_time,
+            end_time=end_time,
+            columnar=True,
+            sync=sync,
+        ),
+        channels,
+        max_workers=max_workers,
     )
-    geojson_data = {"type": "FeatureCollection", "features": []}
-
-    for channel_info in all_channels_dict.values():
-        if channel_info["channel"].channel_type.name == AIRQO_CHANNEL_TYPE:
-            for data_entry in channel_info["data"]:
-                geojson_data["features"].append({
-                    "type": "Feature",
-                    "geometry": {
-                        "type": "Point",
-                        "coordinates": [data_entry["longitude"], data_entry["latitude"]],
-                    },
-                })
-
-    return geojson_data
+    for channel, data in results:
+        yield _format_heatmap_features(
+            {channel.channel_id: {'channel': channel, 'data': data}},
+            cell_size_degrees,
+            time_window_minutes,
+        )
@@ -0,0 +1,149 @@
+import json
+import time
+import traceback
+
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.utils import timezone
+
+from airqo_monitor.constants import (
+    CACHE_LOCK_POLL_SECONDS,
+    CACHE_LOCK_TIMEOUT_SECONDS,
+    CACHE_LOCK_WAIT_SECONDS,
+    JOB_ENQUEUE_LOCK_KEY,
+    JOB_STALE_AFTER_SECONDS,
+    SWEEP_LOCK_WAIT_SECONDS,
+)
+from airqo_monitor.malfunction_detection.get_malfunctions import get_all_channel_malfunctions
+from airqo_monitor.models import Job
+
+
+# What each kind of job runs. Each function is passed a JobProgress to report to.
+JOB_FUNCTIONS = {
+    # Jobs are run by the scheduler, which can afford to wait for its own shard sweeps to finish
+    Job.MALFUNCTION_SWEEP: lambda progress: get_all_channel_malfunctions(
+        progress=progress,
+        lock_wait_seconds=SWEEP_LOCK_WAIT_SECONDS,
+    ),
+}
+
+
+class JobProgress(object):
+    """
+    Records how far a running job has got on its Job row, so the status endpoint can show it.
+    """
+
+    def __init__(self, job):
+        self.job = job
+        self.channel_progress = {}
+
+    def _save(self):
+        self.job.channel_progress_json = json.dumps(self.channel_progress)
+        self.job.save(update_fields=['stage', 'channel_progress_json'])
+
+    def start_stage(self, stage, channel_ids):
+        """Start a new stage, with every one of channel_ids pending"""
+        self.job.stage = stage
+        self.channel_progress = {str(channel_id): 'pending' for channel_id in channel_ids}
+        self._save()
+
+    def channels_done(self, channel_statuses):
+        """Record channel_statuses, a dict {channel_id: status}, for the current stage"""
+        if not channel_statuses:
+            return
+        for channel_id, status in channel_statuses.items():
+            self.channel_progress[str(channel_id)] = status
+        self._save()
+
+
+def fail_stale_jobs():
+    """
+    Mark running jobs that started more than JOB_STALE_AFTER_SECONDS ago as failed. Their worker
+    must have died, and they'd otherwise stop new jobs of the same kind from being queued.
+    """
+    cutoff = timezone.now() - timedelta(seconds=JOB_STALE_AFTER_SECONDS)
+    Job.objects.filter(status=Job.RUNNING, started_at__lt=cutoff).update(
+        status=Job.FAILED,
+        finished_at=timezone.now(),
+        error='Timed out',
+    )
+
+
+def enqueue_job(kind):
+    """
+    Queue a job of the given kind, unless one is already queued or running, in which case the
+    caller gets that one instead.
+
+    Returns: tuple (Job, whether it was created)
+    """
+    fail_stale_jobs()
+
+    # The lock stops two web workers from both seeing no job and queuing one each
+    deadline = time.time() + CACHE_LOCK_WAIT_SECONDS
+    locked = cache.add(JOB_ENQUEUE_LOCK_KEY, True, timeout=CACHE_LOCK_TIMEOUT_SECONDS)
+    while not locked:
+        if time.time() > deadline:
+            # Carry on without it; at worst a duplicate job is queued, which the worker runs in turn
+            print('[enqueue_job] Gave up waiting for the lock')
+            break
+        time.sleep(CACHE_LOCK_POLL_SECONDS)
+        locked = cache.add(JOB_ENQUEUE_LOCK_KEY, True, timeout=CACHE_LOCK_TIMEOUT_SECONDS)
+    try:
+        job = Job.objects.filter(kind=kind, status__in=[Job.QUEUED, Job.RUNNING]).order_by('created_at').first()
+        if job is not None:
+            return job, False
+        return Job.objects.create(kind=kind), True
+    finally:
+        # Only release the lock if this call holds it, rather than another worker's
+        if locked:
+            cache.delete(JOB_ENQUEUE_LOCK_KEY)
+
+
+def claim_next_job():
+    """
+    Mark the oldest queued job as running. The status check in the update means that only one
+    worker can claim each job.
+
+    Returns: the claimed Job, or None if there's nothing queued
+    """
+    for job in Job.objects.filter(status=Job.QUEUED).order_by('created_at'):
+        started_at = timezone.now()
+        if Job.objects.filter(id=job.id, status=Job.QUEUED).update(status=Job.RUNNING, started_at=started_at):
+            job.status = Job.RUNNING
+            job.started_at = started_at
+            return job
+    return None
+
+
+def run_job(job):
+    """
+    Run a claimed job, recording whether it succeeded (and the error if it didn't)
+    """
+    print('[run_job] Running job {}'.format(job))
+    try:
+        JOB_FUNCTIONS[job.kind](JobProgress(job))
+        job.status = Job.SUCCEEDED
+    except Exception:
+        print('[run_job] Job {} failed: {}'.format(job.id, traceback.format_exc()))
+        job.status = Job.FAILED
+        job.error = traceback.format_exc()
+    job.finished_at = timezone.now()
+    job.save(update_fields=['status', 'error', 'finished_at'])
+
+
+def run_pending_jobs():
+    """
+    Run queued jobs one after another until there are none left.
+
+    Returns: the number of jobs run
+    """
+    fail_stale_jobs()
+
+    num_jobs = 0
+    job = claim_next_job()
+    while job is not None:
+        run_job(job)
+        num_jobs += 1
+        job = claim_next_job()
+    return num_jobs
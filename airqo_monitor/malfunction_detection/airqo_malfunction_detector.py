@@ -1,3 +1,5 @@
+import numpy as np
+
 from datetime import datetime, timedelta
 
 from airqo_monitor.malfunction_detection.base_malfunction_detector import MalfunctionDetector
@@ -7,14 +9,21 @@ from airqo_monitor.constants import (
     NO_DATA_MALFUNCTION_REASON_STR,
     REPORTING_OUTLIERS_MALFUNCTION_REASON_STR,
 )
-from airqo_monitor.utils import (
-    get_float_global_var_value,
-    get_int_global_var_value,
-)
+from airqo_monitor.objects.channel_data import ChannelData
 
 
 class AirqoMalfunctionDetector(MalfunctionDetector):
 
+    def get_num_recent_entries_needed(self):
+        return max(
+            1,
+            self.thresholds.get_int('AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION'),
+            self.thresholds.get_int('AIRQO_NUM_REPORTS_TO_VERIFY_REPORTING_MALFUNCTION'),
+        )
+
+    def get_field_names_needed(self):
+        return ['pm_2_5', 'battery_voltage']
+
     def get_malfunctions(self, channel_data):
         malfunction_list = []
 
@@ -37,25 +46,31 @@ class AirqoMalfunctionDetector(MalfunctionDetector):
         Presence of outlier points may indicated an obstructed sensor.
         """
         assert len(channel_data) > 0
-        num_points = min(get_int_global_var_value('AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION'), len(channel_data))
-        is_outlier = lambda pm_2_5: pm_2_5 < get_float_global_var_value('AIRQO_SENSOR_PM_2_5_MIN_CUTOFF') or pm_2_5 > get_float_global_var_value('AIRQO_SENSOR_PM_2_5_MAX_CUTOFF')
-        extreme_reads = [entry for entry in channel_data[-1 * num_points:] if is_outlier(float(entry.get('pm_2_5')))]
-        return len(extreme_reads) > num_points * get_float_global_var_value('AIRQO_ALLOWABLE_OUTLIER_SENSOR_RATIO')
+        channel_data = ChannelData.coerce(channel_data)
+
+        num_points = min(self.thresholds.get_int('AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION'), len(channel_data))
+        pm_2_5 = channel_data['pm_2_5'][-1 * num_points:]
+        min_cutoff = self.thresholds.get_float('AIRQO_SENSOR_PM_2_5_MIN_CUTOFF')
+        max_cutoff = self.thresholds.get_float('AIRQO_SENSOR_PM_2_5_MAX_CUTOFF')
+        is_outlier = (pm_2_5 < min_cutoff) | (pm_2_5 > max_cutoff)
+        num_extreme_reads = np.count_nonzero(is_outlier)
+        return bool(num_extreme_reads > num_points * self.thresholds.get_float('AIRQO_ALLOWABLE_OUTLIER_SENSOR_RATIO'))
 
     def _has_low_reporting_frequency(self, channel_data):
         """
         Determine whether the channel is reporting data at a lower frequency than expected.
         """
         assert len(channel_data) > 0
+        channel_data = ChannelData.coerce(channel_data)
 
-        index_to_verify = min(len(channel_data), get_int_global_var_value('AIRQO_NUM_REPORTS_TO_VERIFY_REPORTING_MALFUNCTION'))
-        report_to_verify = channel_data[-1 * index_to_verify]
-        report_timestamp = datetime.strptime(report_to_verify.get('created_at'), '%Y-%m-%dT%H:%M:%SZ')
+        index_to_verify = min(len(channel_data), self.thresholds.get_int('AIRQO_NUM_REPORTS_TO_VERIFY_REPORTING_MALFUNCTION'))
+        report_timestamp = channel_data['created_at'][-1 * index_to_verify]
 
         # The cutoff time is now minus MINIMUM_REPORT_FREQUENCY_SECONDS seconds per report being evaluated.
         # The number of reports being evaluated is determined by the index_to_verify.
-        cutoff_time = datetime.utcnow() - timedelta(seconds=get_int_global_var_value('AIRQO_MAXIMUM_AVERAGE_SECONDS_BETWEEN_REPORTS') * index_to_verify)
+        max_seconds_between_reports = self.thresholds.get_int('AIRQO_MAXIMUM_AVERAGE_SECONDS_BETWEEN_REPORTS')
+        cutoff_time = np.datetime64(datetime.utcnow() - timedelta(seconds=max_seconds_between_reports * index_to_verify), 's')
 
         # If the report timestamp is earlier than the cutoff time, that means that there is too much time passing
         # between each point being reported.
-        return report_timestamp < cutoff_time
+        return bool(report_timestamp < cutoff_time)
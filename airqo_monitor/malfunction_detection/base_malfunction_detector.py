@@ -4,15 +4,43 @@ from airqo_monitor.constants import (
     NO_DATA_MALFUNCTION_REASON_STR,
     REPORTING_OUTLIERS_MALFUNCTION_REASON_STR,
 )
-from airqo_monitor.utils import get_float_global_var_value
+from airqo_monitor.malfunction_detection.thresholds import MalfunctionThresholds
+from airqo_monitor.objects.channel_data import ChannelData
+
 
 class MalfunctionDetector(object):
     """
     All malfunction detectors inherit this base detection class. By default, a new type of
     channel will use these detection functions unless they are overriden by their own detection
     class.
+
+    channel_data can be a ChannelData or a list of entry dicts. Checks work on whole columns at
+    once, and thresholds are read once per detector (or passed in, to share them across a run).
     """
 
+    def __init__(self, thresholds=None):
+        self._thresholds = thresholds
+
+    @property
+    def thresholds(self):
+        if self._thresholds is None:
+            self._thresholds = MalfunctionThresholds.load()
+        return self._thresholds
+
+    def get_num_recent_entries_needed(self):
+        """
+        How many of the newest entries the checks look at, which is how many incremental
+        detection has to remember between runs.
+        """
+        return 1
+
+    def get_field_names_needed(self):
+        """
+        The fields the checks read (besides the entry id and time), so sweeps can leave the
+        others out.
+        """
+        return ['battery_voltage']
+
     def get_malfunctions(self, channel_data):
         malfunction_list = []
 
@@ -31,8 +59,8 @@ class MalfunctionDetector(object):
     def _has_low_battery(self, channel_data):
         """Determine whether the channel has low battery. channel_data can't be empty."""
         assert len(channel_data) > 0
-        last_voltage = float(channel_data[-1].get('battery_voltage'))
-        return last_voltage < get_float_global_var_value('LOW_BATTERY_CUTOFF')
+        last_voltage = ChannelData.coerce(channel_data)['battery_voltage'][-1]
+        return bool(last_voltage < self.thresholds.get_float('LOW_BATTERY_CUTOFF'))
 
     def _has_no_data(self, channel_data):
         return len(channel_data) == 0
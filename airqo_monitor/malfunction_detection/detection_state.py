@@ -0,0 +1,132 @@
+import json
+import numpy as np
+
+from datetime import timedelta
+from django.utils import timezone
+
+from airqo_monitor.constants import (
+    CHECK_DUE_SLACK_SECONDS,
+    CHECK_INTERVAL_BACKOFF_FACTOR,
+    CHECK_INTERVAL_DEFAULT_SECONDS,
+    CHECK_INTERVAL_MAX_SECONDS,
+    CHECK_INTERVAL_MIN_SECONDS,
+    CHECK_INTERVAL_VOLATILE_COEFFICIENT_OF_VARIATION,
+    INACTIVE_MONITOR_KEYWORD,
+)
+from airqo_monitor.models import ChannelDetectionState
+from airqo_monitor.objects.channel_data import ChannelData
+from airqo_monitor.utils import to_utc
+
+
+def load_detection_states(channels=None):
+    """
+    Returns: dict {thingspeak_channel_id: ChannelDetectionState} for all channels, or just the
+        given queryset of channels
+    """
+    states = ChannelDetectionState.objects.select_related('channel')
+    if channels is not None:
+        states = states.filter(channel__in=channels)
+    return {state.channel.channel_id: state for state in states}
+
+
+def get_after_entry_ids(detection_states):
+    """
+    Returns: dict {thingspeak_channel_id: newest entry id detection has already seen}
+    """
+    return {
+        channel_id: state.last_entry_id
+        for channel_id, state in detection_states.items()
+        if state.last_entry_id is not None
+    }
+
+
+def update_detection_state(state, channel, new_data, num_recent_entries, window_start, field_names=None):
+    """
+    Add the entries that arrived since the last run to the ones remembered from earlier runs,
+    and keep the newest num_recent_entries of them that are still after window_start. Detectors
+    only look at that many of the newest entries, so they get the same result as they would from
+    the whole window. If field_names is given, only those fields are kept.
+
+    Returns: tuple (the updated, unsaved ChannelDetectionState, ChannelData of the recent entries)
+    """
+    if state is None:
+        state = ChannelDetectionState(channel=channel)
+
+    new_data = ChannelData.coerce(new_data)
+    recent_data = ChannelData.concatenate([ChannelData.from_entries(state.recent_entries), new_data])
+    recent_data = recent_data[recent_data.created_at >= np.datetime64(window_start, 's')]
+    recent_data = recent_data[-num_recent_entries:]
+    if field_names is not None:
+        recent_data = recent_data.with_fields(field_names)
+
+    if len(new_data):
+        state.last_entry_id = int(new_data.entry_id[-1])
+        state.last_report_at = to_utc(new_data.created_at[-1].item())
+    state.recent_entries_json = json.dumps(recent_data.to_entries())
+
+    return state, recent_data
+
+
+def get_due_channels(channels, now=None):
+    """
+    Returns: the channels in the queryset that are due a check: those whose next_check_at has
+    passed, and those that have never been checked
+    """
+    now = now or timezone.now()
+    return channels.exclude(
+        channeldetectionstate__next_check_at__gt=now + timedelta(seconds=CHECK_DUE_SLACK_SECONDS),
+    )
+
+
+def _is_volatile(recent_data):
+    if 'pm_2_5' not in recent_data:
+        return False
+    values = recent_data['pm_2_5']
+    values = values[~np.isnan(values)]
+    if len(values) < 2 or values.mean() <= 0:
+        return False
+    return values.std() / values.mean() > CHECK_INTERVAL_VOLATILE_COEFFICIENT_OF_VARIATION
+
+
+def _is_inactive(channel):
+    # Either deactivated, or renamed INACTIVE on Thingspeak and about to be
+    return not channel.is_active or INACTIVE_MONITOR_KEYWORD in (channel.name or '')
+
+
+def update_next_check(state, num_new_entries, recent_data, possible_malfunctions, now=None):
+    """
+    Work out when the channel should next be checked, from how it behaved in this check:
+
+        - marked INACTIVE: nobody's looking at it, so check it as rarely as possible
+        - malfunctioning (including not reporting at all): check again as soon as possible
+        - no new entries since the last check: it's gone quiet, so back off
+        - volatile PM2.5 readings: check more often
+        - otherwise it's stable, so back off
+
+    The interval is kept between CHECK_INTERVAL_MIN_SECONDS and CHECK_INTERVAL_MAX_SECONDS.
+    """
+    now = now or timezone.now()
+    interval = state.check_interval_seconds or CHECK_INTERVAL_DEFAULT_SECONDS
+
+    if _is_inactive(state.channel):
+        interval = CHECK_INTERVAL_MAX_SECONDS
+    elif possible_malfunctions:
+        interval = CHECK_INTERVAL_MIN_SECONDS
+    elif not num_new_entries:
+        interval *= CHECK_INTERVAL_BACKOFF_FACTOR
+    elif _is_volatile(recent_data):
+        interval //= CHECK_INTERVAL_BACKOFF_FACTOR
+    else:
+        interval *= CHECK_INTERVAL_BACKOFF_FACTOR
+
+    state.check_interval_seconds = int(min(CHECK_INTERVAL_MAX_SECONDS, max(CHECK_INTERVAL_MIN_SECONDS, interval)))
+    state.next_check_at = now + timedelta(seconds=state.check_interval_seconds)
+
+
+def save_detection_states(states):
+    new_states = [state for state in states if state.pk is None]
+    ChannelDetectionState.objects.bulk_create(new_states)
+
+    for state in states:
+        if state.pk is not None:
+            state.save()
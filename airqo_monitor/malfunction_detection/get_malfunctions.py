@@ -1,27 +1,97 @@
+import django
+import multiprocessing
+import os
+import time
+import traceback
+
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from datetime import datetime, timedelta
-from werkzeug.contrib.cache import SimpleCache
 from copy import deepcopy
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 
-from airqo_monitor.models import Incident, Channel, MalfunctionReason
+from airqo_monitor.caching import (
+    CacheLockTimeout,
+    get_with_age,
+    invalidate_dashboard_cache,
+    renewing_cache_locks,
+    set_with_age,
+)
+from airqo_monitor.models import Incident, Channel, ChannelType, GlobalVariable, MalfunctionReason
 
+from airqo_monitor.external.thingspeak import flush_usage
 from airqo_monitor.format_data import get_and_format_data_for_all_channels
 from airqo_monitor.constants import (
     AIRQO_CHANNEL_TYPE,
+    CACHE_LOCK_POLL_SECONDS,
+    DETECTION_MAX_PROCESSES,
+    DETECTION_PROCESS_POOL_CHUNKS_PER_PROCESS,
+    DETECTION_PROCESS_POOL_MIN_CHANNELS,
+    MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS,
+    MALFUNCTIONS_CACHE_KEY,
     SOIL_CHANNEL_TYPE,
+    SWEEP_LOCK_KEY,
+    SWEEP_LOCK_TIMEOUT_SECONDS,
 )
 from airqo_monitor.malfunction_detection import (
     AirqoMalfunctionDetector,
     SoilMalfunctionDetector,
     MalfunctionDetector,
+    MalfunctionThresholds,
+)
+from airqo_monitor.malfunction_detection.detection_state import (
+    get_after_entry_ids,
+    load_detection_states,
+    save_detection_states,
+    update_detection_state,
+    update_next_check,
 )
 from airqo_monitor.utils import update_last_channel_update_time
 
-cache = SimpleCache()
+
+def _get_malfunction_detector(channel_type, thresholds=None):
+    if channel_type == AIRQO_CHANNEL_TYPE:
+        return AirqoMalfunctionDetector(thresholds)
+    elif channel_type == SOIL_CHANNEL_TYPE:
+        return SoilMalfunctionDetector(thresholds)
+    return MalfunctionDetector(thresholds)
+
+
+def _get_field_names_needed():
+    """The fields any of the detectors read, which are all a sweep needs to load."""
+    field_names = set()
+    for channel_type in (AIRQO_CHANNEL_TYPE, SOIL_CHANNEL_TYPE, None):
+        field_names.update(_get_malfunction_detector(channel_type).get_field_names_needed())
+    return sorted(field_names)
+
+
+def _get_num_recent_entries_needed(channel_type_names, thresholds):
+    """
+    The most entries the detectors of the given channel types look at, which is all a channel's
+    first sweep needs.
+
+    Returns: the number of entries, or None (so the whole window is synced) if there are no
+        channel types or one of the thresholds that decides it isn't set
+    """
+    try:
+        num_entries = [
+            _get_malfunction_detector(channel_type_name, thresholds).get_num_recent_entries_needed()
+            for channel_type_name in channel_type_names
+        ]
+    except GlobalVariable.DoesNotExist as e:
+        print('[_get_num_recent_entries_needed] Syncing whole windows: {}'.format(e))
+        return None
+    return max(num_entries) if num_entries else None
 
 
-def _get_channel_malfunctions(channel_data, channel_type):
+def _get_channel_malfunctions(channel_data, channel_type, thresholds=None):
     """
     Use channel_data to get a list of malfunctions that may be occuring with a channel.
+    Pass thresholds to share one set of GlobalVariable cutoffs across a whole detection run.
 
     Returns: a list of potential malfunctions. Potential malfunctions include:
         - "low_battery_voltage": Channel data indicates that the device is running low on battery
@@ -29,76 +99,254 @@ def _get_channel_malfunctions(channel_data, channel_type):
         - "reporting_outliers": The sensor is reporting readings that are outside a reasonable range.
         - "no_data": The channel_data list was empty.
     """
-    malfunction_detector = MalfunctionDetector()
-    if channel_type == AIRQO_CHANNEL_TYPE:
-        malfunction_detector = AirqoMalfunctionDetector()
-    elif channel_type == SOIL_CHANNEL_TYPE:
-        malfunction_detector = SoilMalfunctionDetector()
+    return _get_malfunction_detector(channel_type, thresholds).get_malfunctions(channel_data)
+
+
+def _get_malfunctions_for_chunk(chunk):
+    """
+    Run detection for a list of (channel_data, channel_type, thresholds) tuples. This runs in
+    a worker process, so it must only use what it's given and never touch the database.
+    """
+    return [
+        _get_channel_malfunctions(channel_data, channel_type, thresholds=thresholds)
+        for channel_data, channel_type, thresholds in chunk
+    ]
+
+
+def _get_malfunctions_for_channels(detection_inputs, max_processes=DETECTION_MAX_PROCESSES,
+                                   min_channels=DETECTION_PROCESS_POOL_MIN_CHANNELS):
+    """
+    Run detection for every (channel_data, channel_type, thresholds) tuple in detection_inputs.
+
+    Large fleets are split into chunks and spread over a pool of processes, with the data passed
+    as ChannelData arrays so it's cheap to pickle. Small fleets, or a pool that can't be started
+    or dies, fall back to running serially in this process.
+
+    Returns: list of malfunction lists, in the same order as detection_inputs
+    """
+    num_processes = max_processes or os.cpu_count() or 1
+    if len(detection_inputs) < max(min_channels, 2) or num_processes < 2:
+        return _get_malfunctions_for_chunk(detection_inputs)
+
+    num_chunks = min(len(detection_inputs), num_processes * DETECTION_PROCESS_POOL_CHUNKS_PER_PROCESS)
+    chunk_size = -(-len(detection_inputs) // num_chunks)
+    chunks = [detection_inputs[i:i + chunk_size] for i in range(0, len(detection_inputs), chunk_size)]
 
-    return malfunction_detector.get_malfunctions(channel_data)
+    # This may be the scheduler, with DB connections open in other threads too, and closing them
+    # here would only close this thread's. Spawned workers start fresh, so they can't inherit
+    # any of those sockets (or locks held by other threads); they only need Django set up to
+    # import this module.
+    try:
+        with ProcessPoolExecutor(
+                max_workers=min(num_processes, len(chunks)),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=django.setup,
+        ) as executor:
+            # map returns results in input order, whichever process finishes first
+            chunk_results = list(executor.map(_get_malfunctions_for_chunk, chunks))
+    except (BrokenProcessPool, OSError):
+        print('[_get_malfunctions_for_channels] Process pool failed, detecting serially: {}'.format(
+            traceback.format_exc()))
+        return _get_malfunctions_for_chunk(detection_inputs)
+
+    return [malfunctions for chunk_result in chunk_results for malfunctions in chunk_result]
 
 
 def update_db(channels):
     """
     Given a list of channels and their active malfunctions, create or resolve Incidents
     to reflect the current status.
+
+    All open incidents and malfunction reasons are loaded up front and the changes are written
+    in bulk inside one transaction, so the number of queries doesn't grow with the number of channels.
     """
+    channel_ids = [int(channel["channel_id"]) for channel in channels]
+    channel_objects = Channel.objects.in_bulk(channel_ids, field_name='channel_id')
+
+    # Group the open incidents by channel so each can be matched against the current reasons
+    open_incidents = defaultdict(list)
+    existing_incidents = Incident.objects.filter(
+        channel__channel_id__in=channel_ids,
+        resolved_at__isnull=True,
+    ).select_related('malfunction_reason')
+    for incident in existing_incidents:
+        open_incidents[incident.channel_id].append(incident)
+
+    reason_names = set(name for channel in channels for name in channel["possible_malfunction_reasons"])
+    malfunction_reasons = dict()
+    for malfunction_reason in MalfunctionReason.objects.filter(name__in=reason_names).order_by('-id'):
+        # Names aren't unique, so keep the first one like the lookup this replaced did
+        malfunction_reasons[malfunction_reason.name] = malfunction_reason
+
+    resolved_incident_ids = []
+    new_incidents = []
     for channel in channels:
-        channel_object = Channel.objects.filter(channel_id=channel["channel_id"]).first()
+        channel_object = channel_objects.get(int(channel["channel_id"]))
+        if channel_object is None:
+            continue
 
         # Check for existing incidents and resolve ones that have gone away.
-        existing_channel_incidents = Incident.objects.filter(channel=channel_object, resolved_at__isnull=True)
         current_incident_reasons = deepcopy(channel["possible_malfunction_reasons"])
-        for incident in existing_channel_incidents:
+        for incident in open_incidents[channel_object.id]:
             reason_name = incident.malfunction_reason.name
             if reason_name not in current_incident_reasons:
                 # If the incident is no longer reported, we consider it resolved.
-                incident.resolved_at = datetime.now()
-                incident.save()
+                resolved_incident_ids.append(incident.id)
             else:
                 # If the incident already exists we don't want to create a new Incident object.
                 current_incident_reasons.remove(reason_name)
 
-        # Create new incidents and their reason links.
-        if current_incident_reasons:
-            # Create one incident per reason.
-            for malfunction_reason_name in current_incident_reasons:
-                # Create the incident and connect it to a reason.
-                malfunction_reason = MalfunctionReason.objects.filter(name=malfunction_reason_name).first()
-                incident = Incident.objects.create(channel=channel_object, malfunction_reason=malfunction_reason)
+        # Create one incident per new reason.
+        for malfunction_reason_name in current_incident_reasons:
+            malfunction_reason = malfunction_reasons.get(malfunction_reason_name)
+            if malfunction_reason is None:
+                print('[update_db] Unknown malfunction reason: {}'.format(malfunction_reason_name))
+                continue
+            new_incidents.append(Incident(channel=channel_object, malfunction_reason=malfunction_reason))
+
+    with transaction.atomic():
+        if resolved_incident_ids:
+            Incident.objects.filter(id__in=resolved_incident_ids).update(resolved_at=timezone.now())
+        if new_incidents:
+            Incident.objects.bulk_create(new_incidents)
 
+    # Bulk writes don't send the signals the dashboard cache listens for
+    invalidate_dashboard_cache()
     update_last_channel_update_time()
 
 
-def get_all_channel_malfunctions():
-    """Generate a list of malfunctions for all channels.
+def _lock_all_sweep_shards(wait_seconds):
+    """
+    Take the sweep lock of every shard of every channel type (see sweeps.sweep_shard), waiting
+    up to wait_seconds for any shard that's being swept to finish. If one is still busy after
+    that (straight away, with the default of 0), the locks taken so far are released and
+    CacheLockTimeout is raised.
+
+    Returns: the lock keys, to hold with renewing_cache_locks
+    """
+    lock_keys = [
+        SWEEP_LOCK_KEY.format(channel_type.id, shard_index)
+        for channel_type in ChannelType.objects.order_by('id')
+        for shard_index in range(max(1, channel_type.sweep_shard_count))
+    ]
+    deadline = time.time() + wait_seconds
+    locked_keys = []
+    try:
+        for lock_key in lock_keys:
+            while not cache.add(lock_key, True, timeout=SWEEP_LOCK_TIMEOUT_SECONDS):
+                if time.time() >= deadline:
+                    raise CacheLockTimeout('Gave up waiting for {} after {} seconds'.format(
+                        lock_key, wait_seconds))
+                time.sleep(CACHE_LOCK_POLL_SECONDS)
+            locked_keys.append(lock_key)
+    except Exception:
+        cache.delete_many(locked_keys)
+        raise
+    return locked_keys
+
+
+def get_all_channel_malfunctions(progress=None, channels=None, lock_wait_seconds=0):
+    """Generate a list of malfunctions for all channels, or just the given queryset of channels.
+
+    Each channel's newest entries are remembered between runs (see ChannelDetectionState), so
+    only the entries that arrived since the previous run are read, and only the fields the
+    detectors need. A channel that's never been synced only has the newest entries the detectors
+    look at fetched from Thingspeak, rather than the whole day. When each channel should next be
+    checked is worked out from how it's behaving (see update_next_check).
+
+    A sweep of all the channels holds every shard's sweep lock, so it never runs alongside a
+    scheduled shard sweep (which would open the same incidents and detection states twice). If
+    a shard is still being swept after lock_wait_seconds, CacheLockTimeout is raised; only the
+    scheduler's job worker should wait (see jobs.JOB_FUNCTIONS).
+
+    progress (a JobProgress) is told how far the sweep has got.
 
     Returns: A dict keyed by the channel id. The value is a list of potential concerns about a sensor.
     """
-    channels = []
+    if channels is not None:
+        return _sweep_channels(progress, channels)
+
+    lock_keys = _lock_all_sweep_shards(lock_wait_seconds)
+    with renewing_cache_locks(lock_keys, SWEEP_LOCK_TIMEOUT_SECONDS):
+        channels = _sweep_channels(progress, channels)
+
+    # Full sweeps are what the malfunctions endpoint serves (see get_cached_malfunctions_with_age)
+    set_with_age(
+        MALFUNCTIONS_CACHE_KEY,
+        channels,
+        settings.MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS or MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS,
+    )
+    return channels
+
+
+def _sweep_channels(progress, channels):
+    checked_at = timezone.now()
     start_time = datetime.utcnow() - timedelta(days=1)
-    all_channels_info = get_and_format_data_for_all_channels(start_time=start_time)
+    detection_states = load_detection_states(channels)
+    # Read the cutoffs once for the whole run rather than once per channel (or per reading)
+    thresholds = MalfunctionThresholds.load()
+    swept_channels = channels if channels is not None else Channel.objects.filter(is_active=True)
+    channel_type_names = set(swept_channels.values_list('channel_type__name', flat=True))
+    all_channels_info = get_and_format_data_for_all_channels(
+        start_time=start_time,
+        columnar=True,
+        after_entry_ids=get_after_entry_ids(detection_states),
+        progress=progress,
+        channels=channels,
+        field_names=_get_field_names_needed(),
+        num_recent_entries=_get_num_recent_entries_needed(channel_type_names, thresholds),
+    )
+
+    updated_states = []
+    detection_inputs = []
     for channel_id, channel_info in all_channels_info.items():
         channel = channel_info['channel']
-        possible_malfunctions = _get_channel_malfunctions(channel_info['data'], channel.channel_type.name)
+        detector = _get_malfunction_detector(channel.channel_type.name, thresholds)
+        state, recent_data = update_detection_state(
+            detection_states.get(channel_id),
+            channel,
+            channel_info['data'],
+            detector.get_num_recent_entries_needed(),
+            start_time,
+            field_names=detector.get_field_names_needed(),
+        )
+        updated_states.append(state)
+        detection_inputs.append((recent_data, channel.channel_type.name, thresholds))
+
+    if progress:
+        progress.start_stage('detecting', all_channels_info.keys())
+    all_possible_malfunctions = _get_malfunctions_for_channels(detection_inputs)
+    channels = []
+    for (channel_id, channel_info), state, (recent_data, _, _), possible_malfunctions in zip(
+            all_channels_info.items(), updated_states, detection_inputs, all_possible_malfunctions):
+        update_next_check(state, len(channel_info['data']), recent_data, possible_malfunctions, now=checked_at)
         channels.append(
             {
-                "name": channel.name,
+                "name": channel_info['channel'].name,
                 "channel_id": channel_id,
                 "possible_malfunction_reasons": possible_malfunctions,
             }
         )
 
+    if progress:
+        progress.channels_done({
+            channel['channel_id']: 'malfunctioning' if channel['possible_malfunction_reasons'] else 'ok'
+            for channel in channels
+        })
+
     update_db(channels)
+    save_detection_states(updated_states)
+    flush_usage()
     return channels
 
 
-def get_all_channel_malfunctions_cached():
+def get_cached_malfunctions_with_age():
     """
-    Cached wrapper around get_all_channel_malfunctions
+    The result of the latest full sweep, as cached by get_all_channel_malfunctions for
+    MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS (or the setting of that name). Nothing is swept here,
+    so web requests never do the scheduler's work.
+
+    Returns: tuple (list of channel malfunctions as returned by get_all_channel_malfunctions,
+        age of that list in seconds), or (None, None) if there isn't one
     """
-    cached_value = cache.get('channel-malfunctions')
-    if cached_value is None:
-        cached_value = get_all_channel_malfunctions()
-        cache.set('channel-malfunctions', cached_value, timeout=5 * 60)
-    return cached_value
+    return get_with_age(MALFUNCTIONS_CACHE_KEY)
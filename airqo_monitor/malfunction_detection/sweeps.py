@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from django.core.cache import cache
+from django.db.models import F
+
+from airqo_monitor.caching import renewing_cache_locks
+from airqo_monitor.constants import SWEEP_LOCK_KEY, SWEEP_LOCK_TIMEOUT_SECONDS
+from airqo_monitor.malfunction_detection.detection_state import get_due_channels
+from airqo_monitor.malfunction_detection.get_malfunctions import get_all_channel_malfunctions
+from airqo_monitor.models import Channel, ChannelType
+
+
+def get_shard_channels(channel_type, shard_index):
+    """
+    Returns: queryset of the active channels of channel_type in shard shard_index. Channels are
+    assigned to one of the type's sweep_shard_count shards by their Thingspeak channel id.
+    """
+    channels = Channel.objects.filter(is_active=True, channel_type=channel_type)
+    if channel_type.sweep_shard_count > 1:
+        channels = channels.annotate(
+            shard_index=F('channel_id') % channel_type.sweep_shard_count,
+        ).filter(shard_index=shard_index)
+    return channels
+
+
+def sweep_shard(channel_type_id, shard_index):
+    """
+    Run malfunction detection for the channels in one shard of a channel type that are due a
+    check. If the shard's previous sweep is still running (in this or any process sharing the
+    cache), this one is skipped.
+
+    Returns: the malfunctions, as returned by get_all_channel_malfunctions, or None if skipped
+    """
+    lock_key = SWEEP_LOCK_KEY.format(channel_type_id, shard_index)
+    if not cache.add(lock_key, True, timeout=SWEEP_LOCK_TIMEOUT_SECONDS):
+        print('[sweep_shard] Shard {} of channel type {} is still being swept, skipping'.format(
+            shard_index, channel_type_id))
+        return None
+
+    with renewing_cache_locks([lock_key], SWEEP_LOCK_TIMEOUT_SECONDS):
+        channel_type = ChannelType.objects.get(id=channel_type_id)
+        channels = get_due_channels(get_shard_channels(channel_type, shard_index))
+        if not channels.exists():
+            return []
+        return get_all_channel_malfunctions(channels=channels)
+
+
+def get_sweep_schedule():
+    """
+    One sweep per shard of every channel type. A type's shards are spread evenly over its
+    interval, and different types' shards are offset from each other so they don't line up.
+
+    Returns: dict {job id: dict of the sweep's channel_type_id, shard_index, interval_minutes
+        and offset_seconds from the start of the day}
+    """
+    channel_types = list(ChannelType.objects.order_by('id'))
+    schedule = {}
+    for type_index, channel_type in enumerate(channel_types):
+        shard_count = max(1, channel_type.sweep_shard_count)
+        interval_minutes = max(1, channel_type.sweep_interval_minutes)
+        shard_seconds = interval_minutes * 60.0 / shard_count
+        for shard_index in range(shard_count):
+            offset_seconds = (shard_index + type_index / len(channel_types)) * shard_seconds
+            schedule['sweep-{}-{}'.format(channel_type.id, shard_index)] = {
+                'channel_type_id': channel_type.id,
+                'shard_index': shard_index,
+                'interval_minutes': interval_minutes,
+                'offset_seconds': int(offset_seconds),
+            }
+    return schedule
+
+
+def schedule_sweeps(scheduler, scheduled_sweeps):
+    """
+    Bring the scheduler's sweep jobs in line with get_sweep_schedule, given the schedule that's
+    currently set up (an empty dict the first time). Jobs whose settings haven't changed are left
+    alone, so their next run time isn't reset.
+
+    Each shard's runs are anchored to the start of the day (UTC), so the stagger survives
+    restarts, and a shard is never run again while its previous run is going.
+
+    Returns: the new schedule, to pass back in next time
+    """
+    schedule = get_sweep_schedule()
+    for job_id in set(scheduled_sweeps) - set(schedule):
+        scheduler.remove_job(job_id)
+
+    start_of_day = datetime.now(pytz.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    for job_id, sweep in schedule.items():
+        if scheduled_sweeps.get(job_id) == sweep:
+            continue
+        scheduler.add_job(
+            sweep_shard,
+            'interval',
+            args=[sweep['channel_type_id'], sweep['shard_index']],
+            minutes=sweep['interval_minutes'],
+            start_date=start_of_day + timedelta(seconds=sweep['offset_seconds']),
+            id=job_id,
+            replace_existing=True,
+            max_instances=1,
+            coalesce=True,
+        )
+    return schedule
@@ -3,7 +3,11 @@ import mock
 from datetime import datetime
 from django.test import TestCase
 
-from airqo_monitor.malfunction_detection import AirqoMalfunctionDetector
+from airqo_monitor.malfunction_detection import (
+    AirqoMalfunctionDetector,
+    MalfunctionThresholds,
+)
+from airqo_monitor.objects.channel_data import ChannelData
 from airqo_monitor.tests.utils import create_malfunction_global_vars
 from airqo_monitor.utils import get_float_global_var_value
 
@@ -124,3 +128,31 @@ class TestAirqoMalfunctionDetector(TestCase):
 
         self.sample_channel_data[0]['pm_2_5'] = str(get_float_global_var_value('AIRQO_SENSOR_PM_2_5_MAX_CUTOFF') + 0.1)
         assert detector._sensor_is_reporting_outliers(self.sample_channel_data) == True
+
+    def test_get_malfunctions_with_shared_thresholds_makes_no_queries(self):
+        create_malfunction_global_vars()
+        with self.assertNumQueries(1):
+            thresholds = MalfunctionThresholds.load()
+
+        channel_data = ChannelData.from_entries([
+            dict(battery_voltage=u'4.50', created_at=u'2018-10-22T09:00:52Z', entry_id=1, pm_2_5=u'1.80'),
+            dict(battery_voltage=u'4.50', created_at=u'2018-10-22T09:01:52Z', entry_id=2, pm_2_5=u'1.90'),
+        ])
+        detector = AirqoMalfunctionDetector(thresholds)
+        with self.assertNumQueries(0):
+            malfunctions = detector.get_malfunctions(channel_data)
+
+        assert malfunctions == ['low_reporting_frequency']
+
+    def test_sensor_is_reporting_outliers_only_checks_latest_reports(self):
+        create_malfunction_global_vars()
+        detector = AirqoMalfunctionDetector()
+
+        # 10 normal readings after 5 outliers: only the last 10 reports are verified
+        entry = dict(created_at=u'2018-10-22T09:00:52Z', entry_id=1)
+        channel_data = [dict(entry, pm_2_5=u'5000.0') for _ in range(5)]
+        channel_data += [dict(entry, pm_2_5=u'10.0') for _ in range(10)]
+        assert detector._sensor_is_reporting_outliers(channel_data) == False
+
+        channel_data[-3:] = [dict(entry, pm_2_5=u'0.0') for _ in range(3)]
+        assert detector._sensor_is_reporting_outliers(ChannelData.from_entries(channel_data)) == True
@@ -0,0 +1,76 @@
+import json
+
+from datetime import datetime, timedelta
+from django.test import TestCase
+
+from airqo_monitor.malfunction_detection.detection_state import update_next_check
+from airqo_monitor.models import Channel, ChannelDetectionState, ChannelType
+from airqo_monitor.objects.channel_data import ChannelData
+
+
+def make_data(pm_2_5_values):
+    return ChannelData.from_entries([
+        {'entry_id': entry_id, 'created_at': '2018-11-01T10:{:02d}:00Z'.format(entry_id), 'pm_2_5': pm_2_5}
+        for entry_id, pm_2_5 in enumerate(pm_2_5_values)
+    ])
+
+
+class TestUpdateNextCheck(TestCase):
+
+    def setUp(self):
+        channel_type = ChannelType.objects.create(name='airqo', data_format_json=json.dumps({}))
+        channel = Channel.objects.create(channel_id=1, name='channel', channel_type=channel_type)
+        self.state = ChannelDetectionState(channel=channel, check_interval_seconds=60 * 60)
+        self.now = datetime(2018, 11, 1, 12)
+
+    def test_malfunctioning_channels_are_checked_as_often_as_possible(self):
+        update_next_check(self.state, 10, make_data([30, 31, 29]), ['low_battery_voltage'], now=self.now)
+
+        assert self.state.check_interval_seconds == 15 * 60
+        assert self.state.next_check_at == self.now + timedelta(minutes=15)
+
+    def test_volatile_channels_are_checked_more_often(self):
+        update_next_check(self.state, 10, make_data([5, 80, 10, 120]), [], now=self.now)
+        assert self.state.check_interval_seconds == 30 * 60
+
+        update_next_check(self.state, 10, make_data([5, 80, 10, 120]), [], now=self.now)
+        update_next_check(self.state, 10, make_data([5, 80, 10, 120]), [], now=self.now)
+        assert self.state.check_interval_seconds == 15 * 60
+
+    def test_stable_and_quiet_channels_are_checked_less_often(self):
+        update_next_check(self.state, 10, make_data([30, 31, 29]), [], now=self.now)
+        assert self.state.check_interval_seconds == 2 * 60 * 60
+
+        # A channel with no new entries but nothing wrong with its recent ones backs off too
+        update_next_check(self.state, 0, make_data([30, 31, 29]), [], now=self.now)
+        assert self.state.check_interval_seconds == 4 * 60 * 60
+
+        update_next_check(self.state, 0, make_data([30, 31, 29]), [], now=self.now)
+        update_next_check(self.state, 0, make_data([30, 31, 29]), [], now=self.now)
+        assert self.state.check_interval_seconds == 6 * 60 * 60
+        assert self.state.next_check_at == self.now + timedelta(hours=6)
+
+    def test_channels_that_stopped_reporting_are_checked_as_often_as_possible(self):
+        self.state.check_interval_seconds = 6 * 60 * 60
+
+        update_next_check(self.state, 0, make_data([]), ['no_data'], now=self.now)
+
+        assert self.state.check_interval_seconds == 15 * 60
+
+    def test_inactive_channels_are_checked_as_rarely_as_possible(self):
+        self.state.channel.name = 'channel INACTIVE'
+        update_next_check(self.state, 0, make_data([]), ['no_data'], now=self.now)
+        assert self.state.check_interval_seconds == 6 * 60 * 60
+
+        self.state.channel.name = 'channel'
+        self.state.channel.is_active = False
+        self.state.check_interval_seconds = 15 * 60
+        update_next_check(self.state, 10, make_data([5, 80, 10, 120]), [], now=self.now)
+        assert self.state.check_interval_seconds == 6 * 60 * 60
+
+    def test_new_channels_start_from_the_default_interval(self):
+        self.state.check_interval_seconds = None
+
+        update_next_check(self.state, 10, make_data([30, 31, 29]), [], now=self.now)
+
+        assert self.state.check_interval_seconds == 2 * 60 * 60
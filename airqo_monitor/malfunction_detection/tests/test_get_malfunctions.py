@@ -2,27 +2,38 @@ import json
 import mock
 
 from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from airqo_monitor.caching import CacheLockTimeout
 from airqo_monitor.constants import (
     THINGSPEAK_CHANNELS_LIST_URL,
     THINGSPEAK_FEEDS_LIST_URL,
     LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME,
+    SWEEP_LOCK_KEY,
 )
+from airqo_monitor.objects.channel_data import ChannelData
 from airqo_monitor.objects.data_entry import DataEntry
+from airqo_monitor.malfunction_detection import MalfunctionThresholds
 from airqo_monitor.malfunction_detection.get_malfunctions import (
     _get_channel_malfunctions,
+    _get_malfunctions_for_channels,
     get_all_channel_malfunctions,
+    get_cached_malfunctions_with_age,
     update_db,
 )
 from airqo_monitor.models import (
     Channel,
+    ChannelDetectionState,
     ChannelType,
     GlobalVariable,
     Incident,
     MalfunctionReason,
 )
 from airqo_monitor.tests.utils import create_malfunction_global_vars
+from airqo_monitor.utils import clear_global_var_cache
 
 class TestGetMalfunctions(TestCase):
 
@@ -97,6 +108,7 @@ class TestGetMalfunctions(TestCase):
     @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions._get_channel_malfunctions')
     @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.get_and_format_data_for_all_channels')
     def test_get_all_channel_malfunctions(self, get_and_format_data_for_all_channels_mocker, _get_channel_malfunctions_mocker, update_db_mocker):
+        cache.clear()
         update_db_mocker.return_value = None
         channel1 = Channel.objects.create(channel_id=5555, name='channel5555', channel_type=self.channel_type)
         get_and_format_data_for_all_channels_mocker.return_value =  {
@@ -111,6 +123,165 @@ class TestGetMalfunctions(TestCase):
                 'possible_malfunction_reasons': ['reporting_outliers'],
             }
         ]
+        # Only the soil detector's needs count, since there are no other channels
+        assert get_and_format_data_for_all_channels_mocker.call_args[1]['num_recent_entries'] == 1
+        # The endpoint serves the latest full sweep from the cache
+        assert get_cached_malfunctions_with_age()[0] == all_channel_malfunctions
+
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.update_db')
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.get_and_format_data_for_all_channels')
+    def test_get_all_channel_malfunctions_syncs_whole_windows_without_thresholds(
+            self, get_and_format_data_for_all_channels_mocker, update_db_mocker):
+        clear_global_var_cache()
+        airqo_channel_type = ChannelType.objects.create(name='airqo', data_format_json=json.dumps({}))
+        Channel.objects.create(channel_id=5555, name='channel5555', channel_type=airqo_channel_type)
+        get_and_format_data_for_all_channels_mocker.return_value = {}
+
+        assert get_all_channel_malfunctions() == []
+        assert get_and_format_data_for_all_channels_mocker.call_args[1]['num_recent_entries'] is None
+
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.update_db')
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.get_and_format_data_for_all_channels')
+    def test_get_all_channel_malfunctions_only_reads_new_entries(self, get_and_format_data_for_all_channels_mocker,
+                                                                 update_db_mocker):
+        create_malfunction_global_vars()
+        clear_global_var_cache()
+        airqo_channel_type = ChannelType.objects.create(name='airqo', data_format_json=json.dumps({}))
+        channel = Channel.objects.create(channel_id=5555, name='channel5555', channel_type=airqo_channel_type)
+
+        now = datetime.utcnow()
+        def make_entries(first_entry_id, battery_voltage):
+            return [
+                dict(
+                    entry_id=entry_id,
+                    created_at=datetime.strftime(now - timedelta(minutes=24 - entry_id), '%Y-%m-%dT%H:%M:%SZ'),
+                    battery_voltage=battery_voltage,
+                    pm_2_5='20.0',
+                    pm_10='30.0',
+                )
+                for entry_id in range(first_entry_id, first_entry_id + 12)
+            ]
+
+        first_entries = make_entries(1, '4.5')
+        get_and_format_data_for_all_channels_mocker.return_value = {5555: {'channel': channel, 'data': first_entries}}
+        channels = get_all_channel_malfunctions()
+        assert channels[0]['possible_malfunction_reasons'] == []
+        assert get_and_format_data_for_all_channels_mocker.call_args[1]['after_entry_ids'] == {}
+        # Only the fields the detectors read are loaded, and remembered
+        assert get_and_format_data_for_all_channels_mocker.call_args[1]['field_names'] == ['battery_voltage', 'pm_2_5']
+        # And only as many of the newest entries as they look at, for channels that haven't been synced
+        assert get_and_format_data_for_all_channels_mocker.call_args[1]['num_recent_entries'] == 10
+
+        state = ChannelDetectionState.objects.get(channel=channel)
+        assert state.last_entry_id == 12
+        assert len(state.recent_entries) == 10
+        assert 'pm_10' not in state.recent_entries[0]
+        assert state.check_interval_seconds == 2 * 60 * 60
+
+        # The next run asks for the entries after the last one it saw, and remembers the rest
+        new_entries = make_entries(13, '3.0')
+        get_and_format_data_for_all_channels_mocker.return_value = {5555: {'channel': channel, 'data': new_entries}}
+        channels = get_all_channel_malfunctions()
+        assert get_and_format_data_for_all_channels_mocker.call_args[1]['after_entry_ids'] == {5555: 12}
+
+        # Which gives the same result as checking the whole window
+        whole_window_malfunctions = _get_channel_malfunctions(first_entries + new_entries, channel_type='airqo')
+        assert channels[0]['possible_malfunction_reasons'] == whole_window_malfunctions
+        assert 'low_battery_voltage' in whole_window_malfunctions
+
+        state = ChannelDetectionState.objects.get(channel=channel)
+        assert state.last_entry_id == 24
+        assert [entry['entry_id'] for entry in state.recent_entries] == list(range(15, 25))
+        # It's malfunctioning now, so it's checked again as soon as possible
+        assert state.check_interval_seconds == 15 * 60
+
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.time.sleep')
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.update_db')
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.get_and_format_data_for_all_channels')
+    def test_get_all_channel_malfunctions_waits_for_shard_sweeps(self, get_and_format_data_for_all_channels_mocker,
+                                                                 update_db_mocker, sleep_mocker):
+        cache.clear()
+        ChannelType.objects.filter(id=self.channel_type.id).update(sweep_shard_count=2)
+        get_and_format_data_for_all_channels_mocker.return_value = {}
+        shard_lock_keys = [SWEEP_LOCK_KEY.format(self.channel_type.id, shard_index) for shard_index in range(2)]
+
+        def sweep_shards_during_sweep(**kwargs):
+            # Shard sweeps that start while every channel is being swept are skipped
+            assert all(not cache.add(lock_key, True) for lock_key in shard_lock_keys)
+            return {}
+        get_and_format_data_for_all_channels_mocker.side_effect = sweep_shards_during_sweep
+
+        # A shard sweep is running, and finishes while the full sweep waits for it
+        cache.add(shard_lock_keys[1], True)
+        sleep_mocker.side_effect = lambda seconds: cache.delete(shard_lock_keys[1])
+
+        assert get_all_channel_malfunctions(lock_wait_seconds=60) == []
+
+        assert sleep_mocker.call_count == 1
+        assert get_and_format_data_for_all_channels_mocker.called
+        assert all(cache.get(lock_key) is None for lock_key in shard_lock_keys)
+
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.get_and_format_data_for_all_channels')
+    def test_get_all_channel_malfunctions_fails_fast_while_a_shard_is_swept(self,
+                                                                          get_and_format_data_for_all_channels_mocker):
+        cache.clear()
+        ChannelType.objects.filter(id=self.channel_type.id).update(sweep_shard_count=2)
+        shard_lock_keys = [SWEEP_LOCK_KEY.format(self.channel_type.id, shard_index) for shard_index in range(2)]
+        cache.add(shard_lock_keys[1], True)
+
+        with self.assertRaises(CacheLockTimeout):
+            get_all_channel_malfunctions()
+
+        assert not get_and_format_data_for_all_channels_mocker.called
+        # The running shard sweep keeps its lock, and the full sweep doesn't hold on to the other
+        assert cache.get(shard_lock_keys[1])
+        assert cache.get(shard_lock_keys[0]) is None
+
+    def test_get_malfunctions_for_channels_in_process_pool_keeps_order(self):
+        create_malfunction_global_vars()
+        clear_global_var_cache()
+        thresholds = MalfunctionThresholds.load()
+
+        now = datetime.utcnow()
+        detection_inputs = []
+        for i in range(7):
+            channel_data = ChannelData.from_entries([
+                dict(
+                    entry_id=entry_id,
+                    created_at=datetime.strftime(now - timedelta(minutes=12 - entry_id), '%Y-%m-%dT%H:%M:%SZ'),
+                    battery_voltage='3.0' if i % 2 else '4.5',
+                    pm_2_5='2000.0' if i % 3 else '20.0',
+                )
+                for entry_id in range(12)
+            ])
+            detection_inputs.append((channel_data, 'airqo', thresholds))
+        detection_inputs.append((ChannelData.from_entries([]), 'soil', thresholds))
+
+        serial_malfunctions = _get_malfunctions_for_channels(detection_inputs, max_processes=1)
+        pool_malfunctions = _get_malfunctions_for_channels(detection_inputs, max_processes=2, min_channels=0)
+
+        assert pool_malfunctions == serial_malfunctions
+        assert serial_malfunctions[0] == []
+        assert serial_malfunctions[1] == ['low_battery_voltage', 'reporting_outliers']
+        assert serial_malfunctions[-1] == ['no_data']
+
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.ProcessPoolExecutor')
+    def test_get_malfunctions_for_channels_falls_back_to_serial(self, process_pool_executor_mocker):
+        process_pool_executor_mocker.side_effect = OSError('Cannot fork')
+        detection_inputs = [(ChannelData.from_entries([]), 'soil', None)] * 3
+
+        malfunctions = _get_malfunctions_for_channels(detection_inputs, max_processes=2, min_channels=0)
+
+        assert malfunctions == [['no_data']] * 3
+
+    @mock.patch('airqo_monitor.malfunction_detection.get_malfunctions.ProcessPoolExecutor')
+    def test_get_malfunctions_for_channels_spawns_workers(self, process_pool_executor_mocker):
+        process_pool_executor_mocker.side_effect = OSError('Cannot spawn')
+        detection_inputs = [(ChannelData.from_entries([]), 'soil', None)] * 3
+
+        assert _get_malfunctions_for_channels(detection_inputs, max_processes=2, min_channels=0) == [['no_data']] * 3
+        # Rather than forking a process whose other threads hold DB connections
+        assert process_pool_executor_mocker.call_args[1]['mp_context'].get_start_method() == 'spawn'
 
     def test_update_db_creates_incidents(self):
         reason = MalfunctionReason.objects.create(name='reason', description='Reason')
@@ -144,3 +315,33 @@ class TestGetMalfunctions(TestCase):
 
         incident = Incident.objects.get(id=incident.id)
         assert incident.resolved_at is not None
+
+    def test_update_db_keeps_ongoing_incidents(self):
+        reason = MalfunctionReason.objects.create(name='reason', description='Reason')
+        other_reason = MalfunctionReason.objects.create(name='other_reason', description='Other Reason')
+        channel = Channel.objects.create(channel_id='4321', name='Test Channel', channel_type=self.channel_type)
+        ongoing_incident = Incident.objects.create(channel=channel, malfunction_reason=reason)
+        stale_incident = Incident.objects.create(channel=channel, malfunction_reason=other_reason)
+
+        update_db([{'channel_id': '4321', 'possible_malfunction_reasons': ['reason']}])
+
+        assert Incident.objects.filter(channel=channel).count() == 2
+        assert Incident.objects.get(id=ongoing_incident.id).resolved_at is None
+        assert Incident.objects.get(id=stale_incident.id).resolved_at is not None
+
+    def test_update_db_query_count_does_not_grow_with_channels(self):
+        MalfunctionReason.objects.create(name='reason', description='Reason')
+        MalfunctionReason.objects.create(name='other_reason', description='Other Reason')
+
+        def count_update_db_queries(channel_ids):
+            channels = []
+            for channel_id in channel_ids:
+                Channel.objects.create(channel_id=channel_id, name='Test Channel', channel_type=self.channel_type)
+                channels.append({'channel_id': channel_id, 'possible_malfunction_reasons': ['reason', 'other_reason']})
+
+            with CaptureQueriesContext(connection) as context:
+                update_db(channels)
+            return len(context.captured_queries)
+
+        assert count_update_db_queries([1, 2]) == count_update_db_queries(range(10, 30))
+        assert Incident.objects.filter(resolved_at__isnull=True).count() == 44
@@ -0,0 +1,135 @@
+import json
+import mock
+
+from datetime import timedelta
+from apscheduler.schedulers.background import BackgroundScheduler
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from airqo_monitor.malfunction_detection.detection_state import load_detection_states
+from airqo_monitor.malfunction_detection.sweeps import (
+    get_shard_channels,
+    get_sweep_schedule,
+    schedule_sweeps,
+    sweep_shard,
+)
+from airqo_monitor.models import Channel, ChannelDetectionState, ChannelType
+
+
+class TestSweeps(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.channel_type = ChannelType.objects.create(
+            name='airqo',
+            data_format_json=json.dumps({}),
+            sweep_shard_count=3,
+            sweep_interval_minutes=30,
+        )
+        for channel_id in range(1, 10):
+            Channel.objects.create(channel_id=channel_id, name='channel', channel_type=self.channel_type)
+        Channel.objects.filter(channel_id=4).update(is_active=False)
+
+    def test_get_shard_channels(self):
+        shards = [
+            sorted(get_shard_channels(self.channel_type, shard_index).values_list('channel_id', flat=True))
+            for shard_index in range(3)
+        ]
+        assert shards == [[3, 6, 9], [1, 7], [2, 5, 8]]
+
+        self.channel_type.sweep_shard_count = 1
+        assert get_shard_channels(self.channel_type, 0).count() == 8
+
+    @mock.patch('airqo_monitor.malfunction_detection.sweeps.get_all_channel_malfunctions')
+    def test_sweep_shard(self, get_all_channel_malfunctions_mocker):
+        get_all_channel_malfunctions_mocker.return_value = []
+
+        assert sweep_shard(self.channel_type.id, 1) == []
+
+        channels = get_all_channel_malfunctions_mocker.call_args[1]['channels']
+        assert sorted(channels.values_list('channel_id', flat=True)) == [1, 7]
+
+    @mock.patch('airqo_monitor.malfunction_detection.sweeps.get_all_channel_malfunctions')
+    def test_sweep_shard_only_checks_due_channels(self, get_all_channel_malfunctions_mocker):
+        get_all_channel_malfunctions_mocker.return_value = []
+        ChannelDetectionState.objects.create(
+            channel=Channel.objects.get(channel_id=1),
+            next_check_at=timezone.now() + timedelta(hours=1),
+        )
+
+        sweep_shard(self.channel_type.id, 1)
+        channels = get_all_channel_malfunctions_mocker.call_args[1]['channels']
+        assert list(channels.values_list('channel_id', flat=True)) == [7]
+
+        # Nothing to do when none are due
+        ChannelDetectionState.objects.create(
+            channel=Channel.objects.get(channel_id=7),
+            next_check_at=timezone.now() + timedelta(hours=1),
+        )
+        get_all_channel_malfunctions_mocker.reset_mock()
+        assert sweep_shard(self.channel_type.id, 1) == []
+        assert not get_all_channel_malfunctions_mocker.called
+
+    @mock.patch('airqo_monitor.malfunction_detection.sweeps.get_all_channel_malfunctions')
+    def test_sweep_shard_skips_a_shard_that_is_still_running(self, get_all_channel_malfunctions_mocker):
+        def sweep_again(channels):
+            # The scheduler firing the same shard again while it's running
+            assert sweep_shard(self.channel_type.id, 1) is None
+            return []
+        get_all_channel_malfunctions_mocker.side_effect = sweep_again
+
+        assert sweep_shard(self.channel_type.id, 1) == []
+        assert get_all_channel_malfunctions_mocker.call_count == 1
+
+        get_all_channel_malfunctions_mocker.side_effect = None
+        get_all_channel_malfunctions_mocker.return_value = []
+        # Other shards, and the same one once it's done, aren't affected
+        assert sweep_shard(self.channel_type.id, 2) == []
+        assert sweep_shard(self.channel_type.id, 1) == []
+
+    def test_shard_sweeps_only_load_their_channels_detection_states(self):
+        for channel in Channel.objects.all():
+            ChannelDetectionState.objects.create(channel=channel)
+
+        states = load_detection_states(get_shard_channels(self.channel_type, 1))
+
+        assert sorted(states) == [1, 7]
+
+    def test_get_sweep_schedule(self):
+        soil_channel_type = ChannelType.objects.create(name='soil', data_format_json=json.dumps({}))
+
+        schedule = get_sweep_schedule()
+
+        airqo_offsets = [
+            schedule['sweep-{}-{}'.format(self.channel_type.id, shard_index)]['offset_seconds']
+            for shard_index in range(3)
+        ]
+        assert airqo_offsets == [0, 600, 1200]
+        assert schedule['sweep-{}-0'.format(soil_channel_type.id)] == {
+            'channel_type_id': soil_channel_type.id,
+            'shard_index': 0,
+            'interval_minutes': 15,
+            'offset_seconds': 450,
+        }
+
+    def test_schedule_sweeps(self):
+        scheduler = BackgroundScheduler()
+        scheduler.start(paused=True)
+        self.addCleanup(scheduler.shutdown)
+
+        scheduled_sweeps = schedule_sweeps(scheduler, {})
+        job_ids = sorted(job.id for job in scheduler.get_jobs())
+        assert job_ids == ['sweep-{}-{}'.format(self.channel_type.id, shard_index) for shard_index in range(3)]
+        job = scheduler.get_job(job_ids[0])
+        assert job.max_instances == 1
+        assert job.args == (self.channel_type.id, 0)
+
+        # Unchanged sweeps are left alone and removed shards are unscheduled
+        with mock.patch.object(scheduler, 'add_job') as add_job_mocker:
+            schedule_sweeps(scheduler, scheduled_sweeps)
+        assert not add_job_mocker.called
+
+        ChannelType.objects.filter(id=self.channel_type.id).update(sweep_shard_count=2)
+        schedule_sweeps(scheduler, scheduled_sweeps)
+        assert len(scheduler.get_jobs()) == 2
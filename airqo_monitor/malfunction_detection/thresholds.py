@@ -0,0 +1,41 @@
+from airqo_monitor.models import GlobalVariable
+from airqo_monitor.utils import get_global_var_values
+
+MALFUNCTION_THRESHOLD_KEYS = [
+    'LOW_BATTERY_CUTOFF',
+    'AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION',
+    'AIRQO_SENSOR_PM_2_5_MIN_CUTOFF',
+    'AIRQO_SENSOR_PM_2_5_MAX_CUTOFF',
+    'AIRQO_ALLOWABLE_OUTLIER_SENSOR_RATIO',
+    'AIRQO_NUM_REPORTS_TO_VERIFY_REPORTING_MALFUNCTION',
+    'AIRQO_MAXIMUM_AVERAGE_SECONDS_BETWEEN_REPORTS',
+]
+
+
+class MalfunctionThresholds(object):
+    """
+    The GlobalVariable cutoffs used by the malfunction detectors, read together (from the cached
+    GlobalVariable values) so a detection run can share them across every channel instead of
+    looking them up per reading.
+
+    A missing variable only raises GlobalVariable.DoesNotExist when a detector asks for it.
+    """
+
+    def __init__(self, values):
+        self.values = values
+
+    @classmethod
+    def load(cls):
+        values = get_global_var_values()
+        return cls({key: values[key] for key in MALFUNCTION_THRESHOLD_KEYS if key in values})
+
+    def _get_value(self, key):
+        if key not in self.values:
+            raise GlobalVariable.DoesNotExist('GlobalVariable {} does not exist.'.format(key))
+        return self.values[key]
+
+    def get_int(self, key):
+        return int(self._get_value(key))
+
+    def get_float(self, key):
+        return float(self._get_value(key))
@@ -0,0 +1,37 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from airqo_monitor.benchmark.pipeline import format_results, run_pipeline_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Benchmarks each stage of a malfunction detection sweep against a local fake Thingspeak server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--channels', type=int, default=10, help='Number of synthetic channels')
+        parser.add_argument('--report-interval', type=int, default=60, help='Seconds between each channel\'s reports')
+        parser.add_argument('--hours', type=int, default=24, help='Hours of data each channel has')
+        parser.add_argument('--private-channels', type=int, default=0, help='How many of the channels need a read key')
+        parser.add_argument('--latency', type=float, default=0, help='Seconds the fake server waits before every response')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests the fake server fails with a 503')
+        parser.add_argument('--rate-limit', action='store_true', help='Apply the Thingspeak client\'s rate limit to the fake server')
+        parser.add_argument('--no-memory', action='store_true', help='Skip tracking peak memory, which slows the stages down')
+        parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+
+    def handle(self, *args, **options):
+        results = run_pipeline_benchmark(
+            num_channels=options['channels'],
+            report_interval_seconds=options['report_interval'],
+            duration_hours=options['hours'],
+            trace_memory=not options['no_memory'],
+            rate_limit=options['rate_limit'],
+            num_private_channels=options['private_channels'],
+            latency_seconds=options['latency'],
+            error_rate=options['error_rate'],
+        )
+
+        if options['json']:
+            print(json.dumps([result.to_dict() for result in results], indent=2))
+        else:
+            print(format_results(results))
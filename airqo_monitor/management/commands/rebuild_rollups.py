@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from airqo_monitor.models import Channel
+from airqo_monitor.rollups import rebuild_rollups_for_channel
+
+
+class Command(BaseCommand):
+    help = 'Recomputes the hourly and daily rollups from the locally stored feed entries'
+
+    def add_arguments(self, parser):
+        parser.add_argument('channel_ids', nargs='*', type=int)
+
+    def handle(self, *args, **options):
+        channels = Channel.objects.select_related('channel_type')
+        if options['channel_ids']:
+            channels = channels.filter(channel_id__in=options['channel_ids'])
+
+        for channel in channels:
+            rebuild_rollups_for_channel(channel)
+            print('Rebuilt rollups for channel {}'.format(channel))
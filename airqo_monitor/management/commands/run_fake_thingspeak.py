@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from airqo_monitor.benchmark.fake_thingspeak import FakeThingspeakServer
+
+
+class Command(BaseCommand):
+    help = 'Runs a local stand-in for the Thingspeak API with synthetic channels, for load testing and offline development'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--channels', type=int, default=1000, help='Number of synthetic airqo channels')
+        parser.add_argument('--soil-channels', type=int, default=0, help='Number of synthetic soil channels')
+        parser.add_argument('--private-channels', type=int, default=0, help='How many of the channels need a read key')
+        parser.add_argument('--user-api-key', default=None, help='Key the channel list requires, if any')
+        parser.add_argument('--report-interval', type=int, default=60, help='Seconds between each channel\'s reports')
+        parser.add_argument('--hours', type=int, default=24, help='Hours of data each channel has')
+        parser.add_argument('--latency', type=float, default=0, help='Seconds to wait before every response')
+        parser.add_argument('--latency-jitter', type=float, default=0, help='Up to this many extra seconds per response')
+        parser.add_argument('--error-rate', type=float, default=0, help='Fraction of requests that fail with a 503')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        server = FakeThingspeakServer(
+            num_channels=options['channels'],
+            report_interval_seconds=options['report_interval'],
+            duration_hours=options['hours'],
+            num_soil_channels=options['soil_channels'],
+            num_private_channels=options['private_channels'],
+            user_api_key=options['user_api_key'],
+            latency_seconds=options['latency'],
+            latency_jitter_seconds=options['latency_jitter'],
+            error_rate=options['error_rate'],
+            seed=options['seed'],
+            port=options['port'],
+        )
+
+        with server:
+            print('Fake Thingspeak server running at {}. Point the app at it with:'.format(server.url))
+            print('export THINGSPEAK_FEEDS_LIST_URL="{}"'.format(server.feeds_list_url))
+            print('export THINGSPEAK_CHANNELS_LIST_URL="{}"'.format(server.channels_list_url))
+            for name, value in sorted(server.get_environ().items()):
+                print('export {}="{}"'.format(name, value))
+
+            try:
+                while True:
+                    time.sleep(60)
+                    print('{} requests served ({} failed), {} bytes'.format(
+                        server.num_requests,
+                        server.num_errors,
+                        server.bytes_sent,
+                    ))
+            except KeyboardInterrupt:
+                pass
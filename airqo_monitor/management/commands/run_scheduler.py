@@ -1,7 +1,12 @@
 from apscheduler.schedulers.blocking import BlockingScheduler
 from django.core.management.base import BaseCommand, CommandError
 
-from airqo_monitor.malfunction_detection.get_malfunctions import get_all_channel_malfunctions
+from airqo_monitor.constants import JOB_POLL_INTERVAL_SECONDS, SWEEP_SCHEDULE_REFRESH_MINUTES
+from airqo_monitor.external.usage import prune_usage
+from airqo_monitor.feed_store import prune_feed_entries
+from airqo_monitor.jobs import run_pending_jobs
+from airqo_monitor.malfunction_detection.sweeps import schedule_sweeps
+from airqo_monitor.rollups import prune_rollups
 
 
 class Command(BaseCommand):
@@ -11,9 +16,25 @@ class Command(BaseCommand):
         sched = BlockingScheduler()
 
         @sched.scheduled_job('cron', hour='*')
-        def update_channel_data():
+        def prune_old_data():
             print('Running scheduled tasks...')
-            get_all_channel_malfunctions()
+            prune_feed_entries()
+            prune_rollups()
+            prune_usage()
             print('Scheduled tasks complete.')
 
+        @sched.scheduled_job('interval', seconds=JOB_POLL_INTERVAL_SECONDS, max_instances=1, coalesce=True)
+        def run_jobs():
+            run_pending_jobs()
+
+        # Malfunction sweeps run per shard of each channel type, spread over their intervals.
+        # The schedule is re-read regularly to pick up changes to the channel types.
+        scheduled_sweeps = schedule_sweeps(sched, {})
+
+        @sched.scheduled_job('interval', minutes=SWEEP_SCHEDULE_REFRESH_MINUTES, max_instances=1)
+        def refresh_sweep_schedule():
+            new_schedule = schedule_sweeps(sched, scheduled_sweeps)
+            scheduled_sweeps.clear()
+            scheduled_sweeps.update(new_schedule)
+
         sched.start()
@@ -0,0 +1,51 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0012_auto_20181107_1223'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channel',
+            name='feed_last_entry_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='feed_last_entry_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='channel',
+            name='feed_synced_from',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.CreateModel(
+            name='FeedEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('entry_id', models.IntegerField()),
+                ('created_at', models.DateTimeField(help_text="Thingspeak's timestamp for the entry")),
+                ('field1', models.TextField(null=True)),
+                ('field2', models.TextField(null=True)),
+                ('field3', models.TextField(null=True)),
+                ('field4', models.TextField(null=True)),
+                ('field5', models.TextField(null=True)),
+                ('field6', models.TextField(null=True)),
+                ('field7', models.TextField(null=True)),
+                ('field8', models.TextField(null=True)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='airqo_monitor.Channel')),
+            ],
+            options={
+                'db_table': 'feed_entry',
+                'indexes': [models.Index(fields=['channel', 'created_at'], name='feed_entry_channel_dad8ef_idx')],
+                'unique_together': {('channel', 'entry_id')},
+            },
+        ),
+    ]
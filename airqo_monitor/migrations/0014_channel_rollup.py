@@ -0,0 +1,32 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0013_feed_entry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('hour', 'Hourly'), ('day', 'Daily')], max_length=8)),
+                ('field', models.CharField(help_text="Descriptive field name from the channel type's data format, e.g. pm_2_5", max_length=64)),
+                ('bucket_start', models.DateTimeField()),
+                ('count', models.IntegerField(default=0)),
+                ('sum', models.FloatField(default=0)),
+                ('min', models.FloatField(null=True)),
+                ('max', models.FloatField(null=True)),
+                ('channel', models.ForeignKey(on_delete=django.db.models.deletion.DO_NOTHING, to='airqo_monitor.Channel')),
+            ],
+            options={
+                'db_table': 'channel_rollup',
+                'unique_together': {('channel', 'resolution', 'field', 'bucket_start')},
+            },
+        ),
+    ]
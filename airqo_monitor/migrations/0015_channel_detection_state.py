@@ -0,0 +1,28 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:23
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0014_channel_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelDetectionState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_entry_id', models.IntegerField(null=True)),
+                ('last_report_at', models.DateTimeField(null=True)),
+                ('recent_entries_json', models.TextField(default='[]')),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('channel', models.OneToOneField(on_delete=django.db.models.deletion.DO_NOTHING, to='airqo_monitor.Channel')),
+            ],
+            options={
+                'db_table': 'channel_detection_state',
+            },
+        ),
+    ]
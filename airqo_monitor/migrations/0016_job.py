@@ -0,0 +1,31 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0015_channel_detection_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Job',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('malfunction_sweep', 'Malfunction sweep')], max_length=32)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('succeeded', 'Succeeded'), ('failed', 'Failed')], default='queued', max_length=16)),
+                ('created_at', models.DateTimeField(auto_now_add=True, verbose_name='date created')),
+                ('started_at', models.DateTimeField(null=True)),
+                ('finished_at', models.DateTimeField(null=True)),
+                ('stage', models.CharField(max_length=32, null=True)),
+                ('channel_progress_json', models.TextField(default='{}')),
+                ('error', models.TextField(null=True)),
+            ],
+            options={
+                'db_table': 'job',
+                'indexes': [models.Index(fields=['kind', 'status'], name='job_kind_0444bb_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0016_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channeltype',
+            name='sweep_interval_minutes',
+            field=models.PositiveIntegerField(default=60),
+        ),
+        migrations.AddField(
+            model_name='channeltype',
+            name='sweep_shard_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
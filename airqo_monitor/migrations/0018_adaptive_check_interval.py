@@ -0,0 +1,36 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:37
+
+from django.db import migrations, models
+
+
+def sweep_every_15_minutes(apps, schema_editor):
+    # Sweeps only check the channels that are due now, so they need to run often enough for the
+    # shortest check interval. Channel types still on the old hourly default are moved to the new one.
+    ChannelType = apps.get_model('airqo_monitor', 'ChannelType')
+    ChannelType.objects.filter(sweep_interval_minutes=60).update(sweep_interval_minutes=15)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0017_channeltype_sweep_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='channeldetectionstate',
+            name='check_interval_seconds',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='channeldetectionstate',
+            name='next_check_at',
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='channeltype',
+            name='sweep_interval_minutes',
+            field=models.PositiveIntegerField(default=15),
+        ),
+        migrations.RunPython(sweep_every_15_minutes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.1.2 on 2026-10-18 16:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('airqo_monitor', '0018_adaptive_check_interval'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ThingspeakUsage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hour_start', models.DateTimeField()),
+                ('channel_id', models.IntegerField(help_text='The Thingspeak channel id, which may not be in the Channel table yet')),
+                ('num_requests', models.IntegerField(default=0)),
+                ('num_bytes', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'db_table': 'thingspeak_usage',
+                'unique_together': {('hour_start', 'channel_id')},
+            },
+        ),
+    ]
@@ -24,6 +24,12 @@ class ChannelType(models.Model):
     )  ## in json
     description = models.TextField(null=True)
 
+    # The channels are swept for malfunctions in sweep_shard_count groups, each every
+    # sweep_interval_minutes, with their start times spread evenly over the interval. Each sweep
+    # only checks the channels that are due (see ChannelDetectionState.next_check_at).
+    sweep_shard_count = models.PositiveIntegerField(default=1)
+    sweep_interval_minutes = models.PositiveIntegerField(default=15)
+
     def __str__(self):
         return self.friendly_name
 
@@ -60,10 +66,194 @@ class Channel(models.Model):
         on_delete=models.DO_NOTHING,
     )
 
+    # High-water marks for the local FeedEntry store. Everything between feed_synced_from and
+    # feed_last_entry_at has been copied from Thingspeak, so only newer entries need fetching.
+    feed_synced_from = models.DateTimeField(null=True)
+    feed_last_entry_id = models.IntegerField(null=True)
+    feed_last_entry_at = models.DateTimeField(null=True)
+
     def __str__(self):
         return '{}: {}'.format(self.channel_id, self.name)
 
 
+class FeedEntry(models.Model):
+
+    class Meta:
+        db_table = 'feed_entry'
+        unique_together = ('channel', 'entry_id')
+        indexes = [
+            models.Index(fields=['channel', 'created_at']),
+        ]
+
+    channel = models.ForeignKey(
+        Channel,
+        null=False,
+        on_delete=models.DO_NOTHING,
+    )
+    entry_id = models.IntegerField(null=False)
+    created_at = models.DateTimeField(
+        null=False,
+        help_text="Thingspeak's timestamp for the entry",
+    )
+    field1 = models.TextField(null=True)
+    field2 = models.TextField(null=True)
+    field3 = models.TextField(null=True)
+    field4 = models.TextField(null=True)
+    field5 = models.TextField(null=True)
+    field6 = models.TextField(null=True)
+    field7 = models.TextField(null=True)
+    field8 = models.TextField(null=True)
+
+    def __str__(self):
+        return '{}: {}'.format(self.channel_id, self.entry_id)
+
+
+class ChannelRollup(models.Model):
+    """
+    Min/sum/max/count of one field of a channel's entries over an hour or a day, kept up to date
+    as entries are stored so that long time ranges can be read without touching every entry.
+    """
+
+    class Meta:
+        db_table = 'channel_rollup'
+        unique_together = ('channel', 'resolution', 'field', 'bucket_start')
+
+    HOUR = 'hour'
+    DAY = 'day'
+    RESOLUTION_CHOICES = (
+        (HOUR, 'Hourly'),
+        (DAY, 'Daily'),
+    )
+
+    channel = models.ForeignKey(
+        Channel,
+        null=False,
+        on_delete=models.DO_NOTHING,
+    )
+    resolution = models.CharField(max_length=8, choices=RESOLUTION_CHOICES)
+    field = models.CharField(
+        max_length=64,
+        help_text="Descriptive field name from the channel type's data format, e.g. pm_2_5",
+    )
+    bucket_start = models.DateTimeField(null=False)
+    count = models.IntegerField(default=0)
+    sum = models.FloatField(default=0)
+    min = models.FloatField(null=True)
+    max = models.FloatField(null=True)
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def __str__(self):
+        return '{}: {} {} {}'.format(self.channel_id, self.field, self.resolution, self.bucket_start)
+
+
+class ChannelDetectionState(models.Model):
+    """
+    What malfunction detection remembers about a channel between runs, so each run only needs
+    the entries that arrived since the last one.
+    """
+
+    class Meta:
+        db_table = 'channel_detection_state'
+
+    channel = models.OneToOneField(
+        Channel,
+        null=False,
+        on_delete=models.DO_NOTHING,
+    )
+    last_entry_id = models.IntegerField(null=True)
+    last_report_at = models.DateTimeField(null=True)
+    # The newest formatted entries, as many as the channel's detector looks at
+    recent_entries_json = models.TextField(default='[]')
+    updated_at = models.DateTimeField(auto_now=True)
+
+    # When the scheduled sweeps should next check the channel, which adapts to how it's behaving
+    check_interval_seconds = models.IntegerField(null=True)
+    next_check_at = models.DateTimeField(null=True, db_index=True)
+
+    @property
+    def recent_entries(self):
+        return json.loads(self.recent_entries_json)
+
+    def __str__(self):
+        return '{}: {}'.format(self.channel_id, self.last_entry_id)
+
+
+class ThingspeakUsage(models.Model):
+    """
+    How many requests were made to Thingspeak in an hour, and how many bytes they returned,
+    for one channel's feeds (see airqo_monitor.external.usage).
+    """
+
+    class Meta:
+        db_table = 'thingspeak_usage'
+        unique_together = ('hour_start', 'channel_id')
+
+    # channel_id for requests that aren't for a channel's feeds, like listing the channels
+    NO_CHANNEL = 0
+
+    hour_start = models.DateTimeField(null=False)
+    channel_id = models.IntegerField(
+        null=False,
+        help_text="The Thingspeak channel id, which may not be in the Channel table yet",
+    )
+    num_requests = models.IntegerField(default=0)
+    num_bytes = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return '{}: {} {} requests'.format(self.channel_id, self.hour_start, self.num_requests)
+
+
+class Job(models.Model):
+    """
+    A piece of background work, like a malfunction sweep, queued by the web app and run by the
+    worker in run_scheduler (see airqo_monitor.jobs).
+    """
+
+    class Meta:
+        db_table = 'job'
+        indexes = [
+            models.Index(fields=['kind', 'status']),
+        ]
+
+    MALFUNCTION_SWEEP = 'malfunction_sweep'
+    KIND_CHOICES = (
+        (MALFUNCTION_SWEEP, 'Malfunction sweep'),
+    )
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (QUEUED, 'Queued'),
+        (RUNNING, 'Running'),
+        (SUCCEEDED, 'Succeeded'),
+        (FAILED, 'Failed'),
+    )
+
+    kind = models.CharField(max_length=32, choices=KIND_CHOICES)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED)
+    created_at = models.DateTimeField("date created", auto_now_add=True)
+    started_at = models.DateTimeField(null=True)
+    finished_at = models.DateTimeField(null=True)
+
+    # Progress, as reported by JobProgress: the stage the job is in and a JSON map of each
+    # channel's status in that stage
+    stage = models.CharField(max_length=32, null=True)
+    channel_progress_json = models.TextField(default='{}')
+    error = models.TextField(null=True)
+
+    @property
+    def channel_progress(self):
+        return json.loads(self.channel_progress_json)
+
+    def __str__(self):
+        return '{}: {} ({})'.format(self.id, self.kind, self.status)
+
+
 class MalfunctionReason(models.Model):
 
     class Meta:
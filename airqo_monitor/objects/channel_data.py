@@ -0,0 +1,184 @@
+import numpy as np
+
+from airqo_monitor.constants import THINGSPEAK_DATETIME_FORMAT
+
+
+def _parse_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def _to_column(values):
+    """
+    Convert a list of Thingspeak string values into a float64 array, with NaN for missing or
+    unparseable values. If none of the values are numbers (e.g. the comma separated field8
+    metadata), keep them as an object array of strings instead.
+    """
+    cleaned_values = [np.nan if value is None or value == '' else value for value in values]
+    try:
+        return np.array(cleaned_values, dtype=np.float64)
+    except (TypeError, ValueError):
+        column = np.array([_parse_float(value) for value in cleaned_values], dtype=np.float64)
+        has_value = np.array([value is not np.nan for value in cleaned_values], dtype=bool)
+        if np.isnan(column[has_value]).all():
+            return np.array(values, dtype=object)
+        return column
+
+
+def _to_datetime64(created_at_strings):
+    # numpy doesn't accept the trailing Z, but every Thingspeak timestamp is UTC anyway
+    return np.array([value.rstrip('Z') for value in created_at_strings], dtype='datetime64[s]')
+
+
+class ChannelData(object):
+    """
+    Columnar representation of a channel's data: one NumPy array per field instead of one dict
+    per entry.
+
+    entry_id is an int64 array, created_at a datetime64[s] array (UTC) and every other field a
+    float64 array with NaN where there is no reading. Fields that aren't numeric at all are kept
+    as object arrays.
+
+    Dict-style access is kept for code written against the list of entry dicts:
+    data['pm_2_5'] returns a column, data[-1] returns the last entry as a dict and
+    data[-10:] (or data[boolean_mask]) returns a ChannelData with just those entries.
+    """
+
+    def __init__(self, entry_id, created_at, columns, channel_id=None, channel_type_name=None):
+        self.entry_id = entry_id
+        self.created_at = created_at
+        self.columns = columns
+        self.channel_id = channel_id
+        self.channel_type_name = channel_type_name
+
+    @classmethod
+    def from_feeds(cls, feeds, data_format, channel_id=None, channel_type_name=None):
+        """
+        Build the columns straight from Thingspeak's feed entries, naming them with the channel
+        type's data format (e.g. {"field2": "pm_2_5"}).
+        """
+        columns = dict()
+        for thingspeak_fieldname, descriptive_name in data_format.items():
+            columns[descriptive_name] = _to_column([feed.get(thingspeak_fieldname) for feed in feeds])
+
+        return cls(
+            entry_id=np.array([feed['entry_id'] for feed in feeds], dtype=np.int64),
+            created_at=_to_datetime64([feed['created_at'] for feed in feeds]),
+            columns=columns,
+            channel_id=channel_id,
+            channel_type_name=channel_type_name,
+        )
+
+    @classmethod
+    def from_entries(cls, entries):
+        """Build the columns from a list of formatted entry dicts."""
+        if not entries:
+            return cls(np.array([], dtype=np.int64), np.array([], dtype='datetime64[s]'), dict())
+
+        first_entry = entries[0]
+        field_names = [key for key in first_entry if key not in ('entry_id', 'created_at', 'channel_id', 'type')]
+        return cls(
+            entry_id=np.array([entry.get('entry_id') for entry in entries], dtype=np.int64),
+            created_at=_to_datetime64([entry.get('created_at') for entry in entries]),
+            columns={name: _to_column([entry.get(name) for entry in entries]) for name in field_names},
+            channel_id=first_entry.get('channel_id'),
+            channel_type_name=first_entry.get('type'),
+        )
+
+    @classmethod
+    def coerce(cls, channel_data):
+        """Return channel_data as a ChannelData, converting it if it's a list of entry dicts."""
+        if isinstance(channel_data, cls):
+            return channel_data
+        return cls.from_entries(list(channel_data))
+
+    @classmethod
+    def concatenate(cls, channel_datas):
+        """
+        Join several ChannelData end to end. A field that's missing from some of them is filled
+        with NaN for their rows.
+        """
+        channel_datas = [cls.coerce(channel_data) for channel_data in channel_datas]
+        field_names = []
+        for channel_data in channel_datas:
+            field_names += [name for name in channel_data.field_names if name not in field_names]
+
+        columns = dict()
+        for name in field_names:
+            columns[name] = np.concatenate([
+                channel_data.columns[name] if name in channel_data.columns else np.full(len(channel_data), np.nan)
+                for channel_data in channel_datas
+            ])
+
+        identified = [channel_data for channel_data in channel_datas if channel_data.channel_id is not None]
+        return cls(
+            entry_id=np.concatenate([channel_data.entry_id for channel_data in channel_datas]).astype(np.int64),
+            created_at=np.concatenate([channel_data.created_at for channel_data in channel_datas]).astype('datetime64[s]'),
+            columns=columns,
+            channel_id=identified[-1].channel_id if identified else None,
+            channel_type_name=identified[-1].channel_type_name if identified else None,
+        )
+
+    @property
+    def field_names(self):
+        return list(self.columns.keys())
+
+    def with_fields(self, field_names):
+        """Returns: a ChannelData with only the given fields (those it has)"""
+        return ChannelData(
+            entry_id=self.entry_id,
+            created_at=self.created_at,
+            columns={name: column for name, column in self.columns.items() if name in field_names},
+            channel_id=self.channel_id,
+            channel_type_name=self.channel_type_name,
+        )
+
+    def __len__(self):
+        return len(self.entry_id)
+
+    def __contains__(self, key):
+        return key in self.columns or key in ('entry_id', 'created_at')
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self._get_entry(index)
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            if key == 'entry_id':
+                return self.entry_id
+            if key == 'created_at':
+                return self.created_at
+            return self.columns[key]
+
+        # A slice or a boolean mask selects rows
+        if isinstance(key, (slice, np.ndarray)):
+            return ChannelData(
+                entry_id=self.entry_id[key],
+                created_at=self.created_at[key],
+                columns={name: column[key] for name, column in self.columns.items()},
+                channel_id=self.channel_id,
+                channel_type_name=self.channel_type_name,
+            )
+
+        return self._get_entry(key)
+
+    def _get_entry(self, index):
+        """Rebuild the formatted entry dict for one row."""
+        entry = dict()
+        for name, column in self.columns.items():
+            value = column[index]
+            if isinstance(value, float) and np.isnan(value):
+                value = None
+            entry[name] = value.item() if isinstance(value, np.generic) else value
+        entry['type'] = self.channel_type_name
+        entry['entry_id'] = int(self.entry_id[index])
+        entry['channel_id'] = self.channel_id
+        entry['created_at'] = self.created_at[index].item().strftime(THINGSPEAK_DATETIME_FORMAT)
+        return entry
+
+    def to_entries(self):
+        """Returns: list of formatted entry dicts, from oldest to newest"""
+        return list(self)
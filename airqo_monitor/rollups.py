@@ -0,0 +1,209 @@
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest, Least
+from django.utils import timezone
+
+from airqo_monitor.constants import (
+    DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS,
+    FEED_STORE_BULK_CREATE_BATCH_SIZE,
+    ROLLUP_FIELD_NAMES,
+    ROLLUP_HOURLY_RETENTION_DAYS,
+    ROLLUP_MAX_POINTS,
+    THINGSPEAK_DATETIME_FORMAT,
+)
+from airqo_monitor.models import Channel, ChannelRollup, FeedEntry
+from airqo_monitor.utils import to_utc
+
+
+# Finest first, so the query API can pick the finest one that fits in max_points
+ROLLUP_RESOLUTIONS = [
+    (ChannelRollup.HOUR, timedelta(hours=1)),
+    (ChannelRollup.DAY, timedelta(days=1)),
+]
+
+
+def _get_bucket_start(created_at, resolution):
+    if resolution == ChannelRollup.HOUR:
+        return created_at.replace(minute=0, second=0, microsecond=0)
+    return created_at.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_rollup_field_names(channel):
+    """
+    Returns: dict {thingspeak_field_name: descriptive_name} of the channel's fields that are rolled up
+    """
+    return {
+        thingspeak_fieldname: descriptive_name
+        for thingspeak_fieldname, descriptive_name in channel.channel_type.data_format.items()
+        if descriptive_name in ROLLUP_FIELD_NAMES
+    }
+
+
+def _aggregate_entries(channel, entries):
+    """
+    Returns: dict {(resolution, field, bucket_start): [count, sum, min, max]} for the entries
+    """
+    field_names = _get_rollup_field_names(channel)
+    aggregates = {}
+
+    for entry in entries:
+        for thingspeak_fieldname, descriptive_name in field_names.items():
+            value = _to_float(getattr(entry, thingspeak_fieldname))
+            if value is None:
+                continue
+
+            for resolution, _ in ROLLUP_RESOLUTIONS:
+                key = (resolution, descriptive_name, _get_bucket_start(entry.created_at, resolution))
+                aggregate = aggregates.get(key)
+                if aggregate is None:
+                    aggregates[key] = [1, value, value, value]
+                else:
+                    aggregate[0] += 1
+                    aggregate[1] += value
+                    aggregate[2] = min(aggregate[2], value)
+                    aggregate[3] = max(aggregate[3], value)
+
+    return aggregates
+
+
+def update_rollups_for_entries(channel, entries):
+    """
+    Add newly stored FeedEntry objects to the channel's hourly and daily rollups. Each entry must
+    only be added once, which the feed store guarantees by only passing entries it just created.
+
+    The caller must hold the channel's row lock (see feed_store._lock_channel), so that no other
+    sync creates the same buckets between reading the existing ones and creating the rest.
+    """
+    aggregates = _aggregate_entries(channel, entries)
+    if not aggregates:
+        return
+
+    with transaction.atomic():
+        existing_rollups = ChannelRollup.objects.filter(
+            channel=channel,
+            field__in=set(field for _, field, _ in aggregates),
+            bucket_start__gte=min(bucket_start for _, _, bucket_start in aggregates),
+        ).values_list('id', 'resolution', 'field', 'bucket_start')
+        existing_ids = {
+            (resolution, field, bucket_start): rollup_id
+            for rollup_id, resolution, field, bucket_start in existing_rollups
+        }
+
+        new_rollups = []
+        for key, (count, total, minimum, maximum) in aggregates.items():
+            rollup_id = existing_ids.get(key)
+            if rollup_id is None:
+                resolution, field, bucket_start = key
+                new_rollups.append(ChannelRollup(
+                    channel=channel,
+                    resolution=resolution,
+                    field=field,
+                    bucket_start=bucket_start,
+                    count=count,
+                    sum=total,
+                    min=minimum,
+                    max=maximum,
+                ))
+            else:
+                # Only the few buckets that were already open (usually the current hour and day)
+                # get here, and the update is done in the database so concurrent syncs can't
+                # lose each other's counts.
+                ChannelRollup.objects.filter(id=rollup_id).update(
+                    count=F('count') + count,
+                    sum=F('sum') + total,
+                    min=Least('min', Value(minimum)),
+                    max=Greatest('max', Value(maximum)),
+                )
+
+        ChannelRollup.objects.bulk_create(new_rollups, batch_size=FEED_STORE_BULK_CREATE_BATCH_SIZE)
+
+
+def rebuild_rollups_for_channel(channel):
+    """
+    Recompute the channel's rollups from the entries in the feed store, e.g. after its data format
+    changes. Rollups for time ranges that have already been pruned from the store are kept.
+    """
+    entries = FeedEntry.objects.filter(channel=channel)
+    oldest_entry = entries.order_by('created_at').first()
+    if oldest_entry is None:
+        return
+
+    with transaction.atomic():
+        # Hold the channel's row lock like the feed store does, so no sync adds to the buckets
+        # while they're rebuilt
+        Channel.objects.select_for_update().get(id=channel.id)
+        for resolution, _ in ROLLUP_RESOLUTIONS:
+            ChannelRollup.objects.filter(
+                channel=channel,
+                resolution=resolution,
+                bucket_start__gte=_get_bucket_start(oldest_entry.created_at, resolution),
+            ).delete()
+        update_rollups_for_entries(channel, entries.iterator())
+
+
+def get_rollup_resolution(start_time, end_time, max_points=ROLLUP_MAX_POINTS):
+    """
+    Pick the finest resolution that gives at most max_points buckets between start_time and
+    end_time, or the coarsest one if none does.
+    """
+    for resolution, bucket_size in ROLLUP_RESOLUTIONS:
+        if (end_time - start_time) / bucket_size <= max_points:
+            return resolution
+    return ROLLUP_RESOLUTIONS[-1][0]
+
+
+def get_rollup_data_for_channel(channel, start_time=None, end_time=None, field_names=None,
+                                max_points=ROLLUP_MAX_POINTS):
+    """
+    Read the channel's rollups between start_time and end_time (by default, the last week) at the
+    resolution picked by get_rollup_resolution.
+
+    Returns: tuple (resolution, list of dicts, one per bucket from oldest to newest, of the form
+        {'bucket_start': '2018-11-01T10:00:00Z', 'pm_2_5': {'count': 60, 'mean': 35.2, 'min': 12.0, 'max': 80.5}})
+    """
+    now = timezone.now()
+    start_time = to_utc(start_time) if start_time else now - timedelta(days=DEFAULT_THINGSPEAK_FEEDS_INTERVAL_DAYS)
+    end_time = to_utc(end_time) if end_time else now
+    resolution = get_rollup_resolution(start_time, end_time, max_points)
+
+    rollups = ChannelRollup.objects.filter(
+        channel=channel,
+        resolution=resolution,
+        bucket_start__gte=_get_bucket_start(start_time, resolution),
+        bucket_start__lte=end_time,
+    )
+    if field_names:
+        rollups = rollups.filter(field__in=field_names)
+
+    buckets = {}
+    for field, bucket_start, count, total, minimum, maximum in rollups.order_by('bucket_start').values_list(
+            'field', 'bucket_start', 'count', 'sum', 'min', 'max'):
+        bucket = buckets.setdefault(
+            bucket_start,
+            {'bucket_start': datetime.strftime(to_utc(bucket_start), THINGSPEAK_DATETIME_FORMAT)},
+        )
+        bucket[field] = {
+            'count': count,
+            'mean': total / count if count else None,
+            'min': minimum,
+            'max': maximum,
+        }
+
+    return resolution, [buckets[bucket_start] for bucket_start in sorted(buckets)]
+
+
+def prune_rollups(hourly_retention_days=ROLLUP_HOURLY_RETENTION_DAYS):
+    """
+    Delete hourly rollups older than hourly_retention_days. Daily rollups are small enough to keep.
+    """
+    cutoff = timezone.now() - timedelta(days=hourly_retention_days)
+    ChannelRollup.objects.filter(resolution=ChannelRollup.HOUR, bucket_start__lt=cutoff).delete()
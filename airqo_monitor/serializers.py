@@ -54,7 +54,13 @@ class ChannelSerializer(serializers.ModelSerializer):
     active_incidents = serializers.SerializerMethodField()
 
     def get_active_incidents(self, obj):
-        incidents = Incident.objects.filter(channel=obj, resolved_at__isnull=True)
+        # Use the incidents loaded by utils.prefetch_open_incidents if the view prefetched them
+        incidents = getattr(obj, 'open_incidents', None)
+        if incidents is None:
+            incidents = Incident.objects.filter(
+                channel=obj,
+                resolved_at__isnull=True,
+            ).select_related('malfunction_reason')
         return IncidentSerializer(incidents, many=True).data
 
     class Meta:
@@ -0,0 +1,114 @@
+import mock
+import time
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from airqo_monitor.caching import (
+    CacheLockTimeout,
+    get_or_set_with_lock,
+    get_with_age,
+    renewing_cache_locks,
+    set_with_age,
+)
+
+
+class TestGetOrSetWithLock(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_computes_once_and_caches(self):
+        compute = mock.Mock(return_value=['channel'])
+
+        assert get_or_set_with_lock('key', compute, timeout=60) == ['channel']
+        assert get_or_set_with_lock('key', compute, timeout=60) == ['channel']
+        assert compute.call_count == 1
+        assert cache.get('key:lock') is None
+
+    def test_waits_for_the_process_holding_the_lock(self):
+        cache.add('key:lock', True)
+        compute = mock.Mock(return_value='mine')
+
+        def other_process_finishes(seconds):
+            cache.set('key', 'theirs')
+
+        with mock.patch('airqo_monitor.caching.time.sleep', side_effect=other_process_finishes):
+            assert get_or_set_with_lock('key', compute, timeout=60) == 'theirs'
+        assert not compute.called
+
+    def test_takes_over_when_the_lock_holder_fails(self):
+        cache.add('key:lock', True)
+        compute = mock.Mock(return_value='mine')
+
+        with mock.patch('airqo_monitor.caching.time.sleep', side_effect=lambda seconds: cache.delete('key:lock')):
+            assert get_or_set_with_lock('key', compute, timeout=60) == 'mine'
+        assert cache.get('key') == 'mine'
+
+    def test_never_computes_without_the_lock(self):
+        cache.add('key:lock', True)
+        compute = mock.Mock(return_value='mine')
+
+        with mock.patch('airqo_monitor.caching.time.sleep'):
+            with self.assertRaises(CacheLockTimeout):
+                get_or_set_with_lock('key', compute, timeout=60, wait_seconds=0)
+        assert not compute.called
+
+    def test_waits_as_long_as_the_lock_can_be_held(self):
+        cache.add('key:lock', True)
+        compute = mock.Mock(return_value='mine')
+        clock = [1000.0]
+
+        def other_process_finishes_late(seconds):
+            clock[0] += seconds
+            # Well past the old fixed wait, but still inside the lock's lifetime
+            if clock[0] >= 1000 + 10 * 60:
+                cache.set('key', 'theirs')
+
+        with mock.patch('airqo_monitor.caching.time.time', side_effect=lambda: clock[0]), \
+                mock.patch('airqo_monitor.caching.time.sleep', side_effect=other_process_finishes_late):
+            assert get_or_set_with_lock('key', compute, timeout=60, lock_timeout=15 * 60, poll_seconds=30) == 'theirs'
+        assert not compute.called
+
+    def test_releases_the_lock_when_compute_fails(self):
+        with self.assertRaises(ValueError):
+            get_or_set_with_lock('key', mock.Mock(side_effect=ValueError), timeout=60)
+        assert cache.get('key:lock') is None
+
+
+class TestCacheWithAge(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_value_is_returned_with_its_age(self):
+        assert get_with_age('key') == (None, None)
+
+        with mock.patch('airqo_monitor.caching.time.time', return_value=1000.0):
+            set_with_age('key', ['channel'], timeout=600)
+        with mock.patch('airqo_monitor.caching.time.time', return_value=1042.5):
+            assert get_with_age('key') == (['channel'], 42.5)
+
+
+class TestRenewingCacheLocks(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_locks_outlive_their_timeout_until_released(self):
+        cache.add('lock', True, timeout=0.3)
+
+        with renewing_cache_locks(['lock'], timeout=0.3):
+            time.sleep(0.5)
+            assert cache.get('lock')
+
+        assert cache.get('lock') is None
+
+    def test_locks_are_released_when_the_block_fails(self):
+        cache.add('lock', True, timeout=60)
+
+        with self.assertRaises(ValueError):
+            with renewing_cache_locks(['lock'], timeout=60):
+                raise ValueError('sweep failed')
+
+        assert cache.get('lock') is None
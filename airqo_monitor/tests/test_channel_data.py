@@ -0,0 +1,93 @@
+import numpy as np
+
+from django.test import TestCase
+
+from airqo_monitor.objects.channel_data import ChannelData
+
+
+class TestChannelData(TestCase):
+
+    sample_feeds = [
+        {
+            u'field1': u'35.00',
+            u'field2': u'36.00',
+            u'field3': u' 6.30',
+            u'field8': u'6,7,8,9,10,11',
+            u'created_at': u'2017-03-26T22:53:55Z',
+            u'entry_id': 1
+        },
+        {
+            u'field1': u'36.00',
+            u'field2': None,
+            u'field3': u'nonsense',
+            u'field8': None,
+            u'created_at': u'2017-03-27T22:53:55Z',
+            u'entry_id': 2
+        },
+    ]
+
+    sample_data_format = {
+        'field1': 'pm_1',
+        'field2': 'pm_2_5',
+        'field3': 'pm_10',
+        'field8': 'lat,lng,elevation,speed,num_satellites,hdop',
+    }
+
+    def setUp(self):
+        self.data = ChannelData.from_feeds(
+            self.sample_feeds,
+            self.sample_data_format,
+            channel_id=123,
+            channel_type_name='airqo',
+        )
+
+    def test_from_feeds_builds_typed_columns(self):
+        assert len(self.data) == 2
+        assert self.data['entry_id'].tolist() == [1, 2]
+        assert self.data['created_at'].dtype == np.dtype('datetime64[s]')
+        assert self.data['pm_1'].tolist() == [35.0, 36.0]
+        assert self.data['pm_10'][0] == 6.3
+        assert np.isnan(self.data['pm_2_5'][1])
+        assert np.isnan(self.data['pm_10'][1])
+        assert self.data['lat,lng,elevation,speed,num_satellites,hdop'].dtype == object
+
+    def test_entry_access_matches_formatted_dicts(self):
+        entry = self.data[-1]
+        assert entry['entry_id'] == 2
+        assert entry['channel_id'] == 123
+        assert entry['type'] == 'airqo'
+        assert entry['created_at'] == '2017-03-27T22:53:55Z'
+        assert entry['pm_1'] == 36.0
+        assert entry['pm_2_5'] is None
+
+        assert self.data[0].get('lat,lng,elevation,speed,num_satellites,hdop') == '6,7,8,9,10,11'
+
+    def test_slicing_returns_channel_data(self):
+        last_entries = self.data[-1:]
+        assert isinstance(last_entries, ChannelData)
+        assert len(last_entries) == 1
+        assert last_entries['pm_1'].tolist() == [36.0]
+
+    def test_coerce_round_trips_entry_dicts(self):
+        data = ChannelData.coerce(self.data.to_entries())
+        assert data['entry_id'].tolist() == [1, 2]
+        assert data['pm_1'].tolist() == [35.0, 36.0]
+        assert data.channel_id == 123
+
+        assert ChannelData.coerce(self.data) is self.data
+        assert len(ChannelData.coerce([])) == 0
+
+    def test_concatenate_fills_missing_fields(self):
+        older = ChannelData.from_entries([
+            {'entry_id': 1, 'created_at': '2018-10-22T09:00:00Z', 'pm_2_5': '1.5'},
+        ])
+        newer = ChannelData.from_entries([
+            {'entry_id': 2, 'created_at': '2018-10-22T09:01:00Z', 'pm_2_5': '2.5', 'battery_voltage': '4.1'},
+        ])
+
+        data = ChannelData.concatenate([older, newer])
+
+        assert data['entry_id'].tolist() == [1, 2]
+        assert data['pm_2_5'].tolist() == [1.5, 2.5]
+        assert data[0]['battery_voltage'] is None
+        assert data[data['pm_2_5'] > 2]['entry_id'].tolist() == [2]
@@ -0,0 +1,199 @@
+import json
+import mock
+import pytz
+
+from datetime import datetime, timedelta
+from django.test import TestCase
+from django.utils import timezone
+
+from airqo_monitor.feed_store import (
+    get_stored_data_for_channel,
+    prune_feed_entries,
+    sync_feed_entries_for_channel,
+)
+from airqo_monitor.models import (
+    Channel,
+    ChannelType,
+    FeedEntry,
+)
+
+
+def make_feed(entry_id, created_at):
+    return {
+        'entry_id': entry_id,
+        'created_at': datetime.strftime(created_at, '%Y-%m-%dT%H:%M:%SZ'),
+        'field1': '1.0{}'.format(entry_id),
+        'field2': '2.0{}'.format(entry_id),
+    }
+
+
+class TestFeedStore(TestCase):
+
+    def setUp(self):
+        self.channel_type, _ = ChannelType.objects.get_or_create(name='airqo', data_format_json=json.dumps({}))
+        self.channel = Channel.objects.create(channel_id=123, name='Test Name', channel_type=self.channel_type)
+        self.now = datetime.utcnow().replace(microsecond=0)
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_first_sync_stores_entries_and_high_water_marks(self, iter_data_for_channel_mocker):
+        iter_data_for_channel_mocker.return_value = [[
+            make_feed(1, self.now - timedelta(hours=2)),
+            make_feed(2, self.now - timedelta(hours=1)),
+        ]]
+
+        num_new_entries = sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        assert num_new_entries == 2
+        assert FeedEntry.objects.filter(channel=self.channel).count() == 2
+        assert iter_data_for_channel_mocker.call_count == 1
+
+        channel = Channel.objects.get(id=self.channel.id)
+        assert channel.feed_last_entry_id == 2
+        assert channel.feed_last_entry_at == pytz.utc.localize(self.now - timedelta(hours=1))
+        assert channel.feed_synced_from == pytz.utc.localize(self.now - timedelta(days=1))
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_sync_only_requests_entries_after_high_water_mark(self, iter_data_for_channel_mocker):
+        iter_data_for_channel_mocker.return_value = [[make_feed(1, self.now - timedelta(hours=2))]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        # Thingspeak's start parameter is inclusive, so the newest stored entry comes back again
+        iter_data_for_channel_mocker.reset_mock()
+        iter_data_for_channel_mocker.return_value = [[
+            make_feed(1, self.now - timedelta(hours=2)),
+            make_feed(2, self.now - timedelta(minutes=5)),
+        ]]
+        num_new_entries = sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        assert num_new_entries == 1
+        assert FeedEntry.objects.filter(channel=self.channel).count() == 2
+        iter_data_for_channel_mocker.assert_called_once()
+        assert iter_data_for_channel_mocker.call_args[1]['start_time'] == self.now - timedelta(hours=2)
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_overlapping_syncs_dont_collide_or_move_marks_back(self, iter_data_for_channel_mocker):
+        # Two syncs that loaded the channel before either had stored anything
+        stale_channel = Channel.objects.get(id=self.channel.id)
+        iter_data_for_channel_mocker.return_value = [[
+            make_feed(1, self.now - timedelta(hours=2)),
+            make_feed(2, self.now - timedelta(hours=1)),
+        ]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        iter_data_for_channel_mocker.return_value = [[make_feed(1, self.now - timedelta(hours=2))]]
+        num_new_entries = sync_feed_entries_for_channel(stale_channel, start_time=self.now - timedelta(days=1))
+
+        assert num_new_entries == 0
+        assert FeedEntry.objects.filter(channel=self.channel).count() == 2
+        assert Channel.objects.get(id=self.channel.id).feed_last_entry_id == 2
+        assert stale_channel.feed_last_entry_id == 2
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_sync_backfills_before_synced_window(self, iter_data_for_channel_mocker):
+        iter_data_for_channel_mocker.return_value = [[make_feed(5, self.now - timedelta(hours=1))]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        iter_data_for_channel_mocker.reset_mock()
+        iter_data_for_channel_mocker.side_effect = [
+            [[make_feed(1, self.now - timedelta(days=2))]],
+            [],
+        ]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=3))
+
+        first_call = iter_data_for_channel_mocker.call_args_list[0]
+        assert first_call[1]['start_time'] == self.now - timedelta(days=3)
+        assert first_call[1]['end_time'] == self.now - timedelta(days=1)
+
+        channel = Channel.objects.get(id=self.channel.id)
+        assert channel.feed_synced_from == pytz.utc.localize(self.now - timedelta(days=3))
+        assert channel.feed_last_entry_id == 5
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_sync_of_newest_entries_only(self, iter_data_for_channel_mocker):
+        # A channel's first sync only fetches the newest entries, in one request
+        iter_data_for_channel_mocker.return_value = [[
+            make_feed(9, self.now - timedelta(hours=2)),
+            make_feed(10, self.now - timedelta(hours=1)),
+        ]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1), num_recent_entries=2)
+
+        iter_data_for_channel_mocker.assert_called_once_with(123, results=2)
+        channel = Channel.objects.get(id=self.channel.id)
+        assert channel.feed_synced_from == pytz.utc.localize(self.now - timedelta(hours=2))
+        assert channel.feed_last_entry_id == 10
+
+        # Later ones don't backfill the rest of the window, but still get the new entries
+        iter_data_for_channel_mocker.reset_mock()
+        iter_data_for_channel_mocker.return_value = [[make_feed(11, self.now - timedelta(minutes=5))]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1), num_recent_entries=2)
+
+        iter_data_for_channel_mocker.assert_called_once()
+        assert iter_data_for_channel_mocker.call_args[1]['start_time'] == self.now - timedelta(hours=1)
+        channel = Channel.objects.get(id=self.channel.id)
+        assert channel.feed_synced_from == pytz.utc.localize(self.now - timedelta(hours=2))
+
+        # Until a caller needs the whole window
+        iter_data_for_channel_mocker.reset_mock()
+        iter_data_for_channel_mocker.return_value = []
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        assert iter_data_for_channel_mocker.call_args_list[0][1] == {
+            'start_time': self.now - timedelta(days=1),
+            'end_time': self.now - timedelta(hours=2),
+        }
+        assert Channel.objects.get(id=self.channel.id).feed_synced_from == pytz.utc.localize(self.now - timedelta(days=1))
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_sync_skips_thingspeak_when_window_is_already_stored(self, iter_data_for_channel_mocker):
+        iter_data_for_channel_mocker.return_value = [[make_feed(1, self.now - timedelta(hours=1))]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        iter_data_for_channel_mocker.reset_mock()
+        sync_feed_entries_for_channel(
+            self.channel,
+            start_time=self.now - timedelta(hours=12),
+            end_time=self.now - timedelta(hours=6),
+        )
+        assert not iter_data_for_channel_mocker.called
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_get_stored_data_for_channel(self, iter_data_for_channel_mocker):
+        # Pages arrive newest first
+        iter_data_for_channel_mocker.return_value = [
+            [make_feed(2, self.now - timedelta(hours=2)), make_feed(3, self.now - timedelta(hours=1))],
+            [make_feed(1, self.now - timedelta(days=2))],
+        ]
+
+        data = get_stored_data_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        assert [entry['entry_id'] for entry in data] == [2, 3]
+        assert data[0]['created_at'] == datetime.strftime(self.now - timedelta(hours=2), '%Y-%m-%dT%H:%M:%SZ')
+        assert data[0]['field1'] == '1.02'
+        assert data[0]['field2'] == '2.02'
+        assert data[0]['field3'] is None
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_get_stored_data_for_channel_fields(self, iter_data_for_channel_mocker):
+        iter_data_for_channel_mocker.return_value = [[make_feed(1, self.now - timedelta(hours=1))]]
+
+        data = get_stored_data_for_channel(self.channel, fields=['field2'])
+
+        assert data == [{
+            'entry_id': 1,
+            'created_at': datetime.strftime(self.now - timedelta(hours=1), '%Y-%m-%dT%H:%M:%SZ'),
+            'field2': '2.01',
+        }]
+        # The sync still fetches every field for the store
+        assert 'fields' not in iter_data_for_channel_mocker.call_args[1]
+
+    def test_prune_feed_entries(self):
+        FeedEntry.objects.create(channel=self.channel, entry_id=1, created_at=timezone.now() - timedelta(days=40))
+        FeedEntry.objects.create(channel=self.channel, entry_id=2, created_at=timezone.now() - timedelta(days=1))
+        self.channel.feed_synced_from = timezone.now() - timedelta(days=40)
+        self.channel.save()
+
+        prune_feed_entries(retention_days=30)
+
+        assert list(FeedEntry.objects.values_list('entry_id', flat=True)) == [2]
+        channel = Channel.objects.get(id=self.channel.id)
+        assert channel.feed_synced_from > timezone.now() - timedelta(days=31)
@@ -3,21 +3,24 @@ import mock
 
 from bunch import Bunch
 from datetime import datetime, timedelta
+from django.core.cache import cache
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from airqo_monitor.models import Channel, ChannelType
 from airqo_monitor.constants import (
     THINGSPEAK_CHANNELS_LIST_URL,
     THINGSPEAK_FEEDS_LIST_URL,
 )
+from airqo_monitor.objects.channel_data import ChannelData
 from airqo_monitor.objects.data_entry import DataEntry
-from airqo_monitor.external.thingspeak import (
-    get_data_for_channel,
-)
 from airqo_monitor.format_data import (
+    update_all_channel_data,
     get_and_format_data_for_all_channels,
     get_and_format_data_for_channel,
     get_and_format_data_for_channels,
+    get_and_format_heatmap_data_for_channels,
 )
 
 
@@ -72,10 +75,11 @@ class TestFormatData(TestCase):
 
     def setUp(self):
         self.channel_type, _ = ChannelType.objects.get_or_create(name='airqo', data_format_json=json.dumps(self.sample_data_format))
+        cache.clear()
 
-    @mock.patch('airqo_monitor.format_data.get_data_for_channel')
-    def test_get_and_format_data_for_channel(self, get_data_for_channel_mocker):
-        get_data_for_channel_mocker.return_value = self.sample_json_entries
+    @mock.patch('airqo_monitor.format_data.get_stored_data_for_channel')
+    def test_get_and_format_data_for_channel(self, get_stored_data_for_channel_mocker):
+        get_stored_data_for_channel_mocker.return_value = self.sample_json_entries
 
         data = get_and_format_data_for_channel(Bunch(channel_id=123, channel_type=Bunch(name='airqo', data_format=self.sample_data_format)))
         assert data[0].get('created_at') == '2017-03-26T22:53:55Z'
@@ -95,12 +99,12 @@ class TestFormatData(TestCase):
         assert data[2].get('channel_id') == 123
         assert data[2].get('entry_id') == 3
 
-    @mock.patch('airqo_monitor.format_data.get_data_for_channel')
-    def test_get_and_format_data_for_channel_with_field8(self, get_data_for_channel_mocker):
+    @mock.patch('airqo_monitor.format_data.get_stored_data_for_channel')
+    def test_get_and_format_data_for_channel_with_field8(self, get_stored_data_for_channel_mocker):
         sample_json_entries = self.sample_json_entries
         sample_json_entries[0]['field8'] = '6,7,8,9,10,11'
 
-        get_data_for_channel_mocker.return_value = sample_json_entries
+        get_stored_data_for_channel_mocker.return_value = sample_json_entries
 
         data = get_and_format_data_for_channel(Bunch(channel_id=123, channel_type=Bunch(name='airqo', data_format=self.sample_data_format)))
         assert data[0].get('created_at') == '2017-03-26T22:53:55Z'
@@ -123,18 +127,97 @@ class TestFormatData(TestCase):
         assert data[2].get('entry_id') == 3
         assert data[2].get('lat,lng,elevation,speed,num_satellites,hdop') is None
 
-    @mock.patch('airqo_monitor.format_data.get_data_for_channel')
-    def test_get_and_format_data_for_channel_with_misformatted_field8_doesnt_crash(self, get_data_for_channel_mocker):
+    @mock.patch('airqo_monitor.format_data.get_stored_data_for_channel')
+    def test_get_and_format_data_for_channel_with_misformatted_field8_doesnt_crash(self, get_stored_data_for_channel_mocker):
         sample_json_entries = self.sample_json_entries
         sample_json_entries[0]['field8'] = '6,7,8,9,10'
 
-        get_data_for_channel_mocker.return_value = sample_json_entries
+        get_stored_data_for_channel_mocker.return_value = sample_json_entries
 
         data = get_and_format_data_for_channel(Bunch(channel_id=123, channel_type=Bunch(name='airqo', data_format=self.sample_data_format)))
 
         assert data[0].get('latitude') == '172'
         assert data[0].get('longitude') == '1'
 
+    @mock.patch('airqo_monitor.format_data.get_stored_data_for_channel')
+    def test_get_and_format_data_for_channel_columnar(self, get_stored_data_for_channel_mocker):
+        get_stored_data_for_channel_mocker.return_value = self.sample_json_entries
+
+        data = get_and_format_data_for_channel(
+            Bunch(channel_id=123, channel_type=Bunch(name='airqo', data_format=self.sample_data_format)),
+            columnar=True,
+        )
+        assert isinstance(data, ChannelData)
+        assert data['entry_id'].tolist() == [1, 2, 3]
+        assert data['pm_2_5'].tolist() == [36.0, 37.0, 38.0]
+        assert data[0].get('created_at') == '2017-03-26T22:53:55Z'
+        assert data[0].get('channel_id') == 123
+
+    @mock.patch('airqo_monitor.format_data.get_stored_data_for_channel')
+    def test_get_and_format_data_for_channel_field_names(self, get_stored_data_for_channel_mocker):
+        get_stored_data_for_channel_mocker.return_value = [
+            {'entry_id': 1, 'created_at': '2017-03-26T22:53:55Z', 'field2': '36.00', 'field7': '16'},
+        ]
+
+        data = get_and_format_data_for_channel(
+            Bunch(channel_id=123, channel_type=Bunch(name='airqo', data_format=self.sample_data_format)),
+            columnar=True,
+            field_names=['pm_2_5', 'battery_voltage', 'not_in_format'],
+        )
+
+        # Only the Thingspeak fields holding those names are read
+        assert sorted(get_stored_data_for_channel_mocker.call_args[1]['fields']) == ['field2', 'field7']
+        assert sorted(data.field_names) == ['battery_voltage', 'pm_2_5']
+        assert data['battery_voltage'].tolist() == [16.0]
+
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    @mock.patch('airqo_monitor.format_data.get_all_channels_by_type')
+    def test_get_and_format_heatmap_data_skips_entries_without_location(self, get_all_channels_mocker,
+                                                                        get_and_format_data_for_channel_mocker):
+        get_all_channels_mocker.return_value = [dict(name='channel1', id=9999)]
+        get_and_format_data_for_channel_mocker.return_value = ChannelData.from_entries([
+            {'entry_id': 1, 'created_at': '2017-03-26T22:53:55Z', 'latitude': '0.5', 'longitude': '32.5'},
+            {'entry_id': 2, 'created_at': '2017-03-26T22:54:55Z', 'latitude': None, 'longitude': '32.5'},
+        ])
+
+        geojson = get_and_format_heatmap_data_for_channels(channel_ids=['9999'], cell_size_degrees=1.0)
+
+        assert geojson['type'] == 'FeatureCollection'
+        assert len(geojson['features']) == 1
+        assert geojson['features'][0]['geometry']['coordinates'] == [32.5, 0.5]
+        assert geojson['features'][0]['properties']['count'] == 1
+
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    @mock.patch('airqo_monitor.format_data.get_all_channels_by_type')
+    def test_get_and_format_heatmap_data_bins_readings(self, get_all_channels_mocker,
+                                                       get_and_format_data_for_channel_mocker):
+        get_all_channels_mocker.return_value = [dict(name='channel1', id=9999), dict(name='channel2', id=8888)]
+        get_and_format_data_for_channel_mocker.return_value = ChannelData.from_entries([
+            {'entry_id': 1, 'created_at': '2017-03-26T22:10:00Z', 'latitude': '0.31', 'longitude': '32.51', 'pm_2_5': '10'},
+            {'entry_id': 2, 'created_at': '2017-03-26T22:20:00Z', 'latitude': '0.32', 'longitude': '32.52', 'pm_2_5': '30'},
+            {'entry_id': 3, 'created_at': '2017-03-26T23:10:00Z', 'latitude': '0.33', 'longitude': '32.53', 'pm_2_5': None},
+            {'entry_id': 4, 'created_at': '2017-03-26T23:20:00Z', 'latitude': '1.51', 'longitude': '32.51', 'pm_2_5': '50'},
+        ])
+
+        # Both channels report the same readings, so every cell counts each reading twice
+        geojson = get_and_format_heatmap_data_for_channels(channel_ids=['9999', '8888'], cell_size_degrees=1.0)
+        features = sorted(geojson['features'], key=lambda feature: feature['geometry']['coordinates'][1])
+
+        assert len(features) == 2
+        assert features[0]['geometry']['coordinates'] == [32.5, 0.5]
+        assert features[0]['properties'] == {'count': 6, 'mean_pm_2_5': 20.0, 'max_pm_2_5': 30.0}
+        assert features[1]['geometry']['coordinates'] == [32.5, 1.5]
+        assert features[1]['properties'] == {'count': 2, 'mean_pm_2_5': 50.0, 'max_pm_2_5': 50.0}
+
+        # Splitting into hourly windows separates the 22:00 readings from the 23:00 ones
+        geojson = get_and_format_heatmap_data_for_channels(
+            channel_ids=['9999', '8888'],
+            cell_size_degrees=1.0,
+            time_window_minutes=60,
+        )
+        window_starts = sorted(feature['properties']['window_start'] for feature in geojson['features'])
+        assert window_starts == ['2017-03-26T22:00:00Z', '2017-03-26T23:00:00Z', '2017-03-26T23:00:00Z']
+
     @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
     @mock.patch('airqo_monitor.format_data.get_all_channels_by_type')
     def test_get_and_format_data_for_all_channels(self, get_all_channels_mocker, get_and_format_data_for_channel_mocker):
@@ -224,3 +307,56 @@ class TestFormatData(TestCase):
         assert channel_info[8888]['data'][0].get('entry_id') == 1
         assert channel_info[8888]['data'][0].get('latitude') == '1'
         assert channel_info[8888]['data'][0].get('longitude') == '1'
+
+    @mock.patch('airqo_monitor.format_data.get_all_channels_by_type')
+    def test_update_all_channel_data_syncs_in_bulk(self, get_all_channels_mocker):
+        soil_channel_type = ChannelType.objects.create(name='soil', data_format_json=json.dumps({}))
+        renamed = Channel.objects.create(channel_id=1, name='old name', channel_type=self.channel_type)
+        deactivated = Channel.objects.create(channel_id=2, name='channel2', channel_type=self.channel_type)
+        retyped = Channel.objects.create(channel_id=3, name='channel3', channel_type=soil_channel_type)
+        reactivated = Channel.objects.create(channel_id=4, name='channel4', channel_type=self.channel_type, is_active=False)
+        get_all_channels_mocker.side_effect = lambda channel_type: {
+            'airqo': [
+                dict(name='new name', id=1),
+                dict(name='channel2 INACTIVE', id=2),
+                dict(name='channel3', id=3),
+                dict(name='channel4', id=4),
+                dict(name='channel5', id=5),
+                dict(name='channel6 INACTIVE', id=6),
+            ],
+            'soil': [],
+        }[channel_type]
+
+        update_all_channel_data()
+
+        assert Channel.objects.get(id=renamed.id).name == 'new name'
+        assert not Channel.objects.get(id=deactivated.id).is_active
+        assert Channel.objects.get(id=retyped.id).channel_type == self.channel_type
+        assert Channel.objects.get(id=reactivated.id).is_active
+        assert Channel.objects.get(channel_id=5).is_active
+        assert not Channel.objects.get(channel_id=6).is_active
+
+        # Nothing changed, so there's nothing to write
+        with CaptureQueriesContext(connection) as context:
+            update_all_channel_data(force=True)
+        assert not any(query['sql'].startswith(('INSERT', 'UPDATE')) for query in context.captured_queries)
+
+    @mock.patch('airqo_monitor.format_data.get_all_channels_by_type')
+    def test_update_all_channel_data_runs_once_per_interval(self, get_all_channels_mocker):
+        get_all_channels_mocker.return_value = []
+
+        update_all_channel_data()
+        update_all_channel_data()
+        assert get_all_channels_mocker.call_count == 1
+
+        update_all_channel_data(force=True)
+        assert get_all_channels_mocker.call_count == 2
+
+        # A failed sync is retried on the next call
+        cache.clear()
+        get_all_channels_mocker.side_effect = ValueError('Thingspeak is down')
+        with self.assertRaises(ValueError):
+            update_all_channel_data()
+        get_all_channels_mocker.side_effect = None
+        update_all_channel_data()
+        assert get_all_channels_mocker.call_count == 4
@@ -0,0 +1,122 @@
+import json
+import mock
+
+from datetime import timedelta
+from django.core.cache import cache
+from django.test import TestCase
+from django.utils import timezone
+
+from airqo_monitor.constants import JOB_ENQUEUE_LOCK_KEY
+from airqo_monitor.format_data import _get_and_format_data_for_channel_objects
+from airqo_monitor.jobs import (
+    JobProgress,
+    claim_next_job,
+    enqueue_job,
+    run_pending_jobs,
+)
+from airqo_monitor.models import Channel, ChannelType, Job
+
+
+class TestJobs(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_enqueue_job_deduplicates(self):
+        job, created = enqueue_job(Job.MALFUNCTION_SWEEP)
+        assert created
+        assert job.status == Job.QUEUED
+
+        assert enqueue_job(Job.MALFUNCTION_SWEEP) == (job, False)
+
+        # Still the same job once it's running
+        claim_next_job()
+        assert enqueue_job(Job.MALFUNCTION_SWEEP) == (job, False)
+
+        # A new one once it's done
+        Job.objects.filter(id=job.id).update(status=Job.SUCCEEDED)
+        new_job, created = enqueue_job(Job.MALFUNCTION_SWEEP)
+        assert created
+        assert new_job.id != job.id
+
+    @mock.patch('airqo_monitor.jobs.time.sleep')
+    @mock.patch('airqo_monitor.jobs.CACHE_LOCK_WAIT_SECONDS', 0)
+    def test_enqueue_job_leaves_another_workers_lock(self, sleep_mocker):
+        cache.add(JOB_ENQUEUE_LOCK_KEY, True)
+
+        job, created = enqueue_job(Job.MALFUNCTION_SWEEP)
+
+        assert created
+        assert cache.get(JOB_ENQUEUE_LOCK_KEY)
+
+    def test_stale_running_jobs_are_failed(self):
+        job = Job.objects.create(
+            kind=Job.MALFUNCTION_SWEEP,
+            status=Job.RUNNING,
+            started_at=timezone.now() - timedelta(days=1),
+        )
+
+        new_job, created = enqueue_job(Job.MALFUNCTION_SWEEP)
+
+        assert created
+        assert Job.objects.get(id=job.id).status == Job.FAILED
+
+    def test_claim_next_job(self):
+        first_job = Job.objects.create(kind=Job.MALFUNCTION_SWEEP)
+        second_job = Job.objects.create(kind=Job.MALFUNCTION_SWEEP)
+
+        assert claim_next_job() == first_job
+        assert Job.objects.get(id=first_job.id).status == Job.RUNNING
+        assert claim_next_job() == second_job
+        assert claim_next_job() is None
+
+    @mock.patch('airqo_monitor.jobs.get_all_channel_malfunctions')
+    def test_run_pending_jobs(self, get_all_channel_malfunctions_mocker):
+        def sweep(progress, **kwargs):
+            progress.start_stage('detecting', [1, 2])
+            progress.channels_done({1: 'ok'})
+            progress.channels_done({2: 'malfunctioning'})
+        get_all_channel_malfunctions_mocker.side_effect = sweep
+        job, _ = enqueue_job(Job.MALFUNCTION_SWEEP)
+
+        assert run_pending_jobs() == 1
+
+        job = Job.objects.get(id=job.id)
+        assert job.status == Job.SUCCEEDED
+        assert job.finished_at is not None
+        assert job.stage == 'detecting'
+        assert job.channel_progress == {'1': 'ok', '2': 'malfunctioning'}
+        assert run_pending_jobs() == 0
+
+    @mock.patch('airqo_monitor.jobs.get_all_channel_malfunctions')
+    def test_failed_job(self, get_all_channel_malfunctions_mocker):
+        get_all_channel_malfunctions_mocker.side_effect = ValueError('Thingspeak is down')
+        job, _ = enqueue_job(Job.MALFUNCTION_SWEEP)
+
+        run_pending_jobs()
+
+        job = Job.objects.get(id=job.id)
+        assert job.status == Job.FAILED
+        assert 'Thingspeak is down' in job.error
+
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    def test_fetch_progress_is_reported_per_channel(self, get_and_format_data_for_channel_mocker):
+        channel_type = ChannelType.objects.create(name='airqo', data_format_json=json.dumps({}))
+        channels = [
+            Channel.objects.create(channel_id=channel_id, name='channel', channel_type=channel_type)
+            for channel_id in [1, 2, 3]
+        ]
+
+        def get_data(channel, **kwargs):
+            if channel.channel_id == 2:
+                raise ValueError('bad channel')
+            return [channel.channel_id]
+        get_and_format_data_for_channel_mocker.side_effect = get_data
+        job = Job.objects.create(kind=Job.MALFUNCTION_SWEEP)
+
+        results = _get_and_format_data_for_channel_objects(channels, progress=JobProgress(job))
+
+        assert list(results) == [1, 3]
+        job = Job.objects.get(id=job.id)
+        assert job.stage == 'fetching'
+        assert job.channel_progress == {'1': 'fetched', '2': 'failed', '3': 'fetched'}
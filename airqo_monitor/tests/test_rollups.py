@@ -0,0 +1,113 @@
+import json
+import mock
+import pytz
+
+from datetime import datetime, timedelta
+from django.test import TestCase
+
+from airqo_monitor.feed_store import sync_feed_entries_for_channel
+from airqo_monitor.models import (
+    Channel,
+    ChannelRollup,
+    ChannelType,
+)
+from airqo_monitor.rollups import (
+    get_rollup_data_for_channel,
+    get_rollup_resolution,
+    rebuild_rollups_for_channel,
+)
+
+
+def make_feed(entry_id, created_at, pm_2_5, battery_voltage='3.9'):
+    return {
+        'entry_id': entry_id,
+        'created_at': datetime.strftime(created_at, '%Y-%m-%dT%H:%M:%SZ'),
+        'field2': pm_2_5,
+        'field7': battery_voltage,
+    }
+
+
+class TestRollups(TestCase):
+
+    def setUp(self):
+        self.channel_type, _ = ChannelType.objects.get_or_create(
+            name='airqo',
+            data_format_json=json.dumps({'field2': 'pm_2_5', 'field5': 'latitude', 'field7': 'battery_voltage'}),
+        )
+        self.channel = Channel.objects.create(channel_id=123, name='Test Name', channel_type=self.channel_type)
+        # Half past the hour, but never in the future, or syncs wouldn't fetch the newest entries
+        self.now = (datetime.utcnow() - timedelta(minutes=30)).replace(minute=30, second=0, microsecond=0)
+        self.this_hour = pytz.utc.localize(self.now.replace(minute=0))
+
+    def _get_rollup(self, resolution, field, bucket_start):
+        return ChannelRollup.objects.get(
+            channel=self.channel,
+            resolution=resolution,
+            field=field,
+            bucket_start=bucket_start,
+        )
+
+    @mock.patch('airqo_monitor.feed_store.iter_data_for_channel')
+    def test_rollups_are_updated_as_entries_are_stored(self, iter_data_for_channel_mocker):
+        iter_data_for_channel_mocker.return_value = [[
+            make_feed(1, self.now - timedelta(hours=1), '10'),
+            make_feed(2, self.now - timedelta(minutes=20), '20'),
+            make_feed(3, self.now - timedelta(minutes=10), 'not a number'),
+        ]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        rollup = self._get_rollup(ChannelRollup.HOUR, 'pm_2_5', self.this_hour)
+        assert (rollup.count, rollup.min, rollup.max, rollup.mean) == (1, 20.0, 20.0, 20.0)
+        assert self._get_rollup(ChannelRollup.HOUR, 'battery_voltage', self.this_hour).count == 2
+        assert not ChannelRollup.objects.filter(field='latitude').exists()
+
+        # A later sync adds its new entries to the buckets that are already there
+        iter_data_for_channel_mocker.return_value = [[
+            make_feed(2, self.now - timedelta(minutes=20), '20'),
+            make_feed(4, self.now - timedelta(minutes=5), '50'),
+        ]]
+        sync_feed_entries_for_channel(self.channel, start_time=self.now - timedelta(days=1))
+
+        rollup = self._get_rollup(ChannelRollup.HOUR, 'pm_2_5', self.this_hour)
+        assert (rollup.count, rollup.min, rollup.max, rollup.mean) == (2, 20.0, 50.0, 35.0)
+
+        daily_count = sum(
+            ChannelRollup.objects.filter(resolution=ChannelRollup.DAY, field='pm_2_5').values_list('count', flat=True)
+        )
+        assert daily_count == 3
+
+        # Rebuilding from the stored entries gives the same rollups
+        rebuild_rollups_for_channel(self.channel)
+        rollup = self._get_rollup(ChannelRollup.HOUR, 'pm_2_5', self.this_hour)
+        assert (rollup.count, rollup.min, rollup.max) == (2, 20.0, 50.0)
+
+    def test_get_rollup_resolution(self):
+        end_time = datetime(2018, 11, 1)
+        assert get_rollup_resolution(end_time - timedelta(days=7), end_time, max_points=500) == ChannelRollup.HOUR
+        assert get_rollup_resolution(end_time - timedelta(days=30), end_time, max_points=500) == ChannelRollup.DAY
+        assert get_rollup_resolution(end_time - timedelta(days=3650), end_time, max_points=500) == ChannelRollup.DAY
+
+    def test_get_rollup_data_for_channel(self):
+        for hours_ago, pm_2_5 in [(49, 5.0), (48, 15.0), (2, 25.0)]:
+            bucket_start = self.this_hour - timedelta(hours=hours_ago)
+            ChannelRollup.objects.create(
+                channel=self.channel,
+                resolution=ChannelRollup.HOUR,
+                field='pm_2_5',
+                bucket_start=bucket_start,
+                count=2,
+                sum=pm_2_5 * 2,
+                min=pm_2_5 - 1,
+                max=pm_2_5 + 1,
+            )
+
+        resolution, buckets = get_rollup_data_for_channel(
+            self.channel,
+            start_time=self.now - timedelta(hours=48),
+            field_names=['pm_2_5'],
+        )
+
+        assert resolution == ChannelRollup.HOUR
+        assert [bucket['pm_2_5']['mean'] for bucket in buckets] == [15.0, 25.0]
+        assert buckets[0]['bucket_start'] == datetime.strftime(self.this_hour - timedelta(hours=48), '%Y-%m-%dT%H:%M:%SZ')
+        assert buckets[0]['pm_2_5'] == {'count': 2, 'mean': 15.0, 'min': 14.0, 'max': 16.0}
@@ -16,8 +16,13 @@ from airqo_monitor.models import (
     MalfunctionReason,
 )
 from airqo_monitor.utils import (
+    clear_global_var_cache,
     create_channel_note,
     get_channel_history,
+    get_float_global_var_value,
+    get_int_global_var_value,
+    get_str_global_var_value,
+    map_concurrently,
     update_last_channel_update_time,
 )
 
@@ -69,3 +74,44 @@ class TestUtils(TestCase):
         update_last_channel_update_time()
         variable = GlobalVariable.objects.get(id=self.variable.id)
         assert variable.value is not None
+
+    def test_map_concurrently_keeps_order_and_skips_failures(self):
+        def square(value):
+            if value == 3:
+                raise ValueError('bad value')
+            return value * value
+
+        results = map_concurrently(square, [1, 2, 3, 4], max_workers=3)
+        assert results == [(1, 1), (2, 4), (4, 16)]
+
+    def test_map_concurrently_with_no_items(self):
+        assert map_concurrently(lambda value: value, []) == []
+
+    def test_global_var_values_are_cached(self):
+        GlobalVariable.objects.create(key='LOW_BATTERY_CUTOFF', value='3.3')
+        GlobalVariable.objects.create(key='AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION', value='10')
+
+        with self.assertNumQueries(1):
+            assert get_float_global_var_value('LOW_BATTERY_CUTOFF') == 3.3
+            assert get_int_global_var_value('AIRQO_NUM_REPORTS_TO_VERIFY_SENSOR_MALFUNCTION') == 10
+            assert get_str_global_var_value('LOW_BATTERY_CUTOFF') == '3.3'
+
+    def test_global_var_cache_is_cleared_on_save_and_delete(self):
+        variable = GlobalVariable.objects.create(key='LOW_BATTERY_CUTOFF', value='3.3')
+        assert get_float_global_var_value('LOW_BATTERY_CUTOFF') == 3.3
+
+        variable.value = '3.5'
+        variable.save()
+        assert get_float_global_var_value('LOW_BATTERY_CUTOFF') == 3.5
+
+        variable.delete()
+        with self.assertRaises(GlobalVariable.DoesNotExist):
+            get_float_global_var_value('LOW_BATTERY_CUTOFF')
+
+    def test_global_var_cache_reloads_for_unknown_keys(self):
+        clear_global_var_cache()
+        assert get_str_global_var_value(LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME) is None
+
+        # Simulate another process adding a variable without this process' signals firing
+        GlobalVariable.objects.bulk_create([GlobalVariable(key='NEW_VARIABLE', value='1')])
+        assert get_int_global_var_value('NEW_VARIABLE') == 1
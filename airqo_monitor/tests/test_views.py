@@ -4,18 +4,35 @@ import mock
 
 from bunch import Bunch
 from datetime import datetime
-from django.test import TestCase
+from django.core.cache import cache
+from django.db import connection
+from django.test import RequestFactory, TestCase
+from django.test.utils import CaptureQueriesContext
 
+from airqo_monitor.constants import LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME
+from airqo_monitor.objects.channel_data import ChannelData
 from airqo_monitor.models import (
     Channel,
     ChannelNote,
     ChannelType,
+    GlobalVariable,
     Incident,
+    Job,
     MalfunctionReason,
 )
+from airqo_monitor.utils import clear_global_var_cache
 from airqo_monitor.views import (
     channel_detail,
     channel_notes,
+    channel_rollups,
+    channel_type_channels_list,
+    channel_types_list,
+    heatmap_api,
+    index,
+    job_status,
+    malfunctions,
+    thingspeak_usage,
+    update_incidents,
 )
 
 
@@ -78,3 +95,298 @@ class TestChannelDetailView(TestCase):
         assert note.channel == self.channel
         assert note.author == 'rachel'
         assert note.note == 'notenote'
+
+
+class TestChannelListViews(TestCase):
+    def setUp(self):
+        self.channel_type, _ = ChannelType.objects.get_or_create(name='airqo', data_format_json=json.dumps({}))
+        self.malfunction_reason = MalfunctionReason.objects.create(name="Test Reason", description="test")
+        GlobalVariable.objects.create(key=LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME, value='2018-11-01T10:00:00Z')
+        self.num_channels = 0
+        cache.clear()
+
+    def _add_channels_with_incidents(self, num_channels):
+        for _ in range(num_channels):
+            self.num_channels += 1
+            channel = Channel.objects.create(
+                channel_id=self.num_channels,
+                name='Channel {}'.format(self.num_channels),
+                channel_type=self.channel_type,
+            )
+            Incident.objects.create(channel=channel, malfunction_reason=self.malfunction_reason)
+            Incident.objects.create(channel=channel, malfunction_reason=self.malfunction_reason)
+
+    def _count_queries(self, view, *args):
+        clear_global_var_cache()
+        with mock.patch('airqo_monitor.views.render') as render_mocker:
+            with CaptureQueriesContext(connection) as context:
+                view({}, *args)
+        channels = render_mocker.call_args[1]['context']['channels']
+        return len(context.captured_queries), channels
+
+    def test_query_count_does_not_depend_on_number_of_channels(self):
+        for view, args in [(index, []), (channel_types_list, []), (channel_type_channels_list, ['airqo'])]:
+            self._add_channels_with_incidents(1)
+            num_queries_before, channels = self._count_queries(view, *args)
+            assert len(channels) == self.num_channels
+
+            self._add_channels_with_incidents(5)
+            num_queries_after, channels = self._count_queries(view, *args)
+            assert len(channels) == self.num_channels
+            assert num_queries_before == num_queries_after
+
+    def test_index_serializes_open_incidents(self):
+        self._add_channels_with_incidents(1)
+        resolved_incident = Incident.objects.first()
+        resolved_incident.resolved_at = datetime.now()
+        resolved_incident.save()
+
+        _, channels = self._count_queries(index)
+
+        assert len(channels[0]['active_incidents']) == 1
+        assert channels[0]['active_incidents'][0]['malfunction_reason']['name'] == self.malfunction_reason.name
+
+    def test_channel_lists_are_cached_until_something_changes(self):
+        self._add_channels_with_incidents(2)
+
+        for view, args in [(index, []), (channel_types_list, []), (channel_type_channels_list, ['airqo'])]:
+            num_queries_uncached, channels = self._count_queries(view, *args)
+            num_queries_cached, cached_channels = self._count_queries(view, *args)
+            assert num_queries_cached == 1
+            assert num_queries_cached < num_queries_uncached
+            assert cached_channels == channels
+
+        # Writing a note or an incident invalidates the cached lists
+        channel = Channel.objects.first()
+        ChannelNote.objects.create(channel=channel, note='note', author='Rachel')
+        num_queries, _ = self._count_queries(index)
+        assert num_queries > 1
+
+        Incident.objects.create(channel=channel, malfunction_reason=self.malfunction_reason)
+        num_queries, channels = self._count_queries(index)
+        assert num_queries > 1
+        assert len(channels[0]['active_incidents']) == 3
+
+        # So does a sweep finishing
+        GlobalVariable.objects.filter(key=LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME).update(value='2018-11-01T11:00:00Z')
+        num_queries, _ = self._count_queries(index)
+        assert num_queries > 1
+
+
+class TestChannelRollupsView(TestCase):
+    def setUp(self):
+        self.channel_type, _ = ChannelType.objects.get_or_create(name='airqo', data_format_json=json.dumps({}))
+        self.channel = Channel.objects.create(channel_id=1, name='Channel 1', channel_type=self.channel_type)
+        self.request_factory = RequestFactory()
+
+    def test_channel_rollups(self):
+        response = channel_rollups(
+            self.request_factory.get('/', {'start_time': '2018-11-01T00:00:00Z', 'max_points': '10'}),
+            self.channel.channel_id,
+        )
+
+        assert response.status_code == 200
+        assert json.loads(response.content.decode('utf-8')) == {'resolution': 'day', 'buckets': []}
+
+    def test_channel_rollups_rejects_invalid_filters(self):
+        for query in (
+                {'start_time': 'last week'},
+                {'end_time': '2018-11-01'},
+                {'max_points': 'lots'},
+                {'max_points': '0'},
+        ):
+            response = channel_rollups(self.request_factory.get('/', query), self.channel.channel_id)
+            assert response.status_code == 400, query
+
+
+class TestMalfunctionsView(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.channels = [{'name': 'Channel 1', 'channel_id': 1, 'possible_malfunction_reasons': ['no_data']}]
+
+    @mock.patch('airqo_monitor.views.get_cached_malfunctions_with_age')
+    def test_malfunctions_are_served_with_their_age(self, get_cached_malfunctions_with_age_mocker):
+        get_cached_malfunctions_with_age_mocker.return_value = (self.channels, 42.5)
+
+        response = malfunctions(RequestFactory().get('/api/malfunctions/'))
+
+        assert json.loads(response.content.decode('utf-8')) == {'age_seconds': 42, 'channels': self.channels}
+        assert not Job.objects.exists()
+
+    @mock.patch('airqo_monitor.jobs.get_all_channel_malfunctions')
+    @mock.patch('airqo_monitor.views.get_cached_malfunctions_with_age')
+    def test_stale_malfunctions_are_served_while_a_sweep_is_queued(self, get_cached_malfunctions_with_age_mocker,
+                                                                   get_all_channel_malfunctions_mocker):
+        get_cached_malfunctions_with_age_mocker.return_value = (self.channels, 600.0)
+
+        response = malfunctions(RequestFactory().get('/api/malfunctions/'))
+        malfunctions(RequestFactory().get('/api/malfunctions/'))
+
+        assert json.loads(response.content.decode('utf-8')) == {'age_seconds': 600, 'channels': self.channels}
+        assert Job.objects.get().kind == Job.MALFUNCTION_SWEEP
+        # The scheduler's worker sweeps, never the request
+        assert not get_all_channel_malfunctions_mocker.called
+
+    @mock.patch('airqo_monitor.jobs.get_all_channel_malfunctions')
+    def test_missing_malfunctions_are_unavailable_until_the_sweep_runs(self, get_all_channel_malfunctions_mocker):
+        response = malfunctions(RequestFactory().get('/api/malfunctions/'))
+
+        assert response.status_code == 503
+        assert response['Retry-After'] == '60'
+        job = Job.objects.get()
+        assert json.loads(response.content.decode('utf-8')) == {
+            'job_id': job.id,
+            'status': Job.QUEUED,
+            'status_url': '/api/jobs/{}/'.format(job.id),
+        }
+        assert not get_all_channel_malfunctions_mocker.called
+
+
+class TestThingspeakUsageView(TestCase):
+    def test_thingspeak_usage(self):
+        response = thingspeak_usage(RequestFactory().get('/', {'hours': '2'}))
+
+        assert response.status_code == 200
+        assert json.loads(response.content.decode('utf-8')) == {'hours': [], 'channels': []}
+
+    def test_thingspeak_usage_rejects_invalid_hours(self):
+        for hours in ('a day', '0', '-1'):
+            response = thingspeak_usage(RequestFactory().get('/', {'hours': hours}))
+            assert response.status_code == 400, hours
+
+
+class TestHeatmapApiView(TestCase):
+    def setUp(self):
+        self.channel_type, _ = ChannelType.objects.get_or_create(name='airqo', data_format_json=json.dumps({}))
+        self.channel = Channel.objects.create(
+            channel_id=1,
+            name='Channel 1',
+            channel_type=self.channel_type,
+            feed_last_entry_id=2,
+            feed_last_entry_at=datetime(2018, 11, 1, 10, 0),
+        )
+        self.request_factory = RequestFactory()
+
+    @mock.patch('airqo_monitor.views.sync_feed_entries_for_channels')
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    def test_heatmap_api_streams_geojson(self, get_and_format_data_for_channel_mocker, sync_mocker):
+        get_and_format_data_for_channel_mocker.return_value = ChannelData.from_entries([
+            {'entry_id': 1, 'created_at': '2018-11-01T09:50:00Z', 'latitude': '0.31', 'longitude': '32.51', 'pm_2_5': '10'},
+            {'entry_id': 2, 'created_at': '2018-11-01T10:00:00Z', 'latitude': '1.51', 'longitude': '32.51', 'pm_2_5': '30'},
+        ])
+
+        response = heatmap_api(self.request_factory.get('/api/heatmap/', {'cell_size': '1.0'}))
+
+        assert response.streaming
+        assert response['ETag']
+        assert response['Last-Modified'] == 'Thu, 01 Nov 2018 10:00:00 GMT'
+        geojson = json.loads(b''.join(response.streaming_content).decode('utf-8'))
+        assert geojson['type'] == 'FeatureCollection'
+        assert sorted(feature['properties']['mean_pm_2_5'] for feature in geojson['features']) == [10.0, 30.0]
+        # Nothing waits for every channel to sync: each is synced as the stream gets to it
+        assert not sync_mocker.called
+        assert get_and_format_data_for_channel_mocker.call_args[1]['sync'] is True
+
+    @mock.patch('airqo_monitor.views.sync_feed_entries_for_channels')
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    def test_heatmap_api_rejects_invalid_filters(self, get_and_format_data_for_channel_mocker, sync_mocker):
+        for query in (
+                {'cell_size': 'big'},
+                {'cell_size': '0'},
+                {'cell_size': '-0.5'},
+                {'cell_size': 'nan'},
+                {'window_minutes': 'ten'},
+                {'window_minutes': '0'},
+                {'channel_ids': '1,two'},
+                {'start_time': 'yesterday'},
+        ):
+            response = heatmap_api(self.request_factory.get('/api/heatmap/', query))
+            assert response.status_code == 400, query
+
+        assert not get_and_format_data_for_channel_mocker.called
+        assert not sync_mocker.called
+
+    @mock.patch('airqo_monitor.views.sync_feed_entries_for_channels')
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    def test_heatmap_api_is_not_modified_until_a_new_entry_is_stored(self, get_and_format_data_for_channel_mocker,
+                                                                     sync_mocker):
+        get_and_format_data_for_channel_mocker.return_value = ChannelData.from_entries([])
+        query = {'start_time': '2018-11-01T09:00'}
+        etag = heatmap_api(self.request_factory.get('/api/heatmap/', query))['ETag']
+
+        response = heatmap_api(self.request_factory.get('/api/heatmap/', query, HTTP_IF_NONE_MATCH=etag))
+        assert response.status_code == 304
+        assert response['ETag'] == etag
+        # The channels are synced before saying so
+        assert sync_mocker.call_count == 1
+
+        # That sync stores a new entry, so the client gets it, read straight from the store
+        def store_new_entry(channels, **kwargs):
+            for channel in channels:
+                channel.feed_last_entry_id = 3
+        sync_mocker.side_effect = store_new_entry
+        response = heatmap_api(self.request_factory.get('/api/heatmap/', query, HTTP_IF_NONE_MATCH=etag))
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+        b''.join(response.streaming_content)
+        assert get_and_format_data_for_channel_mocker.call_args[1]['sync'] is False
+
+    @mock.patch('airqo_monitor.views.sync_feed_entries_for_channels')
+    @mock.patch('airqo_monitor.format_data.get_and_format_data_for_channel')
+    def test_heatmap_api_etag_changes_with_the_window(self, get_and_format_data_for_channel_mocker, sync_mocker):
+        get_and_format_data_for_channel_mocker.return_value = ChannelData.from_entries([])
+        etag = heatmap_api(self.request_factory.get('/api/heatmap/', {'start_time': '2018-11-01T09:00'}))['ETag']
+
+        response = heatmap_api(self.request_factory.get(
+            '/api/heatmap/', {'start_time': '2018-11-01T09:30'}, HTTP_IF_NONE_MATCH=etag))
+        assert response.status_code == 200
+
+        # The default window slides with the clock
+        with mock.patch('airqo_monitor.views.datetime') as datetime_mocker:
+            datetime_mocker.strptime = datetime.strptime
+            datetime_mocker.strftime = datetime.strftime
+            datetime_mocker.utcnow.return_value = datetime(2018, 11, 2, 9, 0)
+            etag = heatmap_api(self.request_factory.get('/api/heatmap/'))['ETag']
+            datetime_mocker.utcnow.return_value = datetime(2018, 11, 2, 9, 5)
+            response = heatmap_api(self.request_factory.get('/api/heatmap/', HTTP_IF_NONE_MATCH=etag))
+        assert response.status_code == 200
+
+
+class TestJobViews(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    @mock.patch('airqo_monitor.jobs.get_all_channel_malfunctions')
+    def test_update_incidents_queues_a_sweep(self, get_all_channel_malfunctions_mocker):
+        response = update_incidents(self.factory.post('/update_incidents/'))
+
+        assert response.status_code == 202
+        data = json.loads(response.content.decode('utf-8'))
+        job = Job.objects.get(id=data['job_id'])
+        assert job.kind == Job.MALFUNCTION_SWEEP
+        assert data['created']
+        assert data['status_url'] == '/api/jobs/{}/'.format(job.id)
+        assert not get_all_channel_malfunctions_mocker.called
+
+        # A second request joins the queued sweep
+        response = update_incidents(self.factory.post('/update_incidents/'))
+        data = json.loads(response.content.decode('utf-8'))
+        assert data['job_id'] == job.id
+        assert not data['created']
+
+    def test_job_status(self):
+        job = Job.objects.create(
+            kind=Job.MALFUNCTION_SWEEP,
+            status=Job.RUNNING,
+            stage='fetching',
+            channel_progress_json=json.dumps({'1': 'fetched', '2': 'pending', '3': 'failed'}),
+        )
+
+        response = job_status(self.factory.get('/api/jobs/{}/'.format(job.id)), job.id)
+
+        data = json.loads(response.content.decode('utf-8'))
+        assert data['status'] == Job.RUNNING
+        assert data['stage'] == 'fetching'
+        assert (data['num_channels'], data['num_channels_done']) == (3, 2)
+        assert data['channels']['3'] == 'failed'
@@ -1,6 +1,20 @@
-from datetime import datetime
+import pytz
+import time
+import traceback
 
-from airqo_monitor.constants import LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from django.db import connection
+from django.db.models import Prefetch
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from airqo_monitor.constants import (
+    GLOBAL_VARIABLE_CACHE_TTL_SECONDS,
+    LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME,
+    THINGSPEAK_MAX_CONCURRENT_REQUESTS,
+)
 from airqo_monitor.models import (
     Channel,
     ChannelNote,
@@ -9,19 +23,60 @@ from airqo_monitor.models import (
 )
 
 
+# Every GlobalVariable, keyed by key. Edits made in this process clear it straight away through
+# the signal receivers below; the TTL picks up edits made by other processes (e.g. other gunicorn
+# workers or the admin on another dyno).
+_global_var_cache = {'values': None, 'loaded_at': 0}
+
+
+@receiver(post_save, sender=GlobalVariable)
+@receiver(post_delete, sender=GlobalVariable)
+def clear_global_var_cache(**kwargs):
+    _global_var_cache['values'] = None
+
+
+def get_global_var_values(refresh=False):
+    """
+    Get every GlobalVariable from the in-process cache, loading them all in one query when the
+    cache is empty, expired or refresh is True.
+
+    Returns: dict {key: string value}
+    """
+    values = _global_var_cache['values']
+    is_expired = time.time() - _global_var_cache['loaded_at'] > GLOBAL_VARIABLE_CACHE_TTL_SECONDS
+    if refresh or values is None or is_expired:
+        values = dict(GlobalVariable.objects.values_list('key', 'value'))
+        _global_var_cache.update(values=values, loaded_at=time.time())
+    return values
+
+
+def get_str_global_var_value(key):
+    values = get_global_var_values()
+    if key not in values:
+        # The variable may have been created by another process since we loaded, so look once more
+        values = get_global_var_values(refresh=True)
+        if key not in values:
+            raise GlobalVariable.DoesNotExist('GlobalVariable {} does not exist.'.format(key))
+    return values[key]
+
+
 def get_int_global_var_value(key):
-    var = GlobalVariable.objects.get(key=key)
-    return int(var.value)
+    return int(get_str_global_var_value(key))
 
 
 def get_float_global_var_value(key):
-    var = GlobalVariable.objects.get(key=key)
-    return float(var.value)
+    return float(get_str_global_var_value(key))
 
 
-def get_str_global_var_value(key):
-    var = GlobalVariable.objects.get(key=key)
-    return var.value
+def prefetch_open_incidents(channels):
+    """
+    Load the open incidents (and their malfunction reasons) for a queryset of channels in one
+    extra query, and attach them to each channel as channel.open_incidents for ChannelSerializer.
+    """
+    open_incidents = Incident.objects.filter(resolved_at__isnull=True).select_related('malfunction_reason')
+    return channels.prefetch_related(
+        Prefetch('incident_set', queryset=open_incidents, to_attr='open_incidents')
+    )
 
 
 def get_channel_history(channel):
@@ -53,3 +108,71 @@ def update_last_channel_update_time():
     variable = GlobalVariable.objects.get(key=LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME)
     variable.value = datetime.strftime(datetime.now(),'%Y-%m-%dT%H:%M:%SZ')
     variable.save()
+
+
+def to_utc(value):
+    """
+    Naive datetimes in this app are UTC (they come from datetime.utcnow() or Thingspeak), so
+    make them aware. Aware datetimes are converted to UTC.
+    """
+    if timezone.is_naive(value):
+        return timezone.make_aware(value, pytz.utc)
+    return value.astimezone(pytz.utc)
+
+
+def map_concurrently(func, items, max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS):
+    """
+    Call func(item) for every item using a bounded pool of worker threads. An exception for one
+    item is logged and that item is skipped, so one bad channel can't fail the whole batch.
+
+    Returns: list of (item, result) tuples for the items that succeeded, in the same order as items
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    def run(item):
+        try:
+            return True, func(item)
+        except Exception:
+            print('[map_concurrently] Failed for {}: {}'.format(item, traceback.format_exc()))
+            return False, None
+        finally:
+            # Every worker thread opens its own DB connection, so close it rather than leak it
+            connection.close()
+
+    num_workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        outcomes = list(executor.map(run, items))
+
+    return [(item, result) for item, (succeeded, result) in zip(items, outcomes) if succeeded]
+
+
+def iter_concurrently(func, items, max_workers=THINGSPEAK_MAX_CONCURRENT_REQUESTS):
+    """
+    Like map_concurrently, but yield each (item, result) as soon as its call finishes, so the
+    caller can start using the fast items without waiting for the slowest one.
+
+    Returns: generator of (item, result) tuples for the items that succeeded, in completion order
+    """
+    items = list(items)
+    if not items:
+        return
+
+    def run(item):
+        try:
+            return func(item)
+        finally:
+            connection.close()
+
+    num_workers = max(1, min(max_workers, len(items)))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = {executor.submit(run, item): item for item in items}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                result = future.result()
+            except Exception:
+                print('[iter_concurrently] Failed for {}: {}'.format(item, traceback.format_exc()))
+                continue
+            yield item, result
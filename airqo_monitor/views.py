@@ -1,32 +1,42 @@
+import calendar
+import hashlib
 import pytz
 
 from datetime import datetime
 from django.shortcuts import redirect, render
-from django.http import Http404, HttpResponse
-from django.utils.safestring import mark_safe
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
 import json as simplejson
 from datetime import datetime, timedelta
 from urllib import parse
 
+from airqo_monitor.caching import get_or_set_dashboard_data
 from airqo_monitor.constants import (
+    HEATMAP_GRID_CELL_DEGREES,
+    MALFUNCTIONS_CACHE_TIMEOUT_SECONDS,
+    MALFUNCTIONS_RETRY_AFTER_SECONDS,
     PYTZ_KAMPALA_STRING,
     LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME,
 )
-from airqo_monitor.models import Incident
-from airqo_monitor.malfunction_detection.get_malfunctions import (
-    get_all_channel_malfunctions
-)
+from airqo_monitor.external.usage import get_usage_summary
+from airqo_monitor.feed_store import sync_feed_entries_for_channels
 from airqo_monitor.format_data import (
-    get_and_format_heatmap_data_for_all_channels,
-    get_and_format_heatmap_data_for_channels,
+    get_heatmap_channels,
+    iter_heatmap_features_for_channels,
 )
+from airqo_monitor.jobs import enqueue_job
+from airqo_monitor.malfunction_detection.get_malfunctions import get_cached_malfunctions_with_age
 from airqo_monitor.models import (
     Channel,
     ChannelNote,
     ChannelType,
     GlobalVariable,
     Incident,
+    Job,
 )
+from airqo_monitor.rollups import get_rollup_data_for_channel
 from airqo_monitor.serializers import (
     ChannelHistorySerializer,
     ChannelSerializer,
@@ -37,20 +47,33 @@ from airqo_monitor.serializers import (
 from airqo_monitor.utils import (
     create_channel_note,
     get_channel_history,
+    get_str_global_var_value,
+    prefetch_open_incidents,
 )
 
 def index(request):
     local_tz = pytz.timezone(PYTZ_KAMPALA_STRING)
     last_update = GlobalVariable.objects.get(key=LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME)
     last_update_datetime = datetime.strptime(last_update.value,'%Y-%m-%dT%H:%M:%SZ').astimezone(local_tz)
+
+    dashboard_data = get_or_set_dashboard_data(
+        'index',
+        last_update.value,
+        lambda: {
+            "channels": ChannelSerializer(
+                prefetch_open_incidents(Channel.objects.filter(is_active=True)),
+                many=True,
+            ).data,
+            "all_channel_types": ChannelTypeSerializer(ChannelType.objects.all(), many=True).data,
+        },
+    )
     return render(
         request,
         "index.html",
-        context={
-            "channels": ChannelSerializer(Channel.objects.filter(is_active=True), many=True).data,
-            "all_channel_types": ChannelTypeSerializer(ChannelType.objects.all(), many=True).data,
-            "last_update_time": datetime.strftime(last_update_datetime,'%d/%m/%Y at %H:%M')
-        },
+        context=dict(
+            dashboard_data,
+            last_update_time=datetime.strftime(last_update_datetime,'%d/%m/%Y at %H:%M'),
+        ),
     )
 
 
@@ -81,39 +104,120 @@ def channel_detail(request, channel_id):
     )
 
 
-def channel_types_list(request):
-    channels = Channel.objects.filter(is_active=True)
+def channel_rollups(request, channel_id):
+    """
+    Hourly or daily min/mean/max/count of the channel's fields, at whichever resolution keeps the
+    requested range (by default, the last week) under max_points buckets.
+    """
+    try:
+        channel = Channel.objects.select_related('channel_type').get(channel_id=channel_id)
+    except Channel.DoesNotExist:
+        raise Http404("Cannot find channel.")
 
-    return render(
-        request,
-        "channels_list.html",
-        context={
+    fields = request.GET.get('fields')
+    rollup_kwargs = dict(field_names=fields.split(',') if fields else None)
+    try:
+        for name in ('start_time', 'end_time'):
+            if request.GET.get(name):
+                rollup_kwargs[name] = datetime.strptime(request.GET[name], '%Y-%m-%dT%H:%M:%SZ')
+        if request.GET.get('max_points'):
+            rollup_kwargs['max_points'] = int(request.GET['max_points'])
+            if rollup_kwargs['max_points'] <= 0:
+                raise ValueError('max_points must be positive')
+    except ValueError as e:
+        return HttpResponseBadRequest('Invalid rollup filters: {}'.format(e))
+
+    resolution, buckets = get_rollup_data_for_channel(channel, **rollup_kwargs)
+    return JsonResponse({"resolution": resolution, "buckets": buckets})
+
+
+def malfunctions(request):
+    """
+    Each active channel's possible malfunctions as of the latest full sweep, served from the
+    cache (see get_cached_malfunctions_with_age), so age_seconds says how old it is. Once it's
+    stale a sweep is queued for the run_scheduler worker. If there's no result to serve yet, the
+    response is a 503 saying which job to wait for.
+    """
+    channels, age = get_cached_malfunctions_with_age()
+    if channels is not None and age < MALFUNCTIONS_CACHE_TIMEOUT_SECONDS:
+        return JsonResponse({"age_seconds": int(age), "channels": channels})
+
+    job, _ = enqueue_job(Job.MALFUNCTION_SWEEP)
+    if channels is not None:
+        return JsonResponse({"age_seconds": int(age), "channels": channels})
+
+    response = JsonResponse(
+        {
+            "job_id": job.id,
+            "status": job.status,
+            "status_url": reverse('job_status', args=[job.id]),
+        },
+        status=503,
+    )
+    response['Retry-After'] = str(MALFUNCTIONS_RETRY_AFTER_SECONDS)
+    return response
+
+
+def thingspeak_usage(request):
+    """
+    The Thingspeak requests made (and bytes received) per hour and per channel over the last
+    `hours` hours (24 by default).
+    """
+    try:
+        hours = int(request.GET.get('hours') or 24)
+        if hours <= 0:
+            raise ValueError('hours must be positive')
+    except ValueError as e:
+        return HttpResponseBadRequest('Invalid usage filters: {}'.format(e))
+    return JsonResponse(get_usage_summary(hours=hours))
+
+
+def channel_types_list(request):
+    def get_channels_list_data():
+        channels = prefetch_open_incidents(Channel.objects.filter(is_active=True))
+        return {
             "channels": ChannelSerializer(channels, many=True).data,
             "all_channel_types": ChannelTypeSerializer(ChannelType.objects.all(), many=True).data,
             "channel_type_name": "",
         }
+
+    return render(
+        request,
+        "channels_list.html",
+        context=get_or_set_dashboard_data(
+            'channel_types_list',
+            get_str_global_var_value(LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME),
+            get_channels_list_data,
+        ),
     )
 
 
 def channel_type_channels_list(request, channel_type):
-    try:
-        channel_type = ChannelType.objects.get(name=channel_type)
-        channels = Channel.objects.filter(channel_type=channel_type, is_active=True)
-    except ChannelType.DoesNotExist:
-        raise Http404("Cannot find channel type {}. Possible types are: {}".format(
-                channel_type,
-                ChannelType.objects.all(),
+    def get_channels_list_data():
+        try:
+            channel_type_object = ChannelType.objects.get(name=channel_type)
+            channels = prefetch_open_incidents(Channel.objects.filter(channel_type=channel_type_object, is_active=True))
+        except ChannelType.DoesNotExist:
+            raise Http404("Cannot find channel type {}. Possible types are: {}".format(
+                    channel_type,
+                    ChannelType.objects.all(),
+                )
             )
-        )
 
-    return render(
-        request,
-        "channels_list.html",
-        context={
+        return {
             "channels": ChannelSerializer(channels, many=True).data,
             "all_channel_types": ChannelTypeSerializer(ChannelType.objects.all(), many=True).data,
-            "channel_type_name": channel_type,
+            "channel_type_name": channel_type_object,
         }
+
+    return render(
+        request,
+        "channels_list.html",
+        context=get_or_set_dashboard_data(
+            'channel_type_channels_list:{}'.format(channel_type),
+            get_str_global_var_value(LAST_CHANNEL_UPDATE_TIME_GLOBARLVAR_NAME),
+            get_channels_list_data,
+        ),
     )
 
 
@@ -134,13 +238,60 @@ def channel_notes(request):
 
 
 def update_incidents(request):
-    get_all_channel_malfunctions()
-    return redirect('/')
+    """
+    Queue a malfunction sweep for the run_scheduler worker (or join the one already queued or
+    running) and return straight away with its id and where to check on it.
+    """
+    job, created = enqueue_job(Job.MALFUNCTION_SWEEP)
+    return JsonResponse(
+        {
+            "job_id": job.id,
+            "created": created,
+            "status": job.status,
+            "status_url": reverse('job_status', args=[job.id]),
+        },
+        status=202,
+    )
 
-def heatmap(request):
+
+def _format_datetime(value):
+    return datetime.strftime(value, '%Y-%m-%dT%H:%M:%SZ') if value else None
+
+
+def job_status(request, job_id):
+    """
+    A job's status, with its current stage and each channel's progress through that stage.
+    """
+    try:
+        job = Job.objects.get(id=job_id)
+    except Job.DoesNotExist:
+        raise Http404("Cannot find job.")
+
+    channel_progress = job.channel_progress
+    return JsonResponse({
+        "job_id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "created_at": _format_datetime(job.created_at),
+        "started_at": _format_datetime(job.started_at),
+        "finished_at": _format_datetime(job.finished_at),
+        "stage": job.stage,
+        "num_channels": len(channel_progress),
+        "num_channels_done": len([status for status in channel_progress.values() if status != 'pending']),
+        "channels": channel_progress,
+        "error": job.error,
+    })
+
+def _get_heatmap_query(request):
+    """
+    Parse the heatmap filters out of the query string.
+
+    Raises ValueError if one of them isn't valid.
+
+    Returns: dict of keyword arguments for the heatmap data functions
+    """
     query_string = request.META.get('QUERY_STRING')
     queries = parse.parse_qs(query_string)
-    local_tz = pytz.timezone(PYTZ_KAMPALA_STRING)
 
     start_time = None
     end_time = None
@@ -151,7 +302,8 @@ def heatmap(request):
         cleaned_str = start_time_str[0].replace('%3A', ':') + ':00Z'
         start_time = datetime.strptime(cleaned_str,'%Y-%m-%dT%H:%M:%SZ')
     else:
-        start_time = datetime.utcnow() - timedelta(days=1)
+        # Whole minutes, so the window (and the ETag) only moves once a minute
+        start_time = datetime.utcnow().replace(second=0, microsecond=0) - timedelta(days=1)
 
     end_time_str = queries.get('end_time', None)
     if end_time_str:
@@ -160,12 +312,120 @@ def heatmap(request):
 
     channel_ids_str = queries.get('channel_ids', None)
     if channel_ids_str:
-        channel_ids = channel_ids_str[0].split(',')
+        channel_ids = [int(channel_id) for channel_id in channel_ids_str[0].split(',')]
+
+    cell_size_str = queries.get('cell_size', None)
+    cell_size_degrees = float(cell_size_str[0]) if cell_size_str else HEATMAP_GRID_CELL_DEGREES
+    # Also rules out NaN and infinity, which would bin every reading into nonsense cells
+    if not 0 < cell_size_degrees < float('inf'):
+        raise ValueError('cell_size must be a positive number of degrees')
+
+    window_minutes_str = queries.get('window_minutes', None)
+    time_window_minutes = int(window_minutes_str[0]) if window_minutes_str else None
+    if time_window_minutes is not None and time_window_minutes <= 0:
+        raise ValueError('window_minutes must be a positive number of minutes')
+
+    return {
+        "start_time": start_time,
+        "end_time": end_time,
+        "channel_ids": channel_ids,
+        "cell_size_degrees": cell_size_degrees,
+        "time_window_minutes": time_window_minutes,
+    }
 
-    heatmap_data = get_and_format_heatmap_data_for_channels(
-        start_time=start_time,
-        end_time=end_time,
-        channel_ids=channel_ids,
+
+def _get_heatmap_etag(heatmap_query, channels):
+    """
+    The heatmap only changes when one of its channels stores a newer entry or its window moves,
+    so the resolved filters plus the newest entry id of each channel identify a version of the
+    response.
+    """
+    last_entry_ids = sorted((channel.channel_id, channel.feed_last_entry_id) for channel in channels)
+    version = '{}|{}|{}|{}|{}|{}'.format(
+        _format_datetime(heatmap_query["start_time"]),
+        _format_datetime(heatmap_query["end_time"]),
+        heatmap_query["channel_ids"],
+        heatmap_query["cell_size_degrees"],
+        heatmap_query["time_window_minutes"],
+        last_entry_ids,
     )
-    heatmap_json = simplejson.dumps(heatmap_data)
-    return render(request, "heatmap.html", context={"geojson_points": mark_safe(heatmap_data)})
+    return quote_etag(hashlib.md5(version.encode('utf-8')).hexdigest())
+
+
+def _get_heatmap_last_modified(channels):
+    """Returns: Unix timestamp of the newest entry stored for any of the channels, or None"""
+    last_entry_times = [channel.feed_last_entry_at for channel in channels if channel.feed_last_entry_at]
+    if not last_entry_times:
+        return None
+    return calendar.timegm(max(last_entry_times).utctimetuple())
+
+
+def _stream_heatmap_geojson(features_by_channel):
+    """
+    Write the FeatureCollection out a channel at a time, with one feature per line so the page
+    can draw each batch as it arrives.
+    """
+    yield '{"type": "FeatureCollection", "features": [\n'
+    separator = ''
+    for features in features_by_channel:
+        if not features:
+            continue
+        yield separator + ',\n'.join(simplejson.dumps(feature) for feature in features)
+        separator = ',\n'
+    yield '\n]}\n'
+
+
+def heatmap_api(request):
+    try:
+        heatmap_query = _get_heatmap_query(request)
+    except ValueError as e:
+        return HttpResponseBadRequest('Invalid heatmap filters: {}'.format(e))
+
+    # The validators first come from what's stored, so a full response can start straight away,
+    # syncing each channel and writing its features as soon as that channel is done. Its content
+    # is then never older than its ETag (at worst the next revalidation fetches it again).
+    channels = list(get_heatmap_channels(heatmap_query["channel_ids"]))
+    etag = _get_heatmap_etag(heatmap_query, channels)
+    last_modified = _get_heatmap_last_modified(channels)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    sync = True
+
+    if response is not None and response.status_code == 304:
+        # The client has what's stored, so only sync to see whether Thingspeak has anything newer
+        # before telling it nothing's changed. There's no body to hold up while this runs.
+        sync_feed_entries_for_channels(
+            channels,
+            start_time=heatmap_query["start_time"],
+            end_time=heatmap_query["end_time"],
+        )
+        etag = _get_heatmap_etag(heatmap_query, channels)
+        last_modified = _get_heatmap_last_modified(channels)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        sync = False
+
+    if response is None:
+        features_by_channel = iter_heatmap_features_for_channels(
+            channels,
+            start_time=heatmap_query["start_time"],
+            end_time=heatmap_query["end_time"],
+            cell_size_degrees=heatmap_query["cell_size_degrees"],
+            time_window_minutes=heatmap_query["time_window_minutes"],
+            sync=sync,
+        )
+        response = StreamingHttpResponse(_stream_heatmap_geojson(features_by_channel), content_type='application/json')
+        # Always revalidate, which is cheap thanks to the ETag
+        response['Cache-Control'] = 'no-cache'
+
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def heatmap(request):
+    query_string = request.META.get('QUERY_STRING')
+    heatmap_api_url = reverse('heatmap_api')
+    if query_string:
+        heatmap_api_url += '?' + query_string
+
+    return render(request, "heatmap.html", context={"heatmap_api_url": heatmap_api_url})
@@ -90,6 +90,33 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+# The default in-memory cache is per process. To share cached Thingspeak and malfunction data,
+# and the Thingspeak rate limit, between the web workers and the clock process, use e.g. the database cache
+# (CACHE_BACKEND=django.core.cache.backends.db.DatabaseCache, CACHE_LOCATION=airqo_monitor_cache,
+# then run `manage.py createcachetable`) or the file-based one
+# (CACHE_BACKEND=django.core.cache.backends.filebased.FileBasedCache, CACHE_LOCATION=/tmp/airqo-monitor-cache).
+
+CACHES = {
+    "default": {
+        "BACKEND": os.environ.get("CACHE_BACKEND", "django.core.cache.backends.locmem.LocMemCache"),
+        "LOCATION": os.environ.get("CACHE_LOCATION", "airqo-monitor"),
+    }
+}
+
+# How old (in seconds) a cached malfunction sweep can get before it's no longer served, while a
+# new one is queued for the scheduler. Leave unset for the default.
+MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS = int(os.environ.get("MALFUNCTIONS_CACHE_HARD_TIMEOUT_SECONDS", 0)) or None
+
+# Thingspeak
+# Leave these unset to use thingspeak.com. To run against a local stand-in instead (see the
+# run_fake_thingspeak command), set them to e.g. http://127.0.0.1:8001/channels/{} and
+# http://127.0.0.1:8001/channels.json
+
+THINGSPEAK_FEEDS_LIST_URL = os.environ.get("THINGSPEAK_FEEDS_LIST_URL")
+THINGSPEAK_CHANNELS_LIST_URL = os.environ.get("THINGSPEAK_CHANNELS_LIST_URL")
+
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
 
@@ -20,10 +20,15 @@ urlpatterns = [
     path("db/", airqo_monitor.views.db, name="db"),
     path("admin/", admin.site.urls),
     path("channels/<int:channel_id>/", airqo_monitor.views.channel_detail, name="channel_detail"),
+    path("api/channels/<int:channel_id>/rollups/", airqo_monitor.views.channel_rollups, name="channel_rollups"),
     path("channel_notes/", airqo_monitor.views.channel_notes, name="channel_note"),
     path("update_incidents/", airqo_monitor.views.update_incidents, name='update_incidents'),
+    path("api/jobs/<int:job_id>/", airqo_monitor.views.job_status, name='job_status'),
+    path("api/malfunctions/", airqo_monitor.views.malfunctions, name='malfunctions'),
+    path("api/thingspeak/usage/", airqo_monitor.views.thingspeak_usage, name='thingspeak_usage'),
     path("channel_types/", airqo_monitor.views.channel_types_list, name='all_channels_list'),
     path("channel_types/<str:channel_type>/", airqo_monitor.views.channel_type_channels_list, name='channels_list'),
     path("heatmap/", airqo_monitor.views.heatmap, name="heatmap"),
+    path("api/heatmap/", airqo_monitor.views.heatmap_api, name="heatmap_api"),
     # path("heatmap/<str:channel_ids>/", airqo_monitor.views.heatmap_with_filter, name="heatmap_with_filter"),
 ]